@@ -1,4 +1,5 @@
 import email.mime.text
+import archives
 import aws
 import json
 import os
@@ -8,7 +9,6 @@ import sys
 import shutil
 import subprocess
 import smtplib
-import tempfile
 import time
 import json
 
@@ -198,69 +198,35 @@ def SendPublishedEmail( aExecutable, aVersion, aPlatform, aReleaseNotes=None, aD
 
 
 def CommitAndPushFiles( aRepo, aFileList, aCommitMessage, aDryRun, aBranch=None ):
-    from git import Repo
-    clonePath = tempfile.mkdtemp()
-    if aBranch is not None and len(aBranch) > 0:
-        Info( "Locally clone %s (%s) to %s" % ( aRepo, aBranch, clonePath ) )
-        localRepo = Repo.clone_from( aRepo, clonePath, branch=aBranch )
-    else:
-        Info( "Locally clone %s to %s" % ( aRepo, clonePath ) )
-        localRepo = Repo.clone_from( aRepo, clonePath )
-
+    import git_mirror
     repoName = os.path.basename( aRepo ).split('.')[0]
+    files = {}
     for file in aFileList:
-        # copy locally changed files to clone
+        # locally changed files go to the same directory (or the root) of the repo
         parentDir = os.path.abspath(os.path.join(file, os.pardir))
         fileDir = os.path.basename( parentDir )
         if fileDir == repoName:
             fileDir = ""
-        relPath = os.path.join( fileDir, os.path.basename( file ) )
-        fullPath = os.path.join( clonePath, relPath )
-        Info( "Copy %s to %s " % ( file, fullPath ) )
-        shutil.copy2( file, fullPath )
-        localRepo.index.add( [relPath] )  # add changes
-
-    if localRepo.is_dirty():  # check if any changes to commit
-        Info( "Committing changed files..." )
-        Info( "%s" % localRepo.git.status() )
-        if not aDryRun:
-            localRepo.index.commit( "%s" % aCommitMessage )  # commit changes
-        Info( "Pushing changes to %s" % aRepo )
-        if not aDryRun:
-            localRepo.git.push()
-    else:
-        Info( "No changed files to commit!" )
-
-    shutil.rmtree( clonePath )  # remove temp clone
+        files[file] = os.path.join( fileDir, os.path.basename( file ) )
+    Info( "Update %s from local mirror" % aRepo )
+    git_mirror.GitMirrorCache().commit_files( aRepo, files, "%s" % aCommitMessage, aDryRun, aBranch, Info )
 
 
 def PushNewTag( aRepo, aNewTag, aExistingTag, aDryRun ):
-    from git import Repo
-    clonePath = tempfile.mkdtemp()
-    Info( "Locally clone %s to %s" % ( aRepo, clonePath ) )
-    localRepo = Repo.clone_from( aRepo, clonePath )
+    import git_mirror
     Info( "Adding new tag %s to existing tag %s" % ( aNewTag, aExistingTag ) )
-    newTag = None
-    if not aDryRun:
-        newTag = localRepo.create_tag( aNewTag, ref=aExistingTag )
     Info( "Pushing new tag to %s" % aRepo )
-    if not aDryRun:
-        localRepo.remotes.origin.push( newTag )
-    shutil.rmtree( clonePath )  # remove temp clone
+    git_mirror.GitMirrorCache().push_tag( aRepo, aNewTag, aExistingTag, aDryRun )
 
 
 def GetDependenciesJson( aRepo, aVersion ):
-    from git import Repo
-    clonePath = tempfile.mkdtemp()
-    Info( "Locally clone %s to %s" % ( aRepo, clonePath ) )
-    localRepo = Repo.clone_from( aRepo, clonePath )
+    import git_mirror
     prefix = "release"
     if aVersion.split('.')[1] == "0":
         prefix = "nightly"
-    localRepo.git.checkout( "%s_%s" % ( prefix, aVersion ) )
-    depFile = os.path.join( clonePath, "projectdata", "dependencies.json")
-    jsonObjs = GetJsonObjects( depFile )
-    shutil.rmtree( clonePath )  # remove temp clone
+    Info( "Read dependencies of %s from local mirror" % aRepo )
+    data = git_mirror.GitMirrorCache().show( aRepo, "%s_%s" % ( prefix, aVersion ), "projectdata/dependencies.json" )
+    jsonObjs = json.loads( data.decode('utf-8') )  # performs validation as well
     print( "Dependecies for " + aRepo + " @ " + aVersion )
     for obj in jsonObjs:
         print( "    " + obj['name'] + ": " + obj['version'] )
@@ -511,7 +477,7 @@ def CheckPublishTestDsEmulatorLocal( aVersion, aDryRun=False ):
     CreateTestDsEmulator( aVersion, True, True, aDryRun )
 
 
-def CreateTestDsEmulator( aVersion, aCheckOnly, aLocalOnly, aDryRun ):
+def CreateTestDsEmulator( aVersion, aCheckOnly, aLocalOnly, aDryRun, aArchiveExtension='.tar.gz' ):
     kEmulatorTypes = [ { "os": "Linux-x64",   "spotify": "spotify_embedded/lib/libspotify_embedded_shared.so" },
                        { "os": "Windows-x86", "spotify": "spotify_embedded/lib/spotify_embedded_shared.dll" } ]
     jsonObjs = GetDependenciesJson( kProductRepo, aVersion )
@@ -608,10 +574,10 @@ def CreateTestDsEmulator( aVersion, aCheckOnly, aLocalOnly, aDryRun ):
 
         # will only end up here on a publish request (local or Aws)
 
-    tarOutputFile = localDirTop + ".tar.gz"
+    tarOutputFile = localDirTop + aArchiveExtension     # e.g. '.tar.zst' for a zstandard archive
     if os.path.exists( tarOutputFile ):
         os.remove( tarOutputFile )
-    with tarfile.open( tarOutputFile, "w:gz" ) as tarOut:
+    with archives.TarWriter( tarOutputFile ) as tarOut:
         tarOut.add( localDirTop, arcname=os.path.basename( localDirTop ) )
 
     shutil.rmtree( localDirTop )
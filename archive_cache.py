@@ -0,0 +1,195 @@
+"""Persistent per-user cache of downloaded dependency archives"""
+import hashlib
+import json
+import os
+import platform
+import tempfile
+import time
+from userlocks import FileLock
+
+kCacheDirEnv       = 'OHDEVTOOLS_CACHE_DIR'
+kCacheMaxEnv       = 'OHDEVTOOLS_CACHE_MAX_MB'
+kDefaultMaxMB      = 20 * 1024
+kIndexFilename     = 'index.json'
+kLockFilename      = 'cache.lock'
+kPartialSuffix     = '.part'
+kStalePartialSecs  = 24 * 60 * 60
+
+
+def default_cache_root():
+    """Root of the per-user ohdevtools cache (shared by the archive cache and friends)"""
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ohdevtools')
+
+
+def default_cache_dir():
+    return os.environ.get(kCacheDirEnv) or os.path.join(default_cache_root(), 'archives')
+
+
+class ArchiveCache(object):
+    """Content-addressed store of downloaded archives with LRU eviction
+
+    Entries are keyed by the (expanded) archive path plus the remote ETag and
+    size, but a lookup by path does not touch the network: the ETag is never
+    revalidated, as published archive paths are versioned and a cached copy is
+    taken to be current. An archive overwritten in place on AWS (rather than
+    published under a new version) is NOT picked up while a copy is cached -
+    remove it with remove(), or clear the cache directory. Archives checked
+    against a checksum (archive-sha256, a .sha256 sidecar or a lockfile) are
+    removed from the cache if they fail the check.
+
+    The index is updated under a file lock and archives are moved into place
+    with an atomic rename, so several builds can share one cache. Another
+    build may evict an archive between its lookup and being opened, so
+    callers should treat a failure to open it as a miss."""
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or default_cache_dir()
+        if max_bytes is None:
+            max_bytes = int(os.environ.get(kCacheMaxEnv, kDefaultMaxMB)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.index_filename = os.path.join(self.root, kIndexFilename)
+        self.lock_filename = os.path.join(self.root, kLockFilename)
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+
+    @staticmethod
+    def key(path, etag, size):
+        return hashlib.sha1(('%s\n%s\n%d' % (path, etag, size)).encode('utf-8')).hexdigest()
+
+    def lookup(self, path):
+        """Return local filename of cached copy of path, or None on a cache miss
+        (the copy is not revalidated against the remote archive's ETag)"""
+        with FileLock(self.lock_filename):
+            index = self._load_index()
+            entry = index.get(path)
+            if entry is None:
+                return None
+            filename = os.path.join(self.root, entry['file'])
+            try:
+                if os.path.getsize(filename) != entry['size']:
+                    raise OSError('size mismatch')
+            except OSError:
+                del index[path]
+                self._remove(filename)
+                self._save_index(index)
+                return None
+            entry['used'] = time.time()
+            self._save_index(index)
+            return filename
+
+    def contains(self, path):
+        return path in self._load_index()
+
+    def new_temp(self):
+        """Create a file (on the cache's filesystem) to download into before calling insert()"""
+        fd, filename = tempfile.mkstemp(suffix=kPartialSuffix, dir=self.root)
+        os.close(fd)
+        return filename
+
+    def insert(self, path, info, filename, extra=None):
+        """Move downloaded file into the cache, returning its new location.
+        info is the remote object's size/ETag as returned by aws.info(). Any
+        extra (JSON-serialisable) fields are stored alongside the entry."""
+        size = os.path.getsize(filename)
+        if not size or info is None or info.get('size', size) != size:
+            return filename
+        name = self.key(path, info.get('etag', ''), size)
+        cached = os.path.join(self.root, name)
+        try:
+            os.replace(filename, cached)
+        except OSError:
+            # (Windows) another build is using an identical copy - use that instead
+            self._remove(filename)
+        entry = {'file': name, 'size': size, 'etag': info.get('etag', ''), 'used': time.time()}
+        if extra:
+            entry.update(extra)
+        with FileLock(self.lock_filename):
+            index = self._load_index()
+            previous = index.get(path)
+            if previous is not None and previous['file'] != name:
+                self._remove(os.path.join(self.root, previous['file']))
+            index[path] = entry
+            self._evict(index, self.max_bytes, keep=path)
+            self._save_index(index)
+        return cached
+
+    def entry(self, path):
+        return self._load_index().get(path)
+
+    def remove(self, path):
+        """Discard the cached copy of path (e.g. found to be corrupt)"""
+        with FileLock(self.lock_filename):
+            index = self._load_index()
+            entry = index.pop(path, None)
+            if entry is not None:
+                self._remove(os.path.join(self.root, entry['file']))
+                self._save_index(index)
+
+    def stats(self):
+        index = self._load_index()
+        return {
+            'root': self.root,
+            'entries': len(index),
+            'bytes': sum(e['size'] for e in index.values()),
+            'max-bytes': self.max_bytes}
+
+    def prune(self, max_bytes=None):
+        """Evict least recently used entries down to max_bytes (default: the configured
+        limit) and tidy up abandoned downloads. Returns number of archives removed."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with FileLock(self.lock_filename):
+            index = self._load_index()
+            removed = self._evict(index, max_bytes)
+            self._save_index(index)
+            known = set(e['file'] for e in index.values())
+            now = time.time()
+            for name in os.listdir(self.root):
+                filename = os.path.join(self.root, name)
+                if name in known or name in (kIndexFilename, kLockFilename) or not os.path.isfile(filename):
+                    continue
+                if name.endswith(kPartialSuffix) and now - os.path.getmtime(filename) < kStalePartialSecs:
+                    continue    # may be a download in progress
+                self._remove(filename)
+        return removed
+
+    def _evict(self, index, max_bytes, keep=None):
+        removed = 0
+        total = sum(e['size'] for e in index.values())
+        for path, entry in sorted(index.items(), key=lambda item: item[1]['used']):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            self._remove(os.path.join(self.root, entry['file']))
+            del index[path]
+            total -= entry['size']
+            removed += 1
+        return removed
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename, 'rt') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        tmpname = self.index_filename + '.tmp'
+        with open(tmpname, 'wt') as f:
+            json.dump(index, f)
+        os.replace(tmpname, self.index_filename)
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass        # (Windows) still open in another build - picked up by a later prune
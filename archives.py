@@ -0,0 +1,492 @@
+"""Extraction of dependency archives, fanning file writes out to worker threads"""
+import hashlib
+import os
+import queue
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # only needed for .tar.zst archives
+
+kMaxJobs          = 8
+kMaxPooledFile    = 16 * 1024 * 1024   # larger files are streamed to disk by the reading thread
+kMaxPendingBytes  = 128 * 1024 * 1024  # limit on file data read but not yet written
+kCopyChunk        = 1024 * 1024
+kHashChunk        = 1024 * 1024
+kZstdExtensions   = ('.tar.zst', '.tzst')
+kZstdLevel        = 10                 # archives are written once and fetched many times
+kZstdBlock        = 1024 * 1024
+kZstdReadAhead    = 16                 # blocks decoded ahead of the tar reader
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def default_jobs():
+    return max(1, min(kMaxJobs, os.cpu_count() or 1))
+
+
+def hash_file(path, algorithm='sha1'):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(kHashChunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def hash_file_digests(path, algorithms):
+    """Digests of the file at path with each of algorithms (in one pass) - {algorithm: hex digest}"""
+    hashes = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(kHashChunk)
+            if not data:
+                break
+            for h in hashes.values():
+                h.update(data)
+    return dict((algorithm, h.hexdigest()) for algorithm, h in hashes.items())
+
+
+def merge_tree(src, dest):
+    """Move everything under src into dest (merging with any directories already
+    there, replacing files) and remove src. Directories take the mode and
+    modification time they have in src."""
+    directories = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(dirpath, src))
+        ParallelExtractor.makedirs(target)
+        st = os.stat(dirpath)
+        directories.append((target, st))
+        os.chmod(dirpath, st.st_mode | 0o700)   # so that its entries can be moved out
+        for name in filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]:
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(os.path.join(target, name)) and not os.path.islink(os.path.join(target, name)):
+                raise IOError('Unable to replace directory %s with a file' % os.path.join(target, name))
+            os.replace(path, os.path.join(target, name))
+    for target, st in reversed(directories):
+        os.chmod(target, st.st_mode & 0o7777)
+        os.utime(target, (st.st_atime, st.st_mtime))
+    for dirpath, _dirnames, _filenames in os.walk(src, topdown=False):
+        os.rmdir(dirpath)
+
+
+def rmtree(path):
+    """Remove the tree at path - making read-only directories (and on Windows,
+    files), which unpacked trees may contain, writable as needed"""
+    shutil.rmtree(path, onerror=make_writable)
+
+
+def make_writable(func, path, _exc):
+    """shutil.rmtree error handler - make path (and its directory) writable and retry func"""
+    for p in (os.path.dirname(path), path):
+        if os.path.lexists(p) and not os.path.islink(p):
+            os.chmod(p, stat.S_IRWXU)
+    func(path)
+
+
+def is_zstd(path):
+    return path.lower().endswith(kZstdExtensions)
+
+
+def is_tar(path):
+    return is_zstd(path) or tarfile.is_tarfile(path)
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise Exception("Zstandard archives require the zstandard module - please install it using 'pip install zstandard'")
+
+
+def scan_tree(root, base):
+    """File table (as ExtractStats.table) of the files under root, relative to base"""
+    table = {}
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, base).replace('\\', '/')
+            if os.path.islink(path):
+                table[rel] = [None, None, None]
+            else:
+                st = os.stat(path)
+                table[rel] = [st.st_size, int(st.st_mtime), hash_file(path)]
+    return table
+
+
+def _shared_pool():
+    # one pool shared by all extractions, so that unpacking several dependencies
+    # at once doesn't multiply the number of writer threads
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(default_jobs())
+        return _pool
+
+
+class ExtractStats(object):
+    """Counts of files/bytes written by an extraction, and a table of the files
+    written (relative path -> [size, mtime, sha1])"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.table = {}
+        self.lock = threading.Lock()
+
+    def add(self, size, name=None, mtime=None, digest=None):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if name is not None:
+                self.table[name] = [size, int(mtime), digest]
+
+    def add_link(self, name):
+        # links are recorded (so that their owner is known) but not checked
+        with self.lock:
+            self.table[name] = [None, None, None]
+
+    def summary(self):
+        secs = max(self.seconds, 0.001)
+        return 'unpacked %d files (%.1f MB) in %.1fs - %d files/s, %.1f MB/s' % (
+            self.files, self.bytes / 1048576.0, self.seconds, self.files / secs, self.bytes / 1048576.0 / secs)
+
+
+class ParallelExtractor(object):
+    """Unpacks an archive into dest. The archive is read (and decompressed) on the
+    calling thread, while file creation, writes and permission setting are done
+    on a pool of worker threads. As with the original single-threaded unpacker,
+    an existing file which can't be opened for writing is deleted and replaced."""
+
+    def __init__(self, dest, pool=None):
+        self.dest = os.path.abspath(dest)
+        self.pool = pool or _shared_pool()
+        self.stats = ExtractStats()
+        self.pending = []
+        self.pending_bytes = 0
+        self.cond = threading.Condition()
+        self.errors = []
+
+    def extract_tar(self, tf):
+        """Extract all members of tf (which may be opened in stream mode)"""
+        start = time.time()
+        directories = []
+        links = []
+        try:
+            for member in tf:
+                target = self.target_path(member.name)
+                if member.isdir():
+                    self.makedirs(target)
+                    directories.append((target, member))
+                elif member.isreg():
+                    self.makedirs(os.path.dirname(target))
+                    if member.size > kMaxPooledFile:
+                        self.write_streamed(target, tf.extractfile(member), member)
+                    else:
+                        data = tf.extractfile(member).read()
+                        self.submit(self.write_file, target, data, member.mode, member.mtime, member.name)
+                elif member.issym() or member.islnk():
+                    links.append(member)     # made after the files they may refer to are written
+                else:
+                    self.extract_member(tf, member, target)
+        except BaseException:
+            self.abandon()
+            raise
+        self.wait()
+        for member in links:
+            target = self.target_path(member.name)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                # otherwise tarfile falls back to re-reading the link target from
+                # the archive, which isn't possible when it is opened in stream mode
+                os.unlink(target)
+            self.extract_member(tf, member, target)
+            self.stats.add_link(self.relative(target))
+        # set directory permissions last, in case they are not writable
+        for target, member in sorted(directories, key=lambda d: d[0], reverse=True):
+            os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+        self.stats.seconds = time.time() - start
+        return self.stats
+
+    def extract_zip(self, source):
+        """Extract zip file source, inflating members in parallel"""
+        start = time.time()
+        local = threading.local()
+        handles = []
+
+        def extract(info):
+            zf = getattr(local, 'zf', None)
+            if zf is None:
+                zf = local.zf = zipfile.ZipFile(source, mode='r')
+                handles.append(zf)
+            try:
+                target = zf.extract(info, path=self.dest)
+            except IOError:
+                existing = self.target_path(info.filename)
+                if not os.path.isfile(existing):
+                    raise       # not a locked file, which is the only case retried
+                os.unlink(existing)
+                target = zf.extract(info, path=self.dest)
+            self.stats.add(info.file_size, self.relative(target), os.path.getmtime(target), hash_file(target))
+
+        with zipfile.ZipFile(source, mode='r') as zf:
+            infos = zf.infolist()
+        # create directories up front so that workers don't race to create them -
+        # including the parents of files, as many zips have no directory entries
+        for info in infos:
+            target = self.target_path(info.filename)
+            self.makedirs(target if info.is_dir() else os.path.dirname(target))
+        infos = [info for info in infos if not info.is_dir()]
+        infos.sort(key=lambda info: info.compress_size, reverse=True)
+        try:
+            for info in infos:
+                self.submit(extract, info, size=0)
+            self.wait()
+        except BaseException:
+            self.abandon()
+            raise
+        finally:
+            for zf in handles:
+                zf.close()
+        self.stats.seconds = time.time() - start
+        return self.stats
+
+    def target_path(self, name):
+        target = os.path.normpath(os.path.join(self.dest, name))
+        if target != self.dest and not target.startswith(self.dest + os.sep):
+            raise IOError('Archive member would be unpacked outside %s: %s' % (self.dest, name))
+        return target
+
+    def relative(self, target):
+        return os.path.relpath(target, self.dest).replace('\\', '/')
+
+    @staticmethod
+    def makedirs(path):
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def submit(self, fn, *args, **kwargs):
+        size = kwargs.pop('size', None)
+        if size is None:
+            size = len(args[1])
+        with self.cond:
+            while self.pending_bytes and self.pending_bytes + size > kMaxPendingBytes:
+                self.cond.wait()
+            self.pending_bytes += size
+        if self.errors:
+            raise self.errors[0]
+        self.pending.append(self.pool.submit(self.run, fn, size, *args))
+
+    def run(self, fn, size, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            with self.cond:
+                self.pending_bytes -= size
+                self.cond.notify_all()
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        if self.errors:
+            raise self.errors[0]
+
+    def abandon(self):
+        """Cancel the writes not yet started and wait for those in progress, once
+        extraction has failed part-way - so that nothing is left writing into dest"""
+        for future in self.pending:
+            future.cancel()
+        wait(self.pending)
+        self.pending = []
+        with self.cond:
+            self.pending_bytes = 0
+
+    def write_file(self, target, data, mode, mtime, name):
+        try:
+            f = open(target, 'wb')
+        except IOError:
+            os.unlink(target)
+            f = open(target, 'wb')
+        with f:
+            f.write(data)
+        os.chmod(target, mode)
+        os.utime(target, (mtime, mtime))
+        self.stats.add(len(data), self.relative(target), mtime, hashlib.sha1(data).hexdigest())
+
+    def write_streamed(self, target, source, member):
+        try:
+            f = open(target, 'wb')
+        except IOError:
+            os.unlink(target)
+            f = open(target, 'wb')
+        h = hashlib.sha1()
+        with f:
+            while True:
+                data = source.read(kCopyChunk)
+                if not data:
+                    break
+                h.update(data)
+                f.write(data)
+        os.chmod(target, member.mode)
+        os.utime(target, (member.mtime, member.mtime))
+        self.stats.add(member.size, self.relative(target), member.mtime, h.hexdigest())
+
+    def extract_member(self, tf, member, target):
+        try:
+            tf.extract(member, path=self.dest)
+        except IOError:
+            os.unlink(target)
+            tf.extract(member, path=self.dest)
+        self.stats.add(member.size)
+
+
+class TarStream(object):
+    """Tar archive read sequentially from fileobj (which is left open), in the
+    format given by the extension of name. Use the tarfile attribute to read it,
+    and close() when done."""
+
+    def __init__(self, fileobj, name):
+        self.decoder = None
+        mode = 'r|*'
+        if is_zstd(name):
+            self.decoder = fileobj = ZstdReader(fileobj)
+            mode = 'r|'
+        try:
+            self.tarfile = tarfile.open(fileobj=fileobj, mode=mode)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if getattr(self, 'tarfile', None) is not None:
+            self.tarfile.close()
+            self.tarfile = None
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ZstdReader(object):
+    """Decoded contents of the zstandard stream fileobj. Decompression runs on
+    its own thread (zstandard releases the GIL), overlapping with parsing the
+    tar stream and handing files to the writer threads."""
+
+    def __init__(self, fileobj):
+        _require_zstandard()
+        self.reader = zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_size=kZstdBlock, read_across_frames=True, closefd=False)
+        self.blocks = queue.Queue(kZstdReadAhead)
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._decode)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _decode(self):
+        try:
+            while not self.closed:
+                data = self.reader.read(kZstdBlock)
+                self._put(data)
+                if not data:
+                    break
+        except zstandard.ZstdError as e:
+            self._put(IOError('Corrupt zstandard archive: %s' % e))
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.closed:
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        chunks = []
+        while size < 0 or size > 0:
+            if self.offset >= len(self.buffer):
+                if self.eof:
+                    break
+                item = self.blocks.get()
+                if isinstance(item, Exception):
+                    self.eof = True
+                    raise item
+                if not item:
+                    self.eof = True
+                    break
+                self.buffer, self.offset = item, 0
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            chunks.append(self.buffer[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(chunks)
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+
+
+class TarWriter(object):
+    """Tar archive written to filename, compressed according to its extension:
+    .tar.zst or .tzst with zstandard (using all cores), .tar.gz, .tgz, .tar.bz2
+    or .tar.xz as usual, otherwise uncompressed."""
+
+    def __init__(self, filename, level=kZstdLevel):
+        self.file = None
+        self.compressor = None
+        if is_zstd(filename):
+            _require_zstandard()
+            self.file = open(filename, 'wb')
+            self.compressor = zstandard.ZstdCompressor(level=level, threads=-1, write_checksum=True).stream_writer(self.file, closefd=False)
+            self.tarfile = tarfile.open(fileobj=self.compressor, mode='w|')
+        else:
+            self.tarfile = tarfile.open(filename, 'w:' + self.compression(filename))
+
+    @staticmethod
+    def compression(filename):
+        lower = filename.lower()
+        for extensions, compression in ((('.tar.gz', '.tgz'), 'gz'), (('.tar.bz2', '.tbz2'), 'bz2'), (('.tar.xz', '.txz'), 'xz')):
+            if lower.endswith(extensions):
+                return compression
+        return ''
+
+    def add(self, name, arcname=None):
+        self.tarfile.add(name, arcname=arcname)
+
+    def close(self):
+        self.tarfile.close()
+        if self.compressor is not None:
+            self.compressor.close()     # ends the frame - the file is left open
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
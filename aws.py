@@ -73,8 +73,10 @@ class __aws:
             keyDst = '/'.join(aDst.split('/')[3:])
             self.client.copy_object(Bucket=bucketDst, Key=keyDst, CopySource="%s/%s" % (bucketSrc, keySrc))
         elif 's3://' in aSrc:
-            bucket = self.s3.Bucket(aSrc.split('/')[2])
-            obj = bucket.Object('/'.join(aSrc.split('/')[3:]))
+            # use the client (rather than a resource object) as it is thread-safe, allowing
+            # dependencies to be downloaded concurrently
+            bucket = aSrc.split('/')[2]
+            key = '/'.join(aSrc.split('/')[3:])
             try:
                 outDir = os.path.dirname(aDst)
                 if not os.path.exists(outDir):
@@ -82,7 +84,7 @@ class __aws:
             except:
                 pass
             with open(aDst, 'wb') as data:
-                obj.download_fileobj(data)
+                self.client.download_fileobj(bucket, key, data)
         elif 's3://' in aDst:
             bucket = self.s3.Bucket(aDst.split('/')[2])
             with open(aSrc, 'rb') as data:
@@ -124,6 +126,31 @@ class __aws:
             pass
         return exists
 
+    def _info(self, aUri):
+        """Return size, ETag and modification time of specified URI (None if not present)"""
+        bucket = aUri.split('/')[2]
+        key = '/'.join(aUri.split('/')[3:])
+        try:
+            resp = self.client.head_object(Bucket=bucket, Key=key)
+        except:
+            return None
+        return {'size': resp['ContentLength'], 'etag': resp['ETag'].strip('"'), 'modified': int(resp['LastModified'].timestamp())}
+
+    def _stream(self, aUri):
+        """Open specified URI for streaming - returns (readable body, info) where info
+           is as returned by _info()"""
+        bucket = aUri.split('/')[2]
+        key = '/'.join(aUri.split('/')[3:])
+        resp = self.client.get_object(Bucket=bucket, Key=key)
+        info = {'size': resp['ContentLength'], 'etag': resp['ETag'].strip('"'), 'modified': int(resp['LastModified'].timestamp())}
+        return resp['Body'], info
+
+    def _put(self, aUri, aData):
+        """Upload bytes aData to specified URI"""
+        bucket = aUri.split('/')[2]
+        key = '/'.join(aUri.split('/')[3:])
+        self.client.put_object(Bucket=bucket, Key=key, Body=aData)
+
     def _listItems(self, aUri, aSort=None):
         """Return (non-recursive) directory listing of specified URI"""
         entries = []
@@ -333,11 +360,14 @@ copy                 = aws._copy
 download             = aws._download
 delete               = aws._delete
 exists               = aws._exists
+info                 = aws._info
+stream               = aws._stream
 listDetails          = aws._listItems
 listDetailsRecursive = aws._listDetailsRecursive
 listItems            = aws._listItems
 listItemsRecursive   = aws._listItemsRecursive
 move                 = aws._move
+put                  = aws._put
 rsync                = aws._rsync
 
 
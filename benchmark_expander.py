@@ -0,0 +1,180 @@
+"""Micro-benchmark of dependency environment expansion.
+
+Compares the compiled templates used by EnvironmentExpander with the original
+expander (which re-parsed each value with template_regex on every expansion),
+reading and fully expanding a synthetic dependencies.json of 2,000 entries.
+Also checks that both give identical results.
+
+With --platforms, instead compares expanding the file separately for each of
+N platforms (and both debugmodes) with one dependency_matrix.DependencyMatrix,
+which shares the values that don't depend on the platform or debugmode.
+
+    python benchmark_expander.py [--entries N] [--repeat N] [--platforms N]
+"""
+from __future__ import print_function
+from argparse import ArgumentParser
+import io
+import json
+import time
+import dependencies
+import dependency_matrix
+import environment_expander
+
+
+class LegacyEnvironmentExpander(dependencies.EnvironmentExpander):
+    """EnvironmentExpander as it was before templates were compiled"""
+
+    def expandstring(self, value):
+        firstmatch = self.template_regex.match(value)
+        if firstmatch is not None and firstmatch.group(0) == value and value != "$$":
+            return self.replacematch(firstmatch)
+        return self.template_regex.sub(self.replacematch, value)
+
+    def replacematch(self, match):
+        if match.group('dollar'):
+            return '$'
+        key = None
+        if match.group('word'):
+            key = match.group('word')[1:]
+        if match.group('parens'):
+            key = match.group('parens')[2:-1]
+        assert key is not None
+        key = key.strip()
+        if '[' in key:
+            return self.expandlookup(key)
+        if '?' in key:
+            return self.expandconditional(key)
+        return self.expand(key)
+
+    def expandlookup(self, key):
+        match = self.index_regex.match(key)
+        if match is None:
+            raise ValueError('lookup must be of form ${table[key]}')
+        tablename = match.group(1).strip()
+        keyname = match.group(2).strip()
+        table = self.expand(tablename)
+        if keyname.startswith('$'):
+            key = self.expand(keyname[1:])
+        else:
+            key = keyname
+        if not isinstance(table, dict):
+            raise ValueError("lookup table must expand to a JSON object (got {0!r} instead)".format(table))
+        if not isinstance(key, ("".__class__, u"".__class__)):
+            raise ValueError("lookup index must expand to a JSON string (got {0!r} instead)".format(key))
+        if key not in table:
+            if '*' in table:
+                return table['*']
+            raise KeyError("Key not in table, and no default '*' entry found: key={0!r}\ntable={1!r}".format(key, table))
+        return table[key]
+
+    def expandconditional(self, key):
+        if '?' not in key:
+            raise ValueError('conditional must be of form ${condition?result:alternative}')
+        condition, rest = key.split('?', 1)
+        if ':' not in rest:
+            raise ValueError('conditional must be of form ${condition?result:alternative}')
+        primary, alternative = rest.split(':', 1)
+        condition, primary, alternative = [x.strip() for x in [condition, primary, alternative]]
+        try:
+            conditionvalue = self.expand(condition)
+        except KeyError:
+            conditionvalue = False
+        if self.is_trueish(conditionvalue):
+            return self.expand(primary)
+        return self.expand(alternative)
+
+
+def synthetic_dependencies(count):
+    deps = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            deps.append({'name': 'Lib%d' % i, 'version': '1.%d.%d' % (i % 50, i), 'type': 'openhome'})
+        elif kind == 1:
+            deps.append({'name': 'Internal%d' % i, 'version': '2.%d.0' % i, 'type': 'internal',
+                         'platform-specific': i % 3 != 0})
+        elif kind == 2:
+            deps.append({'name': 'Tool%d' % i, 'archive-filename': 'Tool%d-${platform}.zip' % i,
+                         'configure-args': ['--with-tool%d=${dest}Tool%d' % (i, i), '--mode=$debugmode']})
+        else:
+            deps.append({'name': 'Mapped%d' % i, 'version': '3.0.%d' % i, 'type': 'openhome',
+                         'platform-map': {'Linux-x64': 'linux64', 'Windows-x86': 'win32', '*': 'other'},
+                         'archive-platform': '${platform-map[$platform]}',
+                         'use-local-archive': '${use-local?local-flag:remote-flag}',
+                         'local-flag': True, 'remote-flag': False,
+                         'local-archive-path': '../Mapped%d/build/Mapped%d.tar.gz' % (i, i)})
+    return deps
+
+
+def run(source, env):
+    start = time.time()
+    collection = dependencies.read_json_dependencies(io.StringIO(source), io.StringIO(u'[]'), dict(env))
+    expanded = {}
+    for name, dependency in collection.items():
+        expanded[name] = dependency.items()
+    return time.time() - start, expanded
+
+
+def run_separately(definitions, envs):
+    start = time.time()
+    expanded = []
+    for env in envs:
+        collection = dependencies.create_collection(definitions, [], env)
+        expanded.append(dict((name, dependency.items()) for name, dependency in collection.items()))
+    return time.time() - start, expanded
+
+
+def run_matrix(definitions, envs):
+    start = time.time()
+    matrix = dependencies.create_matrix(definitions, [], envs)
+    expanded = [dict((name, dependency.items()) for name, dependency in collection.items())
+                for collection in matrix.collections]
+    return time.time() - start, expanded
+
+
+def main_matrix(options):
+    definitions = synthetic_dependencies(options.entries)
+    platforms = dependency_matrix.supported_platforms()[:options.platforms]
+    envs = dependency_matrix.combination_envs(platforms, ('Release', 'Debug'), {'linn-git-user': 'bench'})
+    results = {}
+    for label, run_one in (('separate', run_separately), ('matrix', run_matrix)):
+        best, expanded = min(run_one(definitions, envs) for _ in range(options.repeat))
+        results[label] = (best, expanded)
+        print("%-9s best of %d %.3fs" % (label, options.repeat, best))
+    if results['separate'][1] != results['matrix'][1]:
+        raise Exception("Matrix and separate expansion differ")
+    print("identical results for %d dependencies x %d combinations; speed-up %.1fx" % (
+        options.entries, len(envs), results['separate'][0] / max(results['matrix'][0], 1e-9)))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark dependency environment expansion.")
+    parser.add_argument('--entries', type=int, default=2000, help="Number of dependencies in synthetic file.")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of runs of each (best is reported).")
+    parser.add_argument('--platforms', type=int, default=None, help="Compare separate and matrix expansion for this many platforms.")
+    options = parser.parse_args()
+    if options.platforms:
+        return main_matrix(options)
+
+    source = json.dumps(synthetic_dependencies(options.entries))
+    env = {'platform': 'Linux-x64', 'debugmode': 'Release', 'linn-git-user': 'bench'}
+    results = {}
+    compiled = dependencies.EnvironmentExpander
+    for label, expander in (('legacy', LegacyEnvironmentExpander), ('compiled', compiled)):
+        dependencies.EnvironmentExpander = expander
+        try:
+            environment_expander._compiled_templates.clear()
+            cold, expanded = run(source, env)
+            best = min(run(source, env)[0] for _ in range(options.repeat))
+        finally:
+            dependencies.EnvironmentExpander = compiled
+        results[label] = (cold, best, expanded)
+        print("%-9s first run %.3fs, best of %d %.3fs" % (label, cold, options.repeat, best))
+    if results['legacy'][2] != results['compiled'][2]:
+        raise Exception("Compiled and legacy expansion differ")
+    print("identical results for %d dependencies; speed-up %.1fx" % (
+        options.entries, results['legacy'][1] / max(results['compiled'][1], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
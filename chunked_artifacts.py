@@ -0,0 +1,353 @@
+"""Chunked, content-addressed form of dependency archives, so that a fetch only
+downloads the parts of an archive not already held locally.
+
+Publishing (see publish()) splits each file in a tar archive into content-defined
+chunks - boundaries never cross files, and within large files they are chosen
+by a rolling hash so that an insertion only changes the chunks around it. Each
+chunk is stored (zlib compressed) once per bucket under
+s3://<bucket>/chunks/<aa>/<sha256>, and a manifest listing the tree and its
+chunks is published next to the archive as <archive>.chunks.json.
+
+Fetching (see Dependency.fetch_chunked) downloads the chunks missing from the
+local ChunkStore and rebuilds the tree from them."""
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import archive_cache
+import archives
+import aws
+
+try:
+    import numpy
+except ImportError:
+    numpy = None        # the rolling hash runs (much more slowly) in Python without it
+
+kManifestSuffix     = '.chunks.json'
+kManifestFormat     = 1
+kChunkPrefix        = 'chunks'
+kChunkDirEnv        = 'OHDEVTOOLS_CHUNK_DIR'
+kMinChunk           = 256 * 1024
+kMaxChunk           = 4 * 1024 * 1024
+kChunkMask          = 0xFFFFF000           # 20 bits - average chunk ~1MB beyond kMinChunk
+kHashWindow         = 32                   # bytes which affect the rolling hash at each position
+kHashBlock          = 256 * 1024           # bytes hashed at once with numpy
+kCompressLevel      = 6
+kJobs               = 16
+kMaxPendingUploads  = 64
+kMaxMissingFraction = 0.5   # fetch the whole archive instead if more than this would be downloaded
+kDefaultMaxAge      = 30    # days
+
+# gear table for the rolling hash - fixed, as publisher and fetcher must agree
+_gear = [int(hashlib.sha256(bytes([i])).hexdigest()[:8], 16) for i in range(256)]
+_gear_array = numpy.array(_gear, dtype=numpy.uint32) if numpy is not None else None
+
+
+def chunk_root(remote_path):
+    return 's3://%s/%s/' % (remote_path.split('/')[2], kChunkPrefix)
+
+
+def chunk_uri(root, digest):
+    return '%s%s/%s' % (root, digest[:2], digest)
+
+
+def split(f):
+    """Split the contents of file object f (one file) into content-defined
+    chunks - reading no more than the largest chunk at a time"""
+    window = b''
+    while True:
+        while len(window) < kMaxChunk:
+            data = f.read(kMaxChunk - len(window))
+            if not data:
+                break
+            window += data
+        if not window:
+            return
+        cut = find_cut(window)
+        yield window[:cut]
+        window = window[cut:]
+
+
+def find_cut(window):
+    """Length of the chunk at the start of window (up to kMaxChunk bytes) - just
+    after the first position beyond kMinChunk where the rolling hash, restarted
+    at kMinChunk, has none of kChunkMask set"""
+    if len(window) <= kMinChunk:
+        return len(window)
+    if numpy is None:
+        h = 0
+        for i in range(kMinChunk, len(window)):
+            h = ((h << 1) + _gear[window[i]]) & 0xFFFFFFFF
+            if not h & kChunkMask:
+                return i + 1
+        return len(window)
+    # the hash at each position is the sum of the gear values of the last
+    # kHashWindow bytes, each shifted by its distance back (older ones are
+    # shifted out), so a block can be hashed at once given the bytes before it
+    data = numpy.frombuffer(window, dtype=numpy.uint8, offset=kMinChunk)
+    for start in range(0, len(data), kHashBlock):
+        lead = min(start, kHashWindow - 1)
+        gear = _gear_array[data[start - lead:start + kHashBlock]]
+        h = gear.copy()
+        for shift in range(1, kHashWindow):
+            h[shift:] += gear[:-shift] << numpy.uint32(shift)
+        hits = numpy.flatnonzero((h[lead:] & numpy.uint32(kChunkMask)) == 0)
+        if len(hits):
+            return kMinChunk + start + int(hits[0]) + 1
+    return len(window)
+
+
+def publish(archive_path, remote_path, jobs=kJobs):
+    """Publish local tar archive archive_path (already uploaded to remote_path)
+    in chunked form - uploading the chunks not already in the bucket, then the
+    manifest. Returns the manifest."""
+    root = chunk_root(remote_path)
+    entries = []
+    seen = set()
+    pending = []
+    counts = {'chunks': 0, 'uploaded': 0, 'bytes': 0}
+    lock = threading.Lock()
+    start = time.time()
+
+    def upload(digest, data):
+        uri = chunk_uri(root, digest)
+        if aws.info(uri) is None:
+            aws.put(uri, data)
+            with lock:
+                counts['uploaded'] += 1
+                counts['bytes'] += len(data)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        with open(archive_path, 'rb') as f, archives.TarStream(f, archive_path) as archive:
+            tf = archive.tarfile
+            for member in tf:
+                entry = {'name': member.name, 'mode': member.mode, 'mtime': member.mtime}
+                if member.isdir():
+                    entry['type'] = 'dir'
+                elif member.issym():
+                    entry['type'] = 'symlink'
+                    entry['linkname'] = member.linkname
+                elif member.islnk():
+                    entry['type'] = 'link'
+                    entry['linkname'] = member.linkname
+                elif member.isreg():
+                    entry['type'] = 'file'
+                    entry['size'] = member.size
+                    entry['chunks'] = []
+                    for chunk in split(tf.extractfile(member)):
+                        digest = hashlib.sha256(chunk).hexdigest()
+                        compressed = zlib.compress(chunk, kCompressLevel)
+                        entry['chunks'].append([digest, len(chunk), len(compressed)])
+                        counts['chunks'] += 1
+                        if digest not in seen:
+                            seen.add(digest)
+                            pending.append(pool.submit(upload, digest, compressed))
+                            if len(pending) > kMaxPendingUploads:
+                                pending.pop(0).result()
+                else:
+                    continue    # devices etc. aren't expected in dependency archives
+                entries.append(entry)
+        for future in pending:
+            future.result()
+    manifest = {
+        'format': kManifestFormat,
+        'archive': os.path.basename(remote_path),
+        'archive-size': os.path.getsize(archive_path),
+        'archive-sha256': archives.hash_file(archive_path, 'sha256'),
+        'chunk-root': root,
+        'entries': entries}
+    aws.put(remote_path + kManifestSuffix, json.dumps(manifest).encode('utf-8'))
+    print("Published %s as %d chunks (%d new, %.1f MB uploaded) in %.1fs" % (
+        remote_path, counts['chunks'], counts['uploaded'], counts['bytes'] / 1048576.0, time.time() - start))
+    return manifest
+
+
+def load_manifest(remote_path):
+    """Chunk manifest published for remote_path, or None if it was not published chunked"""
+    if not remote_path.startswith('s3:'):
+        return None
+    try:
+        body, _info = aws.stream(remote_path + kManifestSuffix)
+    except Exception:
+        return None
+    try:
+        manifest = json.loads(body.read().decode('utf-8'))
+    finally:
+        body.close()
+    if manifest.get('format') != kManifestFormat:
+        return None
+    return manifest
+
+
+def default_chunk_dir():
+    return os.environ.get(kChunkDirEnv) or os.path.join(archive_cache.default_cache_root(), 'chunks')
+
+
+class ChunkStore(object):
+    """Local store of (uncompressed) chunks, keyed by SHA-256, shared by all
+    workspaces of the user. Chunks are written atomically, so several builds can
+    share it; those unused for a while are removed by prune()."""
+
+    def __init__(self, root=None):
+        self.root = root or default_chunk_dir()
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def contains(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def put(self, digest, data):
+        filename = self.path(digest)
+        archives.ParallelExtractor.makedirs(os.path.dirname(filename))
+        tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, filename)
+
+    def get(self, digest):
+        filename = self.path(digest)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            os.unlink(filename)
+            raise IOError('Damaged chunk %s removed from %s' % (digest, self.root))
+        os.utime(filename, None)
+        return data
+
+    def missing(self, manifest):
+        """Chunks of manifest not in the store - {digest: compressed size}"""
+        missing = {}
+        for entry in manifest['entries']:
+            for digest, _size, csize in entry.get('chunks', []):
+                if digest not in missing and not self.contains(digest):
+                    missing[digest] = csize
+        return missing
+
+    def worthwhile(self, missing, manifest):
+        """Whether fetching the missing chunks beats downloading the whole archive"""
+        return sum(missing.values()) <= manifest['archive-size'] * kMaxMissingFraction
+
+    def download(self, manifest, missing, jobs=kJobs):
+        """Download the missing chunks. Returns number of bytes transferred."""
+        root = manifest['chunk-root']
+
+        def fetch(digest):
+            body, _info = aws.stream(chunk_uri(root, digest))
+            try:
+                compressed = body.read()
+            finally:
+                body.close()
+            data = zlib.decompress(compressed)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise IOError('Chunk %s is corrupt' % digest)
+            self.put(digest, data)
+            return len(compressed)
+
+        # largest first, so that the slowest download isn't left running on its own
+        with ThreadPoolExecutor(jobs) as pool:
+            return sum(pool.map(fetch, sorted(missing, key=missing.get, reverse=True)))
+
+    def seed(self, manifest, dest):
+        """Add the chunks of a tree unpacked (from the archive) into dest, so that
+        later versions can be fetched as chunks. Returns number of chunks added."""
+        added = 0
+        for entry in manifest['entries']:
+            if entry['type'] != 'file' or not entry['chunks']:
+                continue
+            if all(self.contains(digest) for digest, _size, _csize in entry['chunks']):
+                continue
+            try:
+                with open(os.path.join(dest, entry['name']), 'rb') as f:
+                    for digest, size, _csize in entry['chunks']:
+                        data = f.read(size)
+                        if not self.contains(digest) and hashlib.sha256(data).hexdigest() == digest:
+                            self.put(digest, data)
+                            added += 1
+            except (IOError, OSError):
+                pass
+        return added
+
+    def rebuild(self, manifest, dest):
+        """Write the tree described by manifest into dest from the stored chunks
+        (which must all be present). Returns archives.ExtractStats."""
+        extractor = archives.ParallelExtractor(dest)
+        start = time.time()
+        directories = []
+        links = []
+        try:
+            for entry in manifest['entries']:
+                target = extractor.target_path(entry['name'])
+                if entry['type'] == 'dir':
+                    extractor.makedirs(target)
+                    directories.append((target, entry))
+                elif entry['type'] == 'file':
+                    extractor.makedirs(os.path.dirname(target))
+                    if entry['size'] > archives.kMaxPooledFile:
+                        member = tarfile.TarInfo(entry['name'])
+                        member.size, member.mode, member.mtime = entry['size'], entry['mode'], entry['mtime']
+                        extractor.write_streamed(target, ChunkReader(self, entry['chunks']), member)
+                    else:
+                        data = b''.join(self.get(digest) for digest, _size, _csize in entry['chunks'])
+                        extractor.submit(extractor.write_file, target, data, entry['mode'], entry['mtime'], entry['name'])
+                else:
+                    links.append((target, entry))
+        except BaseException:
+            extractor.abandon()     # e.g. a damaged chunk
+            raise
+        extractor.wait()
+        for target, entry in links:
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.unlink(target)
+            if entry['type'] == 'symlink':
+                os.symlink(entry['linkname'], target)
+            else:
+                os.link(extractor.target_path(entry['linkname']), target)
+            extractor.stats.add(0)
+            extractor.stats.add_link(extractor.relative(target))
+        # set directory permissions last, in case they are not writable
+        for target, entry in sorted(directories, key=lambda d: d[0], reverse=True):
+            os.chmod(target, entry['mode'])
+            os.utime(target, (entry['mtime'], entry['mtime']))
+        extractor.stats.seconds = time.time() - start
+        return extractor.stats
+
+    def prune(self, max_age_days=kDefaultMaxAge):
+        """Remove chunks unused for max_age_days. Returns number removed."""
+        removed = 0
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(filename) < cutoff:
+                        os.unlink(filename)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+class ChunkReader(object):
+    """File-like reader over the concatenated chunks of one file"""
+
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = list(chunks)
+        self.buffer = b''
+
+    def read(self, size):
+        while len(self.buffer) < size and self.chunks:
+            digest = self.chunks.pop(0)[0]
+            self.buffer += self.store.get(digest)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
@@ -12,9 +12,11 @@ from userlocks import userlock
 from default_platform import default_platform as _default_platform
 from functools import wraps
 import version
-import tarfile
 import glob
+import archives
 import aws
+import chunked_artifacts
+import trash
 
 
 AWS_BUCKET_PRIVATE = 'linn-artifacts-private'
@@ -60,9 +62,16 @@ def default_platform(fail_on_unknown=True):
     return p
 
 
-def delete_directory(path):
+def delete_directory(path, fast=False):
+    """Delete directory tree at path. With fast set, it is renamed out of the way
+    and deleted in the background (see trash.py), falling back to deleting it
+    here if it can't be renamed."""
     path = os.path.abspath(path)
     print('Deleting "' + path + '"... ')
+    trash.purge(os.path.dirname(path))
+    if fast and os.path.isdir(path) and trash.move_to_trash(path):
+        print('\nDone (deleting in background).\n')
+        return
     shutil.rmtree(path, ignore_errors=True)
     if os.path.isdir(path):
         print('\nFailed.\n')
@@ -396,20 +405,28 @@ class Builder(object):
         return selected, env
 
     def fetch_dependencies(self, *selected, **kwargs):
+        jobs = kwargs.pop('jobs', 1)
+        store = kwargs.pop('store', False)
+        locked = kwargs.pop('locked', False)
+        cross_check = kwargs.pop('cross_check', None)
         selected, env = self._process_dependency_args(*selected, **kwargs)
         clean = False
         if 'default' in self._enabled_options or 'all' in self._enabled_options or 'clean' in self._enabled_options:
             if self._context.options.incremental_fetch:
-                clean = False                                   # clean-for fetch follows clean-for-build
-            else:                                               # unless incremental-fetch option is set -  in
-                clean = True                                    # which case clean will NOT clean the dependencies
+                clean = False                                   # clean-for fetch follows clean-for-build, unless
+            else:                                               # incremental-fetch option is set. The clean is
+                clean = 'selective'                             # selective: only dependencies whose version has
+                                                                # changed (or which are no longer listed) are removed
         if 'clean' in self._disabled_options:
             clean = False
+        if cross_check is None:
+            cross_check = clean != 'selective'                  # a clean fetch has never been cross-checked
         try:
             dependencies.fetch_dependencies(
                 selected or None, platform=self._context.env["OH_PLATFORM"], env=env, fetch=True,
                 clean=clean, source=False,
-                local_overrides=not self._context.options.no_overrides)
+                local_overrides=not self._context.options.no_overrides,
+                jobs=jobs, store=store, locked=locked, cross_check=cross_check)
         except Exception as e:
             print(e)
             raise AbortRunException()
@@ -419,9 +436,11 @@ class Builder(object):
         return self._dependency_collection(env)
 
     def fetch_source(self, *selected, **kwargs):
+        jobs = kwargs.pop('jobs', 1)
+        mode = kwargs.pop('mode', 'full')
         selected, env = self._process_dependency_args(*selected, **kwargs)
         dependency_collection = self._dependency_collection(env)
-        return dependency_collection.checkout(selected or None)
+        return dependency_collection.checkout(selected or None, jobs=jobs, mode=mode)
 
     def get_dependency_args(self, *selected, **kwargs):
         selected, env = self._process_dependency_args(*selected, **kwargs)
@@ -593,6 +612,8 @@ class OpenHomeBuilder(object):
     automatic_steps = ['fetch', 'configure', 'clean', 'build', 'test']
     mdtool_mac = r'/Applications/Xamarin\ Studio.app/Contents/MacOS/mdtool'
     msbuild_verbosity = 'minimal'
+    publish_chunked = False        # Also publish tar packages uploaded to AWS in chunked form (see chunked_artifacts.py).
+    publish_checksums = False      # Also publish <package>.sha256 next to packages uploaded to AWS (checked by dependents with 'archive-checksum-sidecar').
 
     cover_reports = [ ]
 
@@ -944,7 +965,8 @@ class OpenHomeBuilder(object):
     def cover_compress(self, output, reports=None):
         '''
         Generates a tar file with the specified name, containing all the reports provided. If no reports are provided,
-        all the reports generated by the cover calls will be added.
+        all the reports generated by the cover calls will be added. The file is compressed according to its extension
+        (e.g. .tar.zst, .tar.gz).
         '''
         if self.should_cover():
             head, tail = os.path.split(output)
@@ -952,13 +974,34 @@ class OpenHomeBuilder(object):
                 os.makedirs(head)
             if reports is None:
                 reports = self.cover_reports
-            with tarfile.open(output, 'w') as tar:
+            with archives.TarWriter(output) as tar:
                 for report in reports:
                     head, tail = os.path.split(report)
                     tar.add(report, arcname=tail)
         else:
             print('Coverage not enabled for this platform, not generating ' + output)
 
+    def create_package(self, packagename, paths, package_location=None):
+        '''
+        Creates a package at package_location (default self.package_location), containing the files or directories
+        in paths - a list of paths, or of (path, name in package) pairs. The package is compressed according to its
+        extension, so e.g. '.tar.zst' produces a zstandard archive compressed using all cores.
+        '''
+        packagename = self._expand_template(packagename)
+        if package_location is None:
+            package_location = self.package_location
+        output = self._expand_template(package_location, packagename=packagename)
+        head, tail = os.path.split(output)
+        if head and not os.path.isdir(head):
+            os.makedirs(head)
+        with archives.TarWriter(output) as tar:
+            for path in paths:
+                if isinstance(path, tuple):
+                    tar.add(path[0], arcname=path[1])
+                else:
+                    tar.add(path, arcname=os.path.basename(path))
+        return output
+
     def publish_package_curl(self, package, server=None):
         '''
         Publishes package(s) to the specified server using curl.
@@ -968,11 +1011,14 @@ class OpenHomeBuilder(object):
                         'package=@{0}'.format(path),
                         server])
 
-    def publish_package(self, packagename, uploadpath, package_location=None, package_upload=None):
+    def publish_package(self, packagename, uploadpath, package_location=None, package_upload=None, chunked=None):
         '''
         Publish a package via scp to the package repository. Projects can
         override the package_location and package_upload template strings to
-        control where packages are uploaded to.
+        control where packages are uploaded to. With chunked (default
+        publish_chunked), tar packages uploaded to AWS are also published in
+        chunked form, so that dependents can fetch just what has changed. With
+        publish_checksums, the SHA-256 of the package is published next to it.
         '''
         packagename = self._expand_template(packagename)
         uploadpath = self._expand_template(uploadpath)
@@ -988,15 +1034,30 @@ class OpenHomeBuilder(object):
             awspath = 's3://%s/%s' % (AWS_BUCKET_PRIVATE, destinationpath.split('artifacts/')[2])
             print( 'Upload %s to AWS %s' % (sourcepath, awspath))
             aws.copy(sourcepath, awspath)
+            self._publish_checksum(sourcepath, awspath)
+            self._publish_chunked(sourcepath, awspath, chunked)
         elif 'openhome.org' in destinationpath:
             # reroute to AWS (public)
             awspath = 's3://%s/artifacts/%s' % (AWS_BUCKET_PUBLIC, destinationpath.split('artifacts/')[1])
             print( 'Upload %s to AWS %s' % (sourcepath, awspath))
             aws.copy(sourcepath, awspath)
+            self._publish_checksum(sourcepath, awspath)
+            self._publish_chunked(sourcepath, awspath, chunked)
         else:
             print( sourcepath, destinationpath )
             scp(sourcepath, destinationpath)
 
+    def _publish_checksum(self, sourcepath, awspath):
+        if self.publish_checksums:
+            digest = archives.hash_file(sourcepath, 'sha256')
+            aws.put(awspath + dependencies.kSidecarSuffix, ('%s  %s\n' % (digest, os.path.basename(awspath))).encode('ascii'))
+
+    def _publish_chunked(self, sourcepath, awspath, chunked):
+        if chunked is None:
+            chunked = self.publish_chunked
+        if chunked and archives.is_tar(sourcepath):
+            chunked_artifacts.publish(sourcepath, awspath)
+
     # This just sets up forwarding methods for a bunch of methods on the Builder, to
     # allow sub-classes access to them.
 
@@ -6,7 +6,10 @@
 from __future__ import print_function
 from ci_build import default_platform
 from argparse import ArgumentParser
+import archive_cache
+import chunked_artifacts
 import dependencies
+import dependency_store
 import getpass
 import sys
 import traceback
@@ -36,19 +39,65 @@ def main():
     parser = ArgumentParser(description=usage)
     parser.add_argument('--linn-git-user', default=None, help='Username to use when connecting to core.linn.co.uk.')
     parser.add_argument('--clean', action="store_true", default=False, help="Clean out the dependencies directory.")
+    parser.add_argument('--clean-changed', action="store_true", default=False, help="Only remove dependencies whose version has changed (or which are no longer listed) since they were fetched.")
     parser.add_argument('--all', action="store_true", default=False, help="Fetch all regular dependencies.")
     parser.add_argument('--source', action="store_true", default=False, help="Fetch source for listed dependencies.")
+    parser.add_argument('--shallow', action="store_const", const="shallow", dest="source_mode", default="full", help="With --source, only fetch the tagged commit of each repository.")
+    parser.add_argument('--blobless', action="store_const", const="blobless", dest="source_mode", default="full", help="With --source, make partial clones that fetch file contents only as they are checked out.")
     parser.add_argument('--release', action="store_const", const="Release", dest="debugmode", default="Release", help="")
     parser.add_argument('--debug', action="store_const", const="Debug", dest="debugmode", default="Release", help="")
     parser.add_argument('-v', '--verbose', action="store_true", default=False, help="Report more information in errors and for --list.")
-    parser.add_argument('--platform', default=None, help='Target platform.')
+    parser.add_argument('--platform', default=None, help='Target platform, or a comma-separated list of platforms to fetch together.')
     parser.add_argument('-l', '--list', action="store_true", default=False, help="Don't fetch anything, just list all dependencies.")
     parser.add_argument('--no-overrides', action="store_true", default=False, help="Don't process ../dependency_overrides.json for local overrides.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of dependencies to fetch (or check out, with --source) concurrently.")
+    parser.add_argument('--no-cache', action="store_true", default=False, help="Don't use (or populate) the local archive cache.")
+    parser.add_argument('--cache-stats', action="store_true", default=False, help="Report on the local archive cache and exit.")
+    parser.add_argument('--cache-prune', type=int, nargs='?', const=-1, default=None, metavar='MB', help="Evict least recently used archives from the local archive cache (down to MB, default the configured limit) and exit.")
+    parser.add_argument('--store', action="store_true", default=False, help="Unpack archives once into the per-machine dependency store and link them into the workspace.")
+    parser.add_argument('--store-hardlink', action="store_true", default=False, help="With --store, hardlink files from the store where they can't be reflinked, rather than copying them (they are then read-only, and shared with the store).")
+    parser.add_argument('--store-verify', action="store_true", default=False, help="Check the dependency store for damaged entries (removing them) and exit.")
+    parser.add_argument('--store-gc', type=int, nargs='?', const=dependency_store.kDefaultMaxAge, default=None, metavar='DAYS', help="Remove dependency store entries unused for DAYS (default %d) and exit." % dependency_store.kDefaultMaxAge)
+    parser.add_argument('--verify', action="store_true", default=False, help="Check fetched dependencies for modified or missing files, re-fetching any that are damaged (only reporting, if no dependencies are specified).")
+    parser.add_argument('--lock', action="store_true", default=False, help="Record the fully expanded dependencies for this platform and debugmode in projectdata/dependencies.lock.json.")
+    parser.add_argument('--locked', action="store_true", default=False, help="Fetch the dependencies recorded in projectdata/dependencies.lock.json (without reading dependencies.json).")
+    parser.add_argument('--verify-lock', action="store_true", default=False, help="With --locked, check that the locked archives haven't changed since they were locked.")
+    parser.add_argument('--report', default=None, metavar='FILE', help="Write a JSON report of the bytes, timings and status of each dependency fetched to FILE, and print a summary.")
+    parser.add_argument('--transitive', action="store_true", default=False, help="Also fetch the dependencies listed in the dependencies.json bundled with each fetched dependency (recursively).")
+    parser.add_argument('--graph', default=None, metavar='FILE', help="With --transitive, write the resolved dependency graph to FILE (Graphviz dot if FILE ends in .dot, else JSON).")
+    parser.add_argument('--chunked', action="store_true", default=False, help="Fetch archives published in chunked form by downloading only the chunks not already held locally.")
+    parser.add_argument('--plan', action="store_true", default=False, help="Don't fetch anything, just check (concurrently) which archives would be downloaded, skipped or are missing, with their sizes.")
+    parser.add_argument('--keep-going', action="store_true", default=False, help="Don't cancel the fetch when the dependency cross-check finds a version mismatch (it is still reported at the end).")
     parser.add_argument('args', nargs='*')
     options = parser.parse_args(sys.argv[2:])     # offset by 1 as routine called indirectly from 'go'
     args = options.args
 
-    if len(args) == 0 and not options.clean and not options.all and not options.source and not options.list:
+    if options.cache_stats or options.cache_prune is not None:
+        cache = archive_cache.ArchiveCache()
+        if options.cache_prune is not None:
+            removed = cache.prune(None if options.cache_prune < 0 else options.cache_prune * 1024 * 1024)
+            print("Removed %d archive(s) from cache" % removed)
+            removed = chunked_artifacts.ChunkStore().prune()
+            print("Removed %d chunk(s) unused for %d days from chunk store" % (removed, chunked_artifacts.kDefaultMaxAge))
+        stats = cache.stats()
+        print("Archive cache:  %s" % stats['root'])
+        print("    archives:   %d" % stats['entries'])
+        print("    size:       %.1f MB (limit %.1f MB)" % (stats['bytes'] / 1048576.0, stats['max-bytes'] / 1048576.0))
+        return
+
+    if options.store_verify or options.store_gc is not None:
+        store = dependency_store.DependencyStore()
+        if options.store_verify:
+            damaged = store.verify()
+            for key, archive, problem in damaged:
+                print("Removed damaged store entry %s (%s) - %s" % (key, archive, problem))
+            print("Verified dependency store %s: %d damaged entries" % (store.root, len(damaged)))
+        if options.store_gc is not None:
+            removed = store.gc(options.store_gc)
+            print("Removed %d dependency store entries unused for %d days" % (removed, options.store_gc))
+        return
+
+    if len(args) == 0 and not options.clean and not options.all and not options.source and not options.list and not options.verify and not options.lock and not options.plan:
         options.all = True
         print("No dependencies were specified. Default to:")
         print("    go fetch --all")
@@ -60,17 +109,31 @@ def main():
     linn_git_user = options.linn_git_user or getpass.getuser()
     try:
         dependencies.fetch_dependencies(
-            dependency_names=None if options.all else args,
+            dependency_names=None if options.all or ((options.verify or options.plan) and not args) else args,
             platform=platform,
             env={'linn-git-user': linn_git_user,
                  'debugmode': options.debugmode,
                  'titlecase-debugmode': options.debugmode.title()},
-            clean=options.clean and not args,
+            clean='selective' if options.clean_changed and not args else options.clean and not args,
             fetch=(options.all or bool(args)) and not options.source,
             source=options.source,
             list_details=options.list,
             verbose=options.verbose,
-            local_overrides=not options.no_overrides)
+            local_overrides=not options.no_overrides,
+            jobs=options.jobs,
+            cache=not options.no_cache,
+            store=dependency_store.DependencyStore(hardlink=True) if options.store and options.store_hardlink else options.store,
+            verify=options.verify,
+            lock=options.lock,
+            locked=options.locked,
+            verify_lock=options.verify_lock,
+            report=options.report,
+            transitive=options.transitive,
+            graph=options.graph,
+            chunked=options.chunked,
+            plan=options.plan,
+            keep_going=options.keep_going,
+            source_mode=options.source_mode)
     except Exception as e:
         if options.verbose:
             traceback.print_exc()
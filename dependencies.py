@@ -1,17 +1,29 @@
 import os
 import tarfile
-import zipfile
 import re
 import platform
 import subprocess
 import stat
 import json
 import shutil
-import io
+import hashlib
 import tempfile
+import threading
+import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from default_platform import default_platform
+from environment_expander import EnvironmentExpander, LockedExpander, lock_key, platform_env
 import deps_cross_checker
+import archive_cache
+import archives
 import aws
+import chunked_artifacts
+import dependency_matrix
+import dependency_store
+import fetch_manifest
+import trash
+import yocto_sdk
 
 # Master table of dependency types.
 
@@ -38,13 +50,17 @@ import aws
 # will be used instead.
 
 # The principle string values that must be defined are 'archive-path' to point to the
-# .tar.gz file with the dependency's binaries, 'dest' to specify where to untar it,
+# archive (.tar.gz, .tar.zst, .zip etc.) with the dependency's binaries, 'dest' to specify where to untar it,
 # and 'configure-args' to specify the list of arguments to pass to waf.
 
 # In order for source control fetching to work, the string 'source-git' should point
 # to the git repo and 'tag' should identify the git tag that corresponds to the
 # fetched binaries.
 
+# To have the archive checked as it is fetched, set 'archive-sha256' or
+# 'archive-md5' to its digest, or set 'archive-checksum-sidecar' to true to
+# read the SHA-256 from <archive-path>.sha256 (see OpenHomeBuilder.publish_checksums).
+
 DEPENDENCY_TYPES = {
     # Ignore dependencies
     #   - ignored - effectively 'comments' out entire dependency
@@ -95,7 +111,8 @@ DEPENDENCY_TYPES = {
         'any-platform': 'AnyPlatform',
         'platform-specific': True,
         'archive-suffix': '',
-        'archive-filename': '${name}-${version}-${platform}${archive-suffix}.tar.gz',
+        'archive-extension': '.tar.gz',
+        'archive-filename': '${name}-${version}-${platform}${archive-suffix}${archive-extension}',
         'archive-platform': '${platform-specific?platform:any-platform}',
         'archive-path': '${binary-repo}/${name}/${archive-filename}',
         'host-platform': default_platform(),
@@ -126,10 +143,131 @@ DEPENDENCY_TYPES = {
 }
 
 
+# Lockfile recording the fully expanded dependencies per platform and debugmode
+# (see 'go fetch --lock'), and the keys recorded for each dependency.
+kLockFilename   = os.path.join('projectdata', 'dependencies.lock.json')
+kLockFormat     = 1
+kLockedKeys     = ('name', 'version', 'archive-path', 'dest', 'configure-args', 'archive-sha256', 'archive-md5', 'cross-check')
+
+# Name of the (project) node at the root of the graph found by a transitive fetch
+kGraphRoot      = 'projectdata'
+
+# Number of archives checked at once by the preflight of a fetch (see 'go fetch --plan')
+kPlanJobs       = 16
+
+# Checksums of archives can be given by 'archive-sha256' or 'archive-md5' keys,
+# or (with 'archive-checksum-sidecar' true) in a sha256sum style file next to the
+# archive. Checked archives that are unpacked as they stream are unpacked into
+# a staging directory until the whole archive has been checked - in a hidden
+# directory beside (not in) the dest, so on the same filesystem.
+kDigestAlgorithms   = ('sha256', 'md5')
+kSidecarSuffix      = '.sha256'
+kStagingDirname     = '.ohdevtools-staging'
+
+# Ways 'go fetch --source' can check out a dependency's repository in ../<name>:
+# with full history, only the tagged commit (--shallow), or full history but
+# with file contents only fetched as checked out (--blobless)
+kCheckoutModes  = ('full', 'shallow', 'blobless')
+
+
+# Output from dependencies fetched on worker threads is buffered per-thread and
+# printed as a block when the dependency completes, so that concurrent fetches
+# don't interleave their progress messages.
+_output = threading.local()
+_output_lock = threading.Lock()
+
+
+def log(msg=''):
+    lines = getattr(_output, 'lines', None)
+    if lines is None:
+        with _output_lock:
+            print(msg)
+    else:
+        lines.append(msg)
+
+
+def _begin_buffered_log():
+    _output.lines = []
+
+
+def _end_buffered_log():
+    lines = _output.lines
+    _output.lines = None
+    with _output_lock:
+        print('\n'.join(lines))
+
+
+class FetchCancelled(Exception):
+    """Raised by a fetch abandoned part way through (see ArchiveStream.cancel)"""
+    pass
+
+
+class ArchiveStream(object):
+    """Sequential reader over an archive being fetched, optionally copying the
+    bytes read into a file (e.g. to populate the archive cache as it streams)"""
+
+    def __init__(self, source, copy_to=None, on_complete=None, origin='local', expected=None, cancel=None):
+        self.source = source
+        self.copy_to = copy_to
+        self.copy = open(copy_to, 'wb') if copy_to else None
+        self.on_complete = on_complete
+        self.origin = origin        # 'aws', 'cache' or 'local'
+        self.bytes_read = 0
+        self.read_seconds = 0.0     # time spent waiting for data (i.e. downloading)
+        self.sha256 = hashlib.sha256()
+        self.expected = expected    # (algorithm, hex digest) checked by finish()
+        self.check = None
+        if expected is not None and expected[0] != 'sha256':
+            self.check = hashlib.new(expected[0])
+        self.cancel = cancel        # threading.Event set to abandon the fetch
+
+    def read(self, size=-1):
+        if self.cancel is not None and self.cancel.is_set():
+            raise FetchCancelled("Cancelled")
+        start = time.time()
+        data = self.source.read() if size is None or size < 0 else self.source.read(size)
+        self.read_seconds += time.time() - start
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+        if self.check is not None:
+            self.check.update(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        return data
+
+    def finish(self):
+        """Consume anything not read by the extractor (e.g. tar end-of-archive padding)
+        and commit the copy - unless the archive doesn't match its expected checksum"""
+        self.cancel = None      # everything has been unpacked, so no point abandoning it now
+        while self.read(1024 * 1024):
+            pass
+        if self.expected is not None:
+            algorithm, digest = self.expected
+            actual = (self.check or self.sha256).hexdigest()
+            if actual != digest:
+                raise Exception("Checksum mismatch - %s of archive is %s, expected %s" % (algorithm, actual, digest))
+        if self.copy is not None:
+            self.copy.close()
+            self.copy = None
+            if self.on_complete is not None:
+                self.on_complete(self.copy_to)
+                self.copy_to = None
+
+    def close(self):
+        self.source.close()
+        if self.copy is not None:
+            self.copy.close()
+            self.copy = None
+        if self.copy_to is not None and os.path.exists(self.copy_to):
+            os.unlink(self.copy_to)
+
+
 class FileFetcher(object):
 
-    def __init__(self):
-        pass
+    def __init__(self, cache=None, chunks=None):
+        self.cache = cache
+        self.chunks = chunks    # chunked_artifacts.ChunkStore, to fetch chunked archives
+        self.cancel = None      # threading.Event set to abandon streamed fetches in progress
 
     def fetch(self, path):
         if path.startswith("file:") or path.startswith("smb:"):
@@ -140,213 +278,440 @@ class FileFetcher(object):
             raise Exception("FETCH: Legacy URLs no longer re-routed")
         return self.fetch_local(path)
 
-    @staticmethod
-    def fetch_aws(awspath):
-        print('  from AWS %s' % awspath)
-        temppath = tempfile.mktemp( suffix='.tmp' )
+    def fetch_aws(self, awspath):
+        if self.cache is not None:
+            cached = self.cache.lookup(awspath)
+            if cached:
+                log('  from CACHE %s' % awspath)
+                return cached
+        log('  from AWS %s' % awspath)
+        if self.cache is not None:
+            temppath = self.cache.new_temp()
+        else:
+            temppath = tempfile.mktemp( suffix='.tmp' )
         try:
             aws.copy(awspath, temppath)
-            return temppath
         except:
+            self.release(temppath, awspath)
             raise Exception("FETCH: Unable to retrieve %s from AWS" % awspath)
-            return None
+        if self.cache is not None:
+            return self.cache.insert(awspath, aws.info(awspath), temppath)
+        return temppath
+
+    def stream(self, path, expected=None):
+        """Open the archive at path for sequential reading, so that it can be
+        unpacked as it downloads. Call finish() on the returned stream once the
+        archive has been unpacked (which checks it against the expected
+        (algorithm, digest), if given), and close() in all cases."""
+        if not path.startswith("s3:"):
+            return ArchiveStream(open(self.fetch(path), 'rb'), expected=expected, cancel=self.cancel)
+        if self.cache is not None:
+            cached = self.cache.lookup(path)
+            if cached:
+                try:
+                    f = open(cached, 'rb')
+                except IOError:
+                    # evicted by another build since the lookup - download it instead
+                    log('  CACHE copy of %s has gone' % path)
+                else:
+                    log('  from CACHE %s' % path)
+                    return ArchiveStream(f, origin='cache', expected=expected, cancel=self.cancel)
+        log('  streaming from AWS %s' % path)
+        try:
+            body, info = aws.stream(path)
+        except:
+            raise Exception("FETCH: Unable to retrieve %s from AWS" % path)
+        if self.cache is None:
+            return ArchiveStream(body, origin='aws', expected=expected, cancel=self.cancel)
+        return ArchiveStream(body, self.cache.new_temp(), lambda copy: self.cache.insert(path, info, copy),
+                             origin='aws', expected=expected, cancel=self.cancel)
 
     @staticmethod
-    def fetch_local(path):
-        print( '  from LOCAL PATH %s' % path)
-        return path
-
-
-class EnvironmentExpander(object):
-    # template_regex matches
-    template_regex = re.compile(r"""(?x)    # Enable whitespace and comments
-        (?P<dollar>\$\$)|                   # Match $$
-        (?P<word>\$[a-zA-Z_][a-zA-Z_0-9]*)| # Match $word
-        (?P<parens>\$\{[^}]*\})             # Match ${any-thing}
-        """)
-    # Matches foo[bar]
-    index_regex = re.compile(r"""(?x)       # Enable whitespace and comments
-        ^                                   # Match only at start of string
-        ([^][]*)                            # Match table name (no brackets allowed)
-        \[                                  # Match one open bracket: [
-        ([^][]*)                            # Match key (no brackets allowed)
-        \]                                  # Match one close bracket: ]
-        $
-        """)
-
-    def __init__(self, env_dict):
-        self.env_dict = env_dict
-        self.cache = {}
-        self.expandset = set()
-
-    def __getitem__(self, key):
-        return self.expand(key)
-
-    def getraw(self, key):
-        return self.env_dict[key]
-
-    def __contains__(self, key):
-        return key in self.env_dict
-
-    def keys(self):
-        return self.env_dict.keys()
-
-    def values(self):
-        return [self.expand(key) for key in self.keys()]
+    def sidecar_digest(path):
+        """SHA-256 digest of the archive at path, from <path>.sha256 (as written by sha256sum)"""
+        sidecar = path + kSidecarSuffix
+        try:
+            if sidecar.startswith("s3:"):
+                body, _info = aws.stream(sidecar)
+                try:
+                    text = body.read().decode('ascii')
+                finally:
+                    body.close()
+            else:
+                with open(sidecar, 'rt') as f:
+                    text = f.read()
+            return text.split()[0].lower()
+        except Exception:
+            raise Exception("FETCH: Unable to retrieve checksum %s" % sidecar)
+
+    def release(self, fetched_path, remote_path):
+        """Discard a fetched archive once it has been unpacked - local and cached archives are kept"""
+        if fetched_path == remote_path:
+            return
+        if self.cache is not None and os.path.dirname(fetched_path) == self.cache.root and not fetched_path.endswith(archive_cache.kPartialSuffix):
+            return
+        try:
+            os.unlink(fetched_path)
+        except OSError:
+            pass
 
-    def items(self):
-        return [(key, self.expand(key)) for key in self.keys()]
-
-    def expand(self, key):
-        if key in self.cache:
-            return self.cache[key]
-        if key in self.expandset:
-            raise ValueError("Recursive expansion for key:", key)
-        self.expandset.add(key)
-        result = self._expand(key)
-        self.cache[key] = result
-        self.expandset.remove(key)
-        return result
-
-    def _expand(self, key):
-        if key not in self.env_dict:
-            raise KeyError("Key undefined:", key)
-        value = self.env_dict[key]
-        return self._expandvalue(value)
-
-    def _expandvalue(self, value):
-        if isinstance(value, ("".__class__, u"".__class__)):
-            return self.expandstring(value)
-            # return self.template_regex.sub(self.replacematch, value)
-        elif isinstance(value, (list, tuple)):
-            return [self._expandvalue(x) for x in value]
-        elif isinstance(value, dict):
-            return dict((k, self._expandvalue(v)) for (k, v) in value.items())
-        return value
-
-    def expandstring(self, value):
-        firstmatch = self.template_regex.match(value)
-        if firstmatch is not None and firstmatch.group(0) == value and value != "$$":
-            # Special case: The entire string is a single expansion. In this case,
-            # we allow the expansion to be *anything* (bool, int, list...),
-            # not just a string.
-            return self.replacematch(firstmatch)
-        return self.template_regex.sub(self.replacematch, value)
-
-    def replacematch(self, match):
-        if match.group('dollar'):
-            return '$'
-        key = None
-        if match.group('word'):
-            key = match.group('word')[1:]
-        if match.group('parens'):
-            key = match.group('parens')[2:-1]
-        assert key is not None
-        key = key.strip()
-        if '[' in key:
-            return self.expandlookup(key)
-        if '?' in key:
-            return self.expandconditional(key)
-        return self.expand(key)
-
-    def expandlookup(self, key):
-        match = self.index_regex.match(key)
-        if match is None:
-            raise ValueError('lookup must be of form ${table[key]}')
-        tablename = match.group(1).strip()
-        keyname = match.group(2).strip()
-        table = self.expand(tablename)
-        if keyname.startswith('$'):
-            key = self.expand(keyname[1:])
-        else:
-            key = keyname
-        if not isinstance(table, dict):
-            raise ValueError("lookup table must expand to a JSON object (got {0!r} instead)".format(table))
-        if not isinstance(key, ("".__class__, u"".__class__)):
-            raise ValueError("lookup index must expand to a JSON string (got {0!r} instead)".format(key))
-        if key not in table:
-            if '*' in table:
-                return table['*']
-            raise KeyError("Key not in table, and no default '*' entry found: key={0!r}\ntable={1!r}".format(key, table))
-        return table[key]
-
-    def expandconditional(self, key):
-        if '?' not in key:
-            raise ValueError('conditional must be of form ${condition?result:alternative}')
-        condition, rest = key.split('?', 1)
-        if ':' not in rest:
-            raise ValueError('conditional must be of form ${condition?result:alternative}')
-        primary, alternative = rest.split(':', 1)
-        condition, primary, alternative = [x.strip() for x in [condition, primary, alternative]]
+    @staticmethod
+    def size(path):
+        """Size of the archive at path in bytes (0 if it cannot be determined)"""
         try:
-            conditionvalue = self.expand(condition)
-        except KeyError:
-            conditionvalue = False
-        if self.is_trueish(conditionvalue):
-            return self.expand(primary)
-        return self.expand(alternative)
+            if path.startswith("s3:"):
+                info = aws.info(path)
+                return info['size'] if info else 0
+            return os.path.getsize(path)
+        except Exception:
+            return 0
 
     @staticmethod
-    def is_trueish(value):
-        if hasattr(value, "upper"):
-            value = value.upper()
-        return value in [1, "1", "YES", "Y", "TRUE", "ON", True]
+    def fetch_local(path):
+        log('  from LOCAL PATH %s' % path)
+        return path
 
 
 class Dependency(object):
+    __slots__ = ('expander', 'has_overrides', 'fetcher', 'unpacked', 'report', 'expected')
 
-    def __init__(self, name, environment, fetcher, has_overrides=False):
-        self.expander = EnvironmentExpander(environment)
+    def __init__(self, name, environment, fetcher, has_overrides=False, expander_class=None):
+        self.expander = (expander_class or EnvironmentExpander)(environment)
         self.has_overrides = has_overrides
         self.fetcher = fetcher
+        self.unpacked = None    # archive hash and file table from the last successful fetch
+        self.report = None      # timings etc. of the last fetch (see new_report)
+        self.expected = None    # (algorithm, digest) the archive being fetched must have
 
-    def fetch(self):
+    def fetch(self, store=None):
         remote_path = self.expander.expand('archive-path')
         local_path = os.path.abspath(self.expander.expand('dest'))
-        fetched_path = None
 
-        print("\nFetching '%s'" % self.name)
+        log("\nFetching '%s'" % self.name)
+        start = time.time()
+        self.report = self.new_report(remote_path, 'failed')
+        try:
+            self.expected = self.expected_digest(remote_path)
+            if store is not None and store.supports(remote_path):
+                ok = self.fetch_via_store(store, remote_path, local_path)
+            else:
+                ok = self.unpack(remote_path, local_path)
+        finally:
+            self.report['seconds'] = round(time.time() - start, 3)
+        if ok:
+            self.report['status'] = 'fetched'
+            log("OK")
+        return ok
+
+    def expected_digest(self, remote_path):
+        """(algorithm, hex digest) that the archive at remote_path must have -
+        from the dependency's 'archive-sha256' or 'archive-md5' key, or if
+        'archive-checksum-sidecar' is true, from <archive>.sha256 published next
+        to it. None if no checksum is given."""
+        for algorithm in kDigestAlgorithms:
+            key = 'archive-' + algorithm
+            if key in self.expander and self.expander.expand(key):
+                return algorithm, self.expander.expand(key).strip().lower()
+        if 'archive-checksum-sidecar' in self.expander and self.expander.is_trueish(self.expander.expand('archive-checksum-sidecar')):
+            return 'sha256', self.fetcher.sidecar_digest(remote_path)
+        return None
+
+    def check_digest(self, digests):
+        """Raise if digests ({algorithm: hex digest}) don't match the expected checksum"""
+        if self.expected is None or self.expected[0] not in digests:
+            return
+        algorithm, digest = self.expected
+        if digests[algorithm] != digest:
+            raise Exception("Checksum mismatch - %s of archive is %s, expected %s" % (algorithm, digests[algorithm], digest))
+
+    def new_report(self, remote_path, status):
+        """Record of a fetch of this dependency, for 'go fetch --report'. bytes is
+        the size of the archive, and downloaded-bytes the part of that fetched
+        over the network (zero if it came from a cache or local path)."""
+        return {
+            'name': self.name,
+            'platform': self.expander.expand('platform') if 'platform' in self.expander else None,
+            'archive': remote_path,
+            'status': status,           # 'fetched', 'skipped' or 'failed'
+            'source': None,             # 'aws', 'cache', 'local', 'store' or 'chunks'
+            'bytes': 0,
+            'downloaded-bytes': 0,
+            'download-seconds': 0.0,
+            'extract-seconds': 0.0,
+            'files': 0,
+            'unpacked-bytes': 0,
+            'seconds': 0.0}
+
+    def fetch_via_store(self, store, remote_path, local_path):
+        """Unpack the archive once into the shared store, then link its files into dest"""
+        info = self.archive_info(remote_path)
+        if info is None:
+            log("  **** FAILED - unable to find %s ****" % remote_path)
+            return False
+        key = store.key(remote_path, info)
+        if store.contains(key):
+            # a hardlinked workspace file written to (e.g. by root) changes the entry too
+            problem = store.check(key)
+            if problem:
+                log("  STORE entry %s is damaged (%s) - unpacking afresh" % (store.entry_dir(key), problem))
+                store.remove(key)
+        if store.contains(key):
+            self.check_digest({'sha256': store.archive_hash(key)})
+            log("  from STORE %s" % store.entry_dir(key))
+            self.report['source'] = 'store'
+            self.report['bytes'] = info.get('size', 0)
+        else:
+            def unpack_into_store(tree):
+                if not self.unpack(remote_path, tree):
+                    return None
+                return {'archive-sha256': self.unpacked['archive-sha256']}
+            if not store.populate(key, remote_path, unpack_into_store):
+                return False
+        self.make_dest(local_path)
+        start = time.time()
+        files, reflinked, hardlinked, copied = store.materialise(key, local_path)
+        log("  linked %d files into '%s' in %.1fs (%d reflinked, %d hardlinked, %d copied)" % (
+            len(files), local_path, time.time() - start, reflinked, hardlinked, copied))
+        self.report['extract-seconds'] = round(self.report['extract-seconds'] + time.time() - start, 3)
+        self.report['files'] = len(files)
+        self.report['unpacked-bytes'] = sum(size for size, _mtime, _digest in files.values() if size)
+        self.unpacked = {'archive-sha256': store.archive_hash(key), 'files': files}
+        return True
+
+    def archive_info(self, remote_path):
+        """Size and ETag (or for a local archive, modification time) identifying the archive contents"""
+        if remote_path.startswith("s3:"):
+            if 'archive-etag' in self.expander:
+                return {'size': self.expander.expand('archive-size'), 'etag': self.expander.expand('archive-etag')}
+            cache = self.fetcher.cache
+            entry = cache.entry(remote_path) if cache is not None else None
+            if entry is not None:
+                return {'size': entry['size'], 'etag': entry['etag']}
+            return aws.info(remote_path)
+        try:
+            st = os.stat(remote_path)
+        except OSError:
+            return None
+        return {'size': st.st_size, 'etag': '%d' % st.st_mtime}
+
+    def unpack(self, remote_path, local_path):
+        """Fetch the archive at remote_path and unpack it into local_path - from
+        the chunks not already held locally, if it was published chunked and
+        chunked fetching is enabled"""
+        chunks = self.fetcher.chunks
+        cache = self.fetcher.cache
+        manifest = None
+        if chunks is not None and self.is_streamable(remote_path) and (cache is None or cache.entry(remote_path) is None):
+            # (an archive already in the archive cache is unpacked from there)
+            manifest = chunked_artifacts.load_manifest(remote_path)
+        if manifest is not None and self.expected is not None:
+            if self.expected[0] == 'sha256':
+                self.check_digest({'sha256': manifest['archive-sha256']})
+            else:
+                manifest = None     # chunks can't be checked against other digests - fetch the archive
+        if manifest is not None:
+            missing = chunks.missing(manifest)
+            if chunks.worthwhile(missing, manifest):
+                return self.fetch_chunked(manifest, missing, local_path)
+        if not self.unpack_archive(remote_path, local_path):
+            return False
+        if manifest is not None:
+            chunks.seed(manifest, local_path)
+        return True
+
+    def fetch_chunked(self, manifest, missing, local_path):
+        """Download the missing chunks of a chunked archive and rebuild its tree"""
+        chunks = self.fetcher.chunks
+        report = self.report if self.report is not None else self.new_report(manifest['archive'], 'failed')
+        report['source'] = 'chunks'
+        log("  from CHUNKS of %s in %s (%d to download, %.1f MB)" % (
+            manifest['archive'], manifest['chunk-root'], len(missing), sum(missing.values()) / 1048576.0))
+        start = time.time()
+        try:
+            report['downloaded-bytes'] = chunks.download(manifest, missing)
+        except Exception as e:
+            log("  **** FAILED - %s ****" % e)
+            return False
+        report['bytes'] = manifest['archive-size']
+        report['download-seconds'] = round(time.time() - start, 3)
+        self.make_dest(local_path)
+        log("  rebuilding in '%s'" % (local_path,))
+        try:
+            stats = chunks.rebuild(manifest, local_path)
+        except IOError as e:
+            log("  **** FAILED - %s ****" % e)
+            return False
+        log("  " + stats.summary())
+        self.unpacked = {'archive-sha256': manifest['archive-sha256'], 'files': stats.table}
+        report['extract-seconds'] = round(stats.seconds, 3)
+        report['files'] = stats.files
+        report['unpacked-bytes'] = stats.bytes
+        return True
+
+    def unpack_archive(self, remote_path, local_path):
+        """Fetch the archive at remote_path and unpack it into local_path"""
+        if self.is_streamable(remote_path):
+            return self.fetch_streamed(remote_path, local_path)
+
+        fetched_path = None
+        report = self.report if self.report is not None else self.new_report(remote_path, 'failed')
+        if not remote_path.startswith("s3:"):
+            report['source'] = 'local'
+        elif self.fetcher.cache is not None and self.fetcher.cache.contains(remote_path):
+            report['source'] = 'cache'
+        else:
+            report['source'] = 'aws'
+        start = time.time()
         try:
             fetched_path = self.fetcher.fetch(remote_path)
             statinfo = os.stat(fetched_path)
+            report['download-seconds'] = round(time.time() - start, 3)
+            report['bytes'] = statinfo.st_size
+            if report['source'] == 'aws':
+                report['downloaded-bytes'] = statinfo.st_size
             if not statinfo.st_size:
-                os.unlink(fetched_path)
-                print("  **** WARNING - failed to fetch %s ****" % os.path.basename(remote_path))
+                self.fetcher.release(fetched_path, remote_path)
+                log("  **** WARNING - failed to fetch %s ****" % os.path.basename(remote_path))
                 return False
         except IOError:
-            print("  **** FAILED ****")
+            if report['source'] == 'cache':
+                return self.refetch_evicted(remote_path, local_path)
+            log("  **** FAILED ****")
             return False
 
+        self.make_dest(local_path)
+
+        # checked before unpacking - on the hash needed for the manifest anyway
         try:
-            os.makedirs(local_path)
-        except OSError:
-            # We get an error if the directory exists, which we are happy to
-            # ignore. If something worse went wrong, we will find out very
-            # soon when we try to extract the files.
-            pass
+            digests = archives.hash_file_digests(fetched_path, set(['sha256', self.expected[0] if self.expected else 'sha256']))
+        except IOError:
+            if report['source'] == 'cache':
+                return self.refetch_evicted(remote_path, local_path)
+            raise
+        archive_sha256 = digests['sha256']
+        try:
+            self.check_digest(digests)
+        except Exception:
+            if self.fetcher.cache is not None and remote_path.startswith("s3:"):
+                self.fetcher.cache.remove(remote_path)
+            self.fetcher.release(fetched_path, remote_path)
+            raise
+        if self.expected is not None:
+            log("  checked %s checksum" % self.expected[0])
 
-        print("  unpacking to '%s'" % (local_path,))
+        log("  unpacking to '%s'" % (local_path,))
+        start = time.time()
         if os.path.splitext(remote_path)[1].upper() in ['.ZIP', '.NUPKG', '.JAR']:
-            self.unzip(fetched_path, local_path)
-        elif os.path.splitext(remote_path)[1].upper() in ['.SH']:
-            # TODO: Handle yocto sdk script installer somehow
-            # either run script and install to appropriate path (e.g. subprocess.check_call(f"{fetched_path} -y -d {local_path}", shell=True)) [LEAST FRAGILE APPROACH]
-            # or seek to archive embedded within script file and extract that directly (e.g. raw archive binary is located after the string "\nMARKER:\n" in the script file).
-            # shell command `payload_offset=$(($(grep -na -m1 "^MARKER:$" "$0"|cut -d':' -f1) + 1))` gives the line number pointint to the start of the binary data
-            # such that `tail -n +$payload_offset "$0" > sdk.zip` outputs a valid archive file containing the data (where $0 is the script file path)
-            st = os.stat(fetched_path)
-            os.chmod(fetched_path, st.st_mode | stat.S_IXUSR)
-            ## subprocess.check_call(f"{fetched_path} -y -d {local_path}", shell=True)     aaargh - Jenkins slave still using Py2.7         
-            subprocess.check_call("%s -y -d %s" % (fetched_path, os.path.join(local_path, self.name)), shell=True)
+            files = self.unzip(fetched_path, local_path).table
         else:
-            self.untar(fetched_path, local_path)
+            # yocto sdk installer (tar archives are all streamed) - unpack the archive
+            # embedded in the script directly, only running it if its payload isn't recognised
+            stats = yocto_sdk.extract(fetched_path, os.path.join(local_path, self.name), local_path)
+            if stats is not None:
+                log('  ' + stats.summary() + ' (from installer payload)')
+                files = stats.table
+            else:
+                log('  running installer')
+                st = os.stat(fetched_path)
+                os.chmod(fetched_path, st.st_mode | stat.S_IXUSR)
+                subprocess.check_call("%s -y -d %s" % (fetched_path, os.path.join(local_path, self.name)), shell=True)
+                files = archives.scan_tree(os.path.join(local_path, self.name), local_path)
 
         if fetched_path:
-            if fetched_path != remote_path:
-                os.unlink(fetched_path)
-        print("OK")
+            self.fetcher.release(fetched_path, remote_path)
+        self.unpacked = {'archive-sha256': archive_sha256, 'files': files}
+        report['extract-seconds'] = round(time.time() - start, 3)
+        report['files'] = len(files)
+        report['unpacked-bytes'] = sum(size for size, _mtime, _digest in files.values() if size)
         return True
 
+    def refetch_evicted(self, remote_path, local_path):
+        """Download an archive whose cached copy was evicted (by another build
+        sharing the cache) between being looked up and opened"""
+        log("  CACHE copy of %s has gone" % remote_path)
+        self.fetcher.cache.remove(remote_path)
+        return self.unpack_archive(remote_path, local_path)
+
+    def fetch_streamed(self, remote_path, local_path):
+        """Unpack a tar archive as it downloads, without staging it in a temporary
+        file. If it has a checksum, it is unpacked into a staging directory and
+        only moved into place once the whole archive has been checked."""
+        report = self.report if self.report is not None else self.new_report(remote_path, 'failed')
+        start = time.time()
+        try:
+            stream = self.fetcher.stream(remote_path, self.expected)
+        except IOError:
+            log("  **** FAILED ****")
+            return False
+        report['source'] = stream.origin
+        target = local_path
+        if self.expected is not None:
+            dest = os.path.normpath(local_path)
+            target = os.path.join(os.path.dirname(dest), kStagingDirname, '%s-%s' % (os.path.basename(dest), self.name))
+        try:
+            self.make_dest(local_path)
+            if target != local_path and os.path.exists(target):
+                trash.move_to_trash(target)     # left by an interrupted fetch
+            log("  unpacking to '%s'" % (local_path,))
+            try:
+                source = archives.TarStream(stream, remote_path)
+            except tarfile.ReadError:
+                if stream.bytes_read:
+                    raise
+                log("  **** WARNING - failed to fetch %s ****" % os.path.basename(remote_path))
+                return False
+            try:
+                stats = self.untar_members(source.tarfile, target)
+            finally:
+                source.close()
+            stream.finish()
+            if target != local_path:
+                archives.merge_tree(target, local_path)
+                log("  checked %s checksum" % self.expected[0])
+            self.unpacked = {'archive-sha256': stream.sha256.hexdigest(), 'files': stats.table}
+            # download and decompression overlap - time spent waiting on the
+            # source counts as download, the rest as extraction
+            report['bytes'] = stream.bytes_read
+            if stream.origin == 'aws':
+                report['downloaded-bytes'] = stream.bytes_read
+            report['download-seconds'] = round(stream.read_seconds, 3)
+            report['extract-seconds'] = round(time.time() - start - stream.read_seconds, 3)
+            report['files'] = stats.files
+            report['unpacked-bytes'] = stats.bytes
+        except IOError:
+            log("  **** FAILED ****")
+            return False
+        except Exception as e:
+            if stream.origin == 'cache' and not isinstance(e, FetchCancelled):
+                self.fetcher.cache.remove(remote_path)
+            raise
+        finally:
+            stream.close()
+            if target != local_path:
+                if os.path.exists(target):
+                    trash.move_to_trash(target)
+                try:
+                    os.rmdir(os.path.dirname(target))
+                except OSError:
+                    pass        # still in use by another fetch (or its trash)
+        return True
+
+    @staticmethod
+    def is_streamable(remote_path):
+        # zip based formats need random access, and yocto installers are run
+        # from disk, so only tar archives can be unpacked as they stream in
+        return os.path.splitext(remote_path)[1].upper() not in ['.ZIP', '.NUPKG', '.JAR', '.SH']
+
+    @staticmethod
+    def make_dest(local_path):
+        try:
+            os.makedirs(local_path)
+        except OSError:
+            # We get an error if the directory exists, which we are happy to
+            # ignore. If something worse went wrong, we will find out very
+            # soon when we try to extract the files.
+            pass
+
     @property
     def name(self):
         return self['name']
@@ -360,47 +725,68 @@ class Dependency(object):
     def items(self):
         return self.expander.items()
 
-    def checkout(self):
+    def checkout(self, mode='full'):
+        """Clone (or update) the dependency's repository into ../<name> and check
+        out its tag - mode is one of kCheckoutModes. Raises an exception on failure."""
         name = self['name']
         sourcegit = self['source-git']
         if sourcegit is None:
-            print('No git repo defined for {0}'.format(name))
-            return False
-        print("Fetching source for '%s'\n  into '%s'" % (name, os.path.abspath('../' + name)))
+            raise Exception('No git repo defined for {0}'.format(name))
+        log("Fetching source for '%s'\n  into '%s'" % (name, os.path.abspath('../' + name)))
         tag = self['tag']
-        try:
-            if not os.path.exists('../' + name):
-                print('  git clone {0} {1}'.format(sourcegit, name))
-                subprocess.check_call(['git', 'clone', sourcegit, name], cwd='..', shell=False)
-            elif not os.path.isdir('../' + name):
-                print('Cannot checkout {0}, because directory ../{0} already exists'.format(name))
-                return False
+        start = time.time()
+        if not os.path.exists('../' + name):
+            if mode == 'shallow':
+                self.git(['clone', '--depth', '1', '--branch', tag, sourcegit, name], '..')
+            elif mode == 'blobless':
+                self.git(['clone', '--filter=blob:none', '--no-checkout', sourcegit, name], '..')
             else:
-                print('  git fetch origin')
-                subprocess.check_call(['git', 'fetch', 'origin'], cwd='../' + name, shell=False)
-            print("  git checkout {0}".format(tag))
-            subprocess.check_call(['git', 'checkout', tag], cwd='../' + name, shell=False)
+                self.git(['clone', sourcegit, name], '..')
+        elif not os.path.isdir('../' + name):
+            raise Exception('Cannot checkout {0}, because directory ../{0} already exists'.format(name))
+        elif mode == 'shallow':
+            self.git(['fetch', '--depth', '1', 'origin', 'refs/tags/{0}:refs/tags/{0}'.format(tag)], '../' + name)
+        else:
+            self.git(['fetch', 'origin'], '../' + name)
+        self.git(['checkout', tag], '../' + name)
+        log("  checked out %s in %.1fs" % (tag, time.time() - start))
+
+    @staticmethod
+    def git(args, cwd):
+        """Run git, logging the command - and its output, if it fails"""
+        log('  git ' + ' '.join(args))
+        try:
+            subprocess.check_output(['git'] + args, cwd=cwd, stderr=subprocess.STDOUT, shell=False)
         except subprocess.CalledProcessError as cpe:
-            print(str(cpe))
-            return False
-        return True
+            lines = cpe.output.decode('utf-8', 'replace').strip().splitlines()
+            for line in lines:
+                log('    ' + line)
+            errors = [line for line in lines if line.startswith(('fatal:', 'error:'))] or lines[-1:]
+            raise Exception("'git %s' failed (exit code %d)%s" % (args[0], cpe.returncode, ': ' + errors[0] if errors else ''))
 
     @staticmethod
     def untar(source, dest):
-        tf = tarfile.open(source, 'r')
-        for f in tf:
-            try:
-                tf.extract(f.name, path=dest)
-            except IOError:
-                os.unlink( os.path.join(dest, f.name ))
-                tf.extract(f.name, path=dest)
-        tf.close()
+        """Unpack tar archive source (in the format given by its extension) into dest"""
+        if not archives.is_zstd(source):
+            tf = tarfile.open(source, 'r')
+            stats = Dependency.untar_members(tf, dest)
+            tf.close()
+            return stats
+        with open(source, 'rb') as f:
+            with archives.TarStream(f, source) as archive:
+                return Dependency.untar_members(archive.tarfile, dest)
+
+    @staticmethod
+    def untar_members(tf, dest):
+        stats = archives.ParallelExtractor(dest).extract_tar(tf)
+        log('  ' + stats.summary())
+        return stats
 
     @staticmethod
     def unzip(source, dest):
-        zf = zipfile.ZipFile(source, mode='r')
-        zf.extractall(path=dest)
-        zf.close()
+        stats = archives.ParallelExtractor(dest).extract_zip(source)
+        log('  ' + stats.summary())
+        return stats
 
     def expand_remote_path(self):
         return self.expander.expand('archive-path')
@@ -420,20 +806,25 @@ class DependencyCollection(object):
         self.dependency_types = DEPENDENCY_TYPES
         self.dependencies = {}
         self.fetcher = fetcher
+        self.store = None
+        self.reports = []       # Dependency.report of each dependency considered by fetch()
+        self.overrides = {}     # local overrides by name (also applied to transitive dependencies)
+        self.graph = None       # dependency name -> names of the dependencies it lists
+        self.listings = {}      # AWS directory listings made to resolve 'latest' (may be shared between platforms)
 
     def create_dependency(self, dependency_definition, overrides={}):
         defn = dependency_definition
-        env = {}
-        env.update(self.base_env)
         if 'type' in defn:
             dep_type = defn['type']
-            env.update(self.dependency_types[dep_type])
         else:
             # default to an 'external' dependency type if none specified
             dep_type = 'external'
-            env.update(self.dependency_types[dep_type])
-        env.update(defn)
-        env.update(overrides)
+        # Look keys up through layers rather than copying them into one dict
+        # per dependency: the base environment and type templates are shared by
+        # all dependencies, and changes (e.g. substituting 'latest' in the
+        # archive-path) go into the first, per-dependency, layer.
+        layers = (overrides, defn, self.dependency_types[dep_type], self.base_env)
+        env = ChainMap({}, *[layer for layer in layers if layer])
         if 'name' not in env:
             raise ValueError('Dependency definition contains no name')
         name = env['name']
@@ -464,47 +855,220 @@ class DependencyCollection(object):
         configure_args = sum((d.expand_configure_args() for d in dependencies), [])
         return configure_args
 
-    def fetch(self, subset=None):
-        dependencies = self._filter(subset)
+    def fetch(self, subset=None, jobs=1):
+        return fetch_collections([self], subset, jobs)
+
+    def plan(self, subset=None, jobs=1, clean=False):
+        """Preflight of a fetch of subset, without downloading anything. Returns,
+        in fetch order, for each dependency its name, platform, archive, dest,
+        manifest key, size in bytes and action: 'skip' (unchanged since
+        fetched, per loadedDeps.json - unless clean), 'download', 'cache',
+        'store' or 'local' (where it will come from), or 'missing'. The
+        archives of all but those skipped are checked concurrently, with a HEAD
+        request each for those on AWS."""
+        return [entry for _collection, entry in plan_fetch([self], subset, jobs, clean)]
+
+    def plan_action(self, path):
+        """(action, size) of fetching the archive at path - see plan()"""
+        cache = self.fetcher.cache
+        if not path.startswith("s3:"):
+            if not os.path.isfile(path):
+                return 'missing', 0
+            info = {'size': os.path.getsize(path), 'etag': '%d' % os.path.getmtime(path)}
+            action = 'local'
+        elif cache is not None and cache.contains(path):
+            info = cache.entry(path)
+            action = 'cache'
+        else:
+            info = aws.info(path)
+            if info is None:
+                return 'missing', 0
+            action = 'download'
+        if self.store is not None and self.store.supports(path) and self.store.contains(self.store.key(path, info)):
+            action = 'store'
+        return action, info['size']
+
+    def check_plan(self, plan):
+        """Report any archives in plan that are missing (so that a fetch fails
+        before downloading anything). Returns True if none are."""
+        return report_missing([(self, entry) for entry in plan])
+
+    def skip(self, d, path):
+        log("Skipping fetch of %s as unchanged (%s)" % (d.name, os.path.basename(path)))
+        d.report = d.new_report(path, 'skipped')
+        self.reports.append(d.report)
+
+    def fetch_one(self, manifest, d, lookup, dest, path):
+        """Fetch dependency d, recording it in the manifest. Returns True on success."""
+        # recorded as incomplete until unpacked, so an interrupted fetch is redone next time
+        manifest.begin(lookup, path)
+        try:
+            ok = d.fetch(store=self.store)
+        except Exception as e:
+            log("  **** FAILED - %s ****" % e)
+            d.report['error'] = str(e)
+            ok = False
+        self.reports.append(d.report)
+        if ok:
+            archive_id = None if path.startswith('s3:') else fetch_manifest.local_archive_id(path)
+            manifest.complete(lookup, path, dest, d.unpacked['archive-sha256'], d.unpacked['files'], archive_id)
+        return ok
+
+    def fetch_transitive(self, subset=None, jobs=1, cross_check=None):
+        """Fetch dependencies as fetch() does, then (recursively) the dependencies
+        listed in the dependencies.json bundled with each, expanded with the
+        same types and overrides. A dependency listed by several others is
+        fetched once - the first definition seen (e.g. the project's own) is
+        used. Dependencies whose parents have been fetched are fetched
+        concurrently (up to jobs at once). Each is checked with cross_check
+        (a CrossCheck), if given, once fetched - after a mismatch no more are
+        started. The resulting graph is left in self.graph (see write_graph)."""
+        roots = list(self._filter(subset))
+        if not self.check_plan(self.plan(subset, jobs)):
+            return False
+        manifest = fetch_manifest.FetchManifest(self.fetched_deps_filename(roots))
+        self.graph = {kGraphRoot: [d.name for d in roots]}
         failed_dependencies = []
-        filename = self.fetched_deps_filename(dependencies)
-        fetched_deps = self.load_fetched_deps(filename)
-        for d in dependencies:
-            do_fetch = True
-            name = ''
-            path = ''
-            dest = ''
-            if 'name' in d.expander:
-                name = d.expander.expand('name')
-            if 'archive-path' in d.expander:
-                path = d.expander.expand('archive-path')
-                if 'latest' in path.lower():
-                    # substitute highest numbered number
-                    del(d.expander.cache['archive-path'])
-                    d.expander.env_dict['archive-path'] = self.substitute_latest(path)
-                    path = d.expander.expand('archive-path')
-            if 'dest' in d.expander:
-                dest = d.expander.expand('dest')
-            lookup = dest.rstrip( '/' ) + '/' + name
-            version = os.path.basename(path)
-            if lookup in fetched_deps:
-                if fetched_deps[lookup] == version:
-                    print("Skipping fetch of %s as unchanged (%s)" % (name, version))
-                    do_fetch = False
-            if do_fetch:
-                if not d.fetch():
-                    failed_dependencies.append(d.name)
+        seen = set(d.name for d in roots)
+        cancel = cross_check.cancel if cross_check is not None else threading.Event()
+        self.fetcher.cancel = cancel
+
+        def visit(d, parent=None):
+            if jobs > 1:
+                _begin_buffered_log()
+            try:
+                try:
+                    _name, lookup, dest, path = self.resolve(d)
+                except KeyError as e:
+                    log("  **** ERROR - unable to resolve %s%s: %s is undefined ****" % (d.name, ' (listed by %s)' % parent if parent else '', e.args[-1]))
+                    return d, False, []
+                if cancel.is_set():
+                    log("Cancelled fetch of %s" % d.name)
+                    ok = False
+                elif manifest.is_current(lookup, path):
+                    self.skip(d, path)
+                    ok = True
                 else:
-                    fetched_deps[lookup] = version
-            if filename:
-                self.save_fetched_deps(filename, fetched_deps)
+                    try:
+                        ok = self.fetch_one(manifest, d, lookup, dest, path)
+                    except Exception as e:
+                        log("  **** ERROR - unable to fetch %s%s: %s ****" % (d.name, ' (listed by %s)' % parent if parent else '', e))
+                        ok = False
+                return d, ok, self.bundled_dependencies(d) if ok else []
+            finally:
+                if jobs > 1:
+                    _end_buffered_log()
+
+        try:
+            with ThreadPoolExecutor(max(1, jobs)) as pool:
+                futures = set(pool.submit(visit, d) for d in roots)
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        d, ok, children = future.result()
+                        if not ok:
+                            failed_dependencies.append(d.name)
+                        elif cross_check is not None:
+                            cross_check.fetched(d)
+                        self.graph[d.name] = []
+                        for defn in children:
+                            child = self.add_transitive(defn, d.name)
+                            if child is None:
+                                continue
+                            self.graph[d.name].append(child.name)
+                            if child.name not in seen:
+                                seen.add(child.name)
+                                futures.add(pool.submit(visit, child, d.name))
+        finally:
+            # keep the record of whatever was fetched, even if something went wrong
+            manifest.save()
+        print("Resolved %d dependencies (%d listed by other dependencies)" % (len(seen), len(seen) - len(roots)))
         if failed_dependencies:
             print("Failed to fetch some dependencies: " + ' '.join(failed_dependencies))
             return False
         return True
-    
+
     @staticmethod
-    def substitute_latest(path):
+    def bundled_dependencies(d):
+        """Definitions from the dependencies.json bundled with fetched dependency d"""
+        filename = os.path.join(d.expand_local_path(), d.name, 'dependencies.json')
+        if not os.path.isfile(filename):
+            return []
+        try:
+            with open(filename, 'rt') as f:
+                return json.load(f)
+        except ValueError as e:
+            log("  **** WARNING - unable to read %s: %s ****" % (filename, e))
+            return []
+
+    def add_transitive(self, defn, parent):
+        """Add a dependency listed in parent's bundled dependencies.json, unless one
+        of that name is already known. Returns the dependency (None if ignored)."""
+        name = defn.get('name')
+        if name is None:
+            return None
+        if name not in self.dependencies:
+            self.create_dependency(defn, self.overrides.get(name, {}))
+            if name not in self.dependencies:
+                return None
+        existing = self.dependencies[name]
+        if 'version' in defn and 'version' in existing.expander and defn['version'] != existing.expander.getraw('version'):
+            log("Note: %s wants %s %s, using %s" % (parent, name, defn['version'], existing.expander.getraw('version')))
+        return existing
+
+    def write_graph(self, filename):
+        """Write the graph found by fetch_transitive to filename - in Graphviz dot
+        format if it ends in '.dot', otherwise as JSON"""
+        nodes = {}
+        for name in self.graph:
+            if name in self.dependencies:
+                d = self.dependencies[name]
+                nodes[name] = {
+                    'version': d['version'] if 'version' in d else None,
+                    'archive-path': d.expand_remote_path(),
+                    'status': d.report['status'] if d.report else None}
+        edges = [[parent, child] for parent, children in sorted(self.graph.items()) for child in children]
+        with open(filename, 'wt') as f:
+            if filename.endswith('.dot'):
+                f.write('digraph dependencies {\n')
+                for name, node in sorted(nodes.items()):
+                    f.write('    "%s" [label="%s\\n%s"];\n' % (name, name, node['version'] or os.path.basename(node['archive-path'])))
+                for parent, child in edges:
+                    f.write('    "%s" -> "%s";\n' % (parent, child))
+                f.write('}\n')
+            else:
+                json.dump({'root': kGraphRoot, 'nodes': nodes, 'edges': edges}, f, indent=4)
+        print("Dependency graph written to %s" % filename)
+
+    def resolve(self, d):
+        """Returns (name, manifest key, dest, archive path) for dependency d,
+        substituting the highest version for 'latest' in its archive path"""
+        name = ''
+        path = ''
+        dest = ''
+        if 'name' in d.expander:
+            name = d.expander.expand('name')
+        if 'archive-path' in d.expander:
+            path = d.expander.expand('archive-path')
+            if 'latest' in path.lower():
+                # substitute highest numbered number
+                del(d.expander.cache['archive-path'])
+                d.expander.env_dict['archive-path'] = self.substitute_latest(path)
+                path = d.expander.expand('archive-path')
+        if 'dest' in d.expander:
+            dest = d.expander.expand('dest')
+        lookup = dest.rstrip( '/' ) + '/' + name
+        return name, lookup, dest, path
+
+    def clean_changed(self):
+        """Selective alternative to clean_dirs(): remove only the files of the
+        dependencies whose archive has changed (or which are no longer listed)
+        since they were fetched, as recorded in the fetched-dependency manifest.
+        Everything else is left in place for fetch() to skip. Falls back to a
+        full clean if there is no usable manifest."""
+        clean_changed_collections([self])
+
+    def substitute_latest(self, path):
 
         def by_version(arg):
             val = 0
@@ -522,7 +1086,9 @@ class DependencyCollection(object):
         matches = []
         dir, base = os.path.split(path)
         pattern = base.replace('latest', '.*')
-        files = aws.ls(dir)
+        files = self.listings.get(dir)
+        if files is None:
+            files = self.listings[dir] = aws.ls(dir)
         for f in files:
             base_name = os.path.basename(f)
             if re.fullmatch(pattern, base_name):
@@ -531,6 +1097,69 @@ class DependencyCollection(object):
         # return f'{dir}/{matches[0]}'  not supported by Jenkins version of python
         return dir + '/' + matches[0]
     
+    def verify(self, subset=None, jobs=None):
+        """Check the unpacked files of the fetched dependencies against the
+        manifest. Damaged dependencies are marked so that the next fetch unpacks
+        them again. Returns list of names of damaged dependencies."""
+        dependencies = self._filter(subset)
+        manifest = fetch_manifest.FetchManifest(self.fetched_deps_filename(dependencies))
+        keys = set()
+        for d in dependencies:
+            if 'dest' in d.expander:
+                keys.add(d.expander.expand('dest').rstrip('/') + '/' + d.name)
+        start = time.time()
+        damaged = manifest.verify(jobs=jobs, keys=keys)
+        manifest.save()
+        for key, problems in sorted(damaged.items()):
+            print("Dependency %s is damaged (%d problems, e.g. %s)" % (key, len(problems), problems[0]))
+        print("Verified %d fetched dependencies in %.1fs - %d damaged" % (
+            len([k for k in keys if k in manifest]), time.time() - start, len(damaged)))
+        return sorted(damaged)
+
+    def lock(self, jobs=1):
+        """Fully expanded values of every dependency (with 'latest' resolved),
+        plus the size and ETag of its archive, as recorded in the lockfile"""
+        locked = {}
+        for d in self.dependencies.values():
+            self.resolve(d)
+            values = {}
+            for key in kLockedKeys:
+                if key in d.expander:
+                    values[key] = d.expander.expand(key)
+            if d.has_overrides:
+                print("Warning: locking %s with local override %s" % (d.name, values['archive-path']))
+            locked[d.name] = values
+        with ThreadPoolExecutor(max(jobs, archives.default_jobs())) as pool:
+            infos = list(pool.map(lambda values: self.lock_info(values['archive-path']), locked.values()))
+        for values, info in zip(locked.values(), infos):
+            if info is None:
+                raise Exception("Unable to find archive %s" % values['archive-path'])
+            values['archive-size'] = info['size']
+            values['archive-etag'] = info['etag']
+        return locked
+
+    @staticmethod
+    def lock_info(path):
+        if path.startswith("s3:"):
+            return aws.info(path)
+        if not os.path.isfile(path):
+            return None
+        return {'size': os.path.getsize(path), 'etag': None}
+
+    def verify_lock(self, jobs=1):
+        """Check (with a HEAD request each) that the locked archives are unchanged.
+        Returns list of descriptions of those that have changed or gone."""
+        dependencies = [d for d in self.dependencies.values() if 'archive-etag' in d.expander]
+        with ThreadPoolExecutor(max(jobs, archives.default_jobs())) as pool:
+            infos = list(pool.map(lambda d: self.lock_info(d.expand_remote_path()), dependencies))
+        problems = []
+        for d, info in zip(dependencies, infos):
+            if info is None:
+                problems.append("%s: %s not found" % (d.name, d.expand_remote_path()))
+            elif info['size'] != d['archive-size'] or info['etag'] != d['archive-etag']:
+                problems.append("%s: %s has changed since it was locked" % (d.name, d.expand_remote_path()))
+        return problems
+
     @staticmethod
     def fetched_deps_filename(deps):
         filename = None
@@ -540,40 +1169,255 @@ class DependencyCollection(object):
                 break
         return filename
 
-    def load_fetched_deps(self, filename):
-        loaded_deps = {}
-        if filename and os.path.isfile(filename):
+    def checkout(self, subset=None, jobs=1, mode='full'):
+        """Check out the source of subset (see Dependency.checkout), up to jobs
+        repositories at once. Dependencies with no 'source-git' are skipped,
+        and failures are reported together at the end. Returns True if all
+        those with a repository were checked out."""
+        if mode not in kCheckoutModes:
+            raise Exception("Unknown checkout mode '%s' - expected one of %s" % (mode, ', '.join(kCheckoutModes)))
+        dependencies = []
+        for d in self._filter(subset):
+            if d['source-git'] is None:
+                print('No git repo defined for {0}'.format(d.name))
+            else:
+                dependencies.append(d)
+        failed_dependencies = []
+        start = time.time()
+
+        def checkout_one(d):
             try:
-                f = open(filename, 'rt')
-                loaded_deps = json.load(f)
-                f.close()
-            except:
-                print("Error with current fetched dependency file: %s" % filename)
-        return loaded_deps
+                d.checkout(mode)
+            except Exception as e:
+                log("  **** FAILED - %s ****" % e)
+                failed_dependencies.append((d.name, str(e)))
 
-    @staticmethod
-    def save_fetched_deps(filename, deps):
-        f = open(filename, 'wt')
-        json.dump(deps, f)
-        f.close()
+        if jobs > 1 and len(dependencies) > 1:
+            print("Checking out %d repositories using %d jobs" % (len(dependencies), jobs))
 
-    def checkout(self, subset=None):
-        dependencies = self._filter(subset)
-        failed_dependencies = []
-        for d in dependencies:
-            if not d.checkout():
-                failed_dependencies.append(d.name)
+            def checkout_buffered(d):
+                _begin_buffered_log()
+                try:
+                    checkout_one(d)
+                finally:
+                    _end_buffered_log()
+
+            with ThreadPoolExecutor(jobs) as pool:
+                for _ in pool.map(checkout_buffered, dependencies):
+                    pass
+        else:
+            for d in dependencies:
+                checkout_one(d)
+        print("Checked out %d of %d repositories in %.1fs" % (
+            len(dependencies) - len(failed_dependencies), len(dependencies), time.time() - start))
         if failed_dependencies:
-            print("Failed to check out some dependencies: " + ' '.join(failed_dependencies))
+            print("Failed to check out some dependencies:")
+            for name, error in sorted(failed_dependencies):
+                print("    %s: %s" % (name, error))
             return False
         return True
 
 
+class CrossCheck(object):
+    """Cross-check (see deps_cross_checker) of the dependencies.json bundled with
+    each dependency as soon as it has been fetched, against the project's and
+    those fetched before it - one DepsCrossChecker per platform fetched. At the
+    first mismatch, cancel is set (unless keep_going), which abandons the fetches
+    in progress and stops any more starting."""
+
+    def __init__(self, checkers, keep_going=False):
+        self.checkers = checkers
+        self.keep_going = keep_going
+        self.cancel = threading.Event()
+        for checker in checkers:
+            checker.begin()
+
+    def fetched(self, d):
+        """Check dependency d, fetched (or already present)"""
+        filename = os.path.join(d.expand_local_path(), d.name, 'dependencies.json')
+        if sum(checker.add_fetched(filename) for checker in self.checkers) and not self.keep_going and not self.cancel.is_set():
+            print("Dependency cross-check failed for %s - cancelling the rest of the fetch (use --keep-going to fetch everything)" % d.name)
+            self.cancel.set()
+
+    def failures(self):
+        return sum(checker.failures for checker in self.checkers)
+
+
+def plan_fetch(collections, subset=None, jobs=1, clean=False, manifests=None):
+    """Plan (see DependencyCollection.plan) a fetch of subset of each of
+    collections - e.g. of the same dependencies for several platforms. A
+    dependency with the same manifest key (dest and archive name) in more than
+    one collection, such as an AnyPlatform one, is planned only for the first,
+    and each archive is checked only once. Returns a list of (collection, plan
+    entry). manifests ({filename: FetchManifest}) is filled with the
+    fetched-dependency manifests read."""
+    if manifests is None:
+        manifests = {}
+    planned = []
+    planned_keys = {}
+    for collection in collections:
+        dependencies = collection._filter(subset)
+        filename = collection.fetched_deps_filename(dependencies)
+        if filename not in manifests:
+            manifests[filename] = fetch_manifest.FetchManifest(filename)
+        manifest = manifests[filename]
+        for d in dependencies:
+            name, lookup, dest, path = collection.resolve(d)
+            if lookup in planned_keys:
+                if planned_keys[lookup] != path:
+                    print("Note: %s for %s is %s, but %s is already being fetched" % (
+                        name, collection.base_env.get('platform'), path, planned_keys[lookup]))
+                continue
+            planned_keys[lookup] = path
+            action = 'skip' if not clean and manifest.is_current(lookup, path) else None
+            planned.append((collection, {
+                'name': name, 'platform': collection.base_env.get('platform'), 'archive': path, 'dest': dest,
+                'key': lookup, 'manifest': filename, 'action': action, 'bytes': 0}))
+    pending = {}
+    for collection, entry in planned:
+        if entry['action'] is None:
+            pending.setdefault(entry['archive'], (collection, []))[1].append(entry)
+    with ThreadPoolExecutor(max(jobs, kPlanJobs)) as pool:
+        results = pool.map(lambda item: item[1][0].plan_action(item[0]), pending.items())
+        for (_path, (_collection, entries)), (action, size) in zip(pending.items(), results):
+            for entry in entries:
+                entry['action'] = action
+                entry['bytes'] = size
+    return planned
+
+
+def report_missing(planned):
+    """Report any archives in planned ((collection, plan entry) - see
+    plan_fetch()) that are missing. Returns True if none are."""
+    missing = [(collection, entry) for collection, entry in planned if entry['action'] == 'missing']
+    for collection, entry in missing:
+        print("Missing archive for %s: %s" % (entry['name'], entry['archive']))
+        d = collection.dependencies[entry['name']]
+        d.report = d.new_report(entry['archive'], 'failed')
+        d.report['error'] = 'archive not found'
+        collection.reports.append(d.report)
+    if missing:
+        print("Unable to find %d of %d archives - nothing fetched" % (len(missing), len(planned)))
+    return not missing
+
+
+def fetch_collections(collections, subset=None, jobs=1, cross_check=None, planned=None):
+    """Fetch subset of each of collections (see plan_fetch()) through one pool
+    of jobs workers, once all their archives are known to exist - checking
+    each dependency with cross_check (a CrossCheck), if given, as it completes.
+    planned is the result of an earlier plan_fetch(), if already made.
+    Returns True if everything was fetched."""
+    manifests = {}
+    if planned is None:
+        planned = plan_fetch(collections, subset, jobs, manifests=manifests)
+        if not report_missing(planned):
+            return False
+    else:
+        # the manifests are read afresh, as the plan may have been made before a clean
+        for _collection, entry in planned:
+            if entry['manifest'] not in manifests:
+                manifests[entry['manifest']] = fetch_manifest.FetchManifest(entry['manifest'])
+    cancel = cross_check.cancel if cross_check is not None else threading.Event()
+    for collection in collections:
+        collection.fetcher.cancel = cancel
+    failed_dependencies = []
+    cancelled = []
+    pending = []
+    for collection, entry in planned:
+        d = collection.dependencies[entry['name']]
+        if entry['action'] == 'skip':
+            collection.skip(d, entry['archive'])
+            if cross_check is not None:
+                cross_check.fetched(d)
+        else:
+            pending.append((collection, d, entry))
+
+    def fetch_one(collection, d, entry):
+        label = d.name if len(collections) == 1 else entry['key']
+        if cancel.is_set():
+            cancelled.append(label)
+            return d, False
+        ok = collection.fetch_one(manifests[entry['manifest']], d, entry['key'], entry['dest'], entry['archive'])
+        if not ok:
+            failed_dependencies.append(label)
+        return d, ok
+
+    def completed(d, ok):
+        if ok and cross_check is not None:
+            cross_check.fetched(d)
+
+    if jobs > 1 and len(pending) > 1:
+        # Start the largest archives first so that the slowest download
+        # isn't left running on its own at the end.
+        pending.sort(key=lambda p: p[2]['bytes'], reverse=True)
+        print("Fetching %d dependencies using %d jobs" % (len(pending), jobs))
+
+        def fetch_buffered(*p):
+            _begin_buffered_log()
+            try:
+                return fetch_one(*p)
+            finally:
+                _end_buffered_log()
+
+        with ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(fetch_buffered, *p) for p in pending]
+            for future in as_completed(futures):
+                completed(*future.result())
+    else:
+        for p in pending:
+            completed(*fetch_one(*p))
+
+    for manifest in manifests.values():
+        manifest.save()
+    if cancelled:
+        print("Cancelled %d outstanding fetches: %s" % (len(cancelled), ' '.join(cancelled)))
+        return False
+    if failed_dependencies:
+        print("Failed to fetch some dependencies: " + ' '.join(failed_dependencies))
+        return False
+    return True
+
+
+def clean_changed_collections(collections):
+    """DependencyCollection.clean_changed() for several collections (e.g.
+    platforms) - a fetched dependency is only stale if it is current in none
+    of those sharing its manifest"""
+    current_by_manifest = {}
+    for collection in collections:
+        dependencies = list(collection._filter())
+        current = current_by_manifest.setdefault(collection.fetched_deps_filename(dependencies), {})
+        for d in dependencies:
+            _name, lookup, _dest, path = collection.resolve(d)
+            current[lookup] = path
+    for filename, current in current_by_manifest.items():
+        manifest = fetch_manifest.FetchManifest(filename)
+        if not manifest.items():
+            if filename:
+                clean_dirs(os.path.dirname(filename))
+            continue
+        stale = [key for key, _entry in manifest.items()
+                 if key not in current or not manifest.is_current(key, current[key])]
+        kept = set(key for key, _entry in manifest.items()) - set(stale)
+        start = time.time()
+        removed = 0
+        for key in sorted(stale):
+            removed += manifest.uninstall(key, keep=kept)
+            print("Cleaned %s (%s)" % (key, 'changed' if key in current else 'no longer listed'))
+        manifest.save()
+        print("Cleaned %d of %d fetched dependencies (%d files) in %.1fs" % (
+            len(stale), len(stale) + len(kept), removed, time.time() - start))
+
+
 def read_json_dependencies(dependencyfile, overridefile, env):
+    return create_collection(json.load(dependencyfile), json.load(overridefile), env)
+
+
+def create_collection(dependencies, overrides, env):
+    """DependencyCollection for env of the (parsed) dependency definitions,
+    with local overrides applied"""
     collection = DependencyCollection(env)
-    dependencies = json.load(dependencyfile)
-    overrides = json.load(overridefile)
     overrides_by_name = dict((dep['name'], dep) for dep in overrides)
+    collection.overrides = overrides_by_name
     for d in dependencies:
         name = d['name']
         override = overrides_by_name.get(name, {})
@@ -581,122 +1425,392 @@ def read_json_dependencies(dependencyfile, overridefile, env):
     return collection
 
 
-def read_json_dependencies_from_filename(dependencies_filename, overrides_filename, env):
+def read_json_definitions(dependencies_filename, overrides_filename):
+    """Parsed (dependencies, overrides) definitions - empty if there is no
+    dependencies file"""
     try:
-        dependencyfile = open(dependencies_filename, "r")
         with open(dependencies_filename) as dependencyfile:
-            if overrides_filename is not None and os.path.isfile(overrides_filename):
-                with open(overrides_filename) as overridesfile:
-                    return read_json_dependencies(dependencyfile, overridesfile, env)
-            else:
-                return read_json_dependencies(dependencyfile, io.StringIO(u'[]'), env)
+            dependencies = json.load(dependencyfile)
     except (OSError, IOError) as e:
         if e.errno != 2:
             raise
-        return DependencyCollection(env)
+        return [], []
+    overrides = []
+    if overrides_filename is not None and os.path.isfile(overrides_filename):
+        with open(overrides_filename) as overridesfile:
+            overrides = json.load(overridesfile)
+    return dependencies, overrides
+
+
+def create_matrix(definitions, overrides, envs, keys=None):
+    """DependencyMatrix (see dependency_matrix) of parsed definitions (see
+    read_json_definitions) for each of envs"""
+    return dependency_matrix.DependencyMatrix([create_collection(definitions, overrides, env) for env in envs], keys)
+
+
+def read_matrix(dependencies_filename, platforms=None, debugmodes=('Release',), env=None, overrides_filename=None, keys=None):
+    """DependencyMatrix of a dependencies file for each of platforms (default
+    all supported platforms) and debugmodes"""
+    definitions, overrides = read_json_definitions(dependencies_filename, overrides_filename)
+    envs = dependency_matrix.combination_envs(platforms or dependency_matrix.supported_platforms(), debugmodes, env)
+    return create_matrix(definitions, overrides, envs, keys)
+
+
+def read_cross_check_versions(filename, platform):
+    """Versions to cross-check (see deps_cross_checker) in the dependencies file
+    filename, expanded for platform"""
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'rt') as f:
+        items = json.load(f)
+    collection = DependencyCollection(dependency_matrix.combination_envs([platform])[0])
+    for item in items:
+        try:
+            collection.create_dependency(item)
+        except Exception as e:
+            print("Warning: %s(%s)" % (e.__class__.__name__, e))
+    return deps_cross_checker.DepsCrossChecker.versions(dependency_matrix.DependencyMatrix([collection], dependency_matrix.kCheckKeys), 0)
+
+
+def read_json_dependencies_from_filename(dependencies_filename, overrides_filename, env):
+    dependencies, overrides = read_json_definitions(dependencies_filename, overrides_filename)
+    return create_collection(dependencies, overrides, env)
+
+
+def write_lockfile(dependencies, env, filename=kLockFilename, jobs=1):
+    """Record the expanded dependencies in the lockfile section for env's platform
+    and debugmode, keeping any other sections"""
+    lockfile = {'format': kLockFormat, 'locked': {}}
+    if os.path.isfile(filename):
+        with open(filename, 'rt') as f:
+            lockfile = json.load(f)
+    lockfile['locked'][lock_key(env)] = dependencies.lock(jobs)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wt') as f:
+        json.dump(lockfile, f, indent=4, sort_keys=True)
+        f.write('\n')
+    os.replace(tmpname, filename)
+    print("Locked %d dependencies for %s in %s" % (len(dependencies.dependencies), lock_key(env), filename))
+
+
+def read_locked_dependencies(env, filename=kLockFilename):
+    """Read the dependencies recorded in the lockfile for env's platform and
+    debugmode - no templates are expanded and no archives are listed"""
+    try:
+        with open(filename, 'rt') as f:
+            lockfile = json.load(f)
+    except (OSError, IOError):
+        raise Exception("No lockfile %s - create one with 'go fetch --lock'" % filename)
+    if lockfile.get('format') != kLockFormat:
+        raise Exception("Unsupported lockfile format in %s" % filename)
+    section = lockfile['locked'].get(lock_key(env))
+    if section is None:
+        raise Exception("Lockfile %s has no entry for %s - update it with 'go fetch --lock'" % (filename, lock_key(env)))
+    collection = DependencyCollection(env)
+    for name, values in section.items():
+        collection.dependencies[name] = Dependency(name, values, collection.fetcher, expander_class=LockedExpander)
+    return collection
 
 
-def clean_dirs(dir):
-    """Remove the specified directory tree - don't remove anything if it would fail"""
+def write_fetch_report(filename, collections, summary):
+    """Write the per-dependency fetch reports of collections (a
+    DependencyCollection or a list of them, one per platform) to filename
+    (JSON), and print a table of them, slowest first"""
+    if isinstance(collections, DependencyCollection):
+        collections = [collections]
+    reports = sorted((r for c in collections for r in c.reports), key=lambda r: r['seconds'], reverse=True)
+    fetched = [r for r in reports if r['status'] == 'fetched']
+    summary['totals'] = {
+        'dependencies': len(reports),
+        'fetched': len(fetched),
+        'skipped': len([r for r in reports if r['status'] == 'skipped']),
+        'failed': len([r for r in reports if r['status'] == 'failed']),
+        'bytes': sum(r['bytes'] for r in fetched),
+        'downloaded-bytes': sum(r['downloaded-bytes'] for r in fetched),
+        'files': sum(r['files'] for r in fetched)}
+    summary['dependencies'] = reports
+    with open(filename, 'wt') as f:
+        json.dump(summary, f, indent=4)
+    print("\n%-32s %-8s %-6s %10s %10s %9s %9s %8s" % ('Dependency', 'Status', 'Source', 'MB', 'MB/s', 'Download', 'Extract', 'Files'))
+    for r in reports:
+        download_rate = r['downloaded-bytes'] / 1048576.0 / r['download-seconds'] if r['download-seconds'] else 0
+        print("%-32s %-8s %-6s %10.1f %10.1f %8.1fs %8.1fs %8d" % (
+            (r['name'] if len(collections) == 1 else '%s (%s)' % (r['name'], r['platform']))[:32], r['status'], r['source'] or '-', r['bytes'] / 1048576.0, download_rate,
+            r['download-seconds'], r['extract-seconds'], r['files']))
+    totals = summary['totals']
+    print("%d fetched, %d skipped, %d failed - %.1f MB (%.1f MB downloaded), %d files in %.1fs (cross-check %.1fs)" % (
+        totals['fetched'], totals['skipped'], totals['failed'], totals['bytes'] / 1048576.0,
+        totals['downloaded-bytes'] / 1048576.0, totals['files'], summary['seconds'], summary['cross-check-seconds']))
+    print("Fetch report written to %s" % filename)
+
+
+def print_plan(plan):
+    """Print the plan of a fetch (see DependencyCollection.plan) and its total transfer"""
+    platforms = len(set(entry['platform'] for entry in plan)) > 1
+    print("%-9s %10s  %-30s %s" % ('action', 'MB', 'dependency', 'archive'))
+    for entry in plan:
+        action = entry['action']
+        size = '' if action in ('skip', 'missing') else '%.1f' % (entry['bytes'] / 1048576.0)
+        name = '%s (%s)' % (entry['name'], entry['platform']) if platforms else entry['name']
+        print("%-9s %10s  %-30s %s" % ('MISSING' if action == 'missing' else action, size, name, entry['archive']))
+    download = [entry['bytes'] for entry in plan if entry['action'] == 'download']
+    local = [entry['bytes'] for entry in plan if entry['action'] in ('cache', 'store', 'local')]
+    print("%d to download (%.1f MB), %d from cache, store or local paths (%.1f MB), %d unchanged, %d missing" % (
+        len(download), sum(download) / 1048576.0, len(local), sum(local) / 1048576.0,
+        len([entry for entry in plan if entry['action'] == 'skip']),
+        len([entry for entry in plan if entry['action'] == 'missing'])))
+
+
+def clean_dirs(dir, fast=True, check_locks=False):
+    """Remove the specified directory tree - don't remove anything if it would fail.
+    With fast set, the tree is renamed into the trash and deleted in the
+    background (see trash.py). Files held open only prevent deletion on
+    Windows, so that is the only place the tree is checked for them - before
+    starting if check_locks is set, otherwise only if it can't be renamed."""
     if os.path.isdir( dir ):
-        locked = []
-        for dirName, _subdirList, fileList in os.walk(dir):
-            for fileName in fileList:
-                filePath = os.path.join(dirName, fileName)
-                try:
-                    if not os.path.islink( filePath ):
-                        openAtt = 'r'
-                        if platform.system().lower() == 'windows':
-                            openAtt = 'a'
-                        f = open(filePath, openAtt)
-                        f.close()
-                except:
-                    locked.append(filePath)
-        if locked:
-            for f in locked:
-                print('Locked file:- ', f)
-            raise Exception('Failed to clean dependencies\n')
-        else:
-            shutil.rmtree(dir)
+        windows = platform.system().lower() == 'windows'
+        if check_locks and windows:
+            check_unlocked(dir)
+        if fast and trash.move_to_trash(dir):
+            return
+        if windows and not check_locks:
+            check_unlocked(dir)
+        shutil.rmtree(dir)
 
 
-def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=True, clean=True, source=False, list_details=False, local_overrides=True, verbose=False):
+def check_unlocked(dir):
+    """Raise if any file in the directory tree is held open (Windows)"""
+    locked = []
+    for dirName, _subdirList, fileList in os.walk(dir):
+        for fileName in fileList:
+            filePath = os.path.join(dirName, fileName)
+            try:
+                if not os.path.islink( filePath ):
+                    f = open(filePath, 'a')
+                    f.close()
+            except:
+                locked.append(filePath)
+    if locked:
+        for f in locked:
+            print('Locked file:- ', f)
+        raise Exception('Failed to clean dependencies\n')
+
+
+def graph_filename(graph, platform):
+    """graph, with platform added before the extension (for a fetch of several platforms)"""
+    root, ext = os.path.splitext(graph)
+    return '%s-%s%s' % (root, platform, ext)
+
+
+def fetch_dependencies(dependency_names=None, platform=None, env=None, fetch=True, clean=True, source=False, list_details=False, local_overrides=True, verbose=False, jobs=1, cache=True, store=False, verify=False, lock=False, locked=False, verify_lock=False, report=None, transitive=False, graph=None, chunked=False, plan=False, cross_check=None, keep_going=False, source_mode='full'):
     '''
     Fetch all the dependencies defined in projectdata/dependencies.json and in
     projectdata/packages.config.
     platform:
         Name of target platform. E.g. 'Windows-x86', 'Linux-x64', 'Mac-x64'...
+        A list (or comma-separated string) of platforms fetches them all
+        together - 'latest' archives are listed once, an archive shared by
+        several platforms (e.g. AnyPlatform) is fetched once and all downloads
+        share the one pool of jobs. A list of DependencyCollection, one per
+        platform, is then returned.
     env:
         Extra variables referenced by the dependencies file.
     fetch:
         True to fetch the listed dependencies, False to skip.
     clean:
         True to clean out directories before fetching, False to skip.
+        'selective' to remove only the dependencies whose archive has changed
+        (or which are no longer listed) since they were last fetched.
     source:
         True to fetch source for the listed dependencies, False to skip.
+        Repositories are checked out into ../<name>, jobs at once.
+    source_mode:
+        How source is checked out - 'full', 'shallow' (only the tagged commit)
+        or 'blobless' (full history, fetching file contents as needed).
+    jobs:
+        Number of dependencies to download and unpack concurrently.
+    cache:
+        True to keep downloaded archives in the per-user archive cache (see
+        archive_cache.py) and re-use them in later fetches, False to always
+        download. An ArchiveCache instance may be passed to use a specific cache.
+    store:
+        True to unpack each archive once into the per-machine dependency store
+        (see dependency_store.py) and copy (or reflink) its files into the
+        workspace, rather than unpacking into each workspace. A DependencyStore
+        instance may be passed to use a specific store (e.g. one which hardlinks).
+    verify:
+        True to check previously fetched dependencies against the files recorded
+        in dependencies/loadedDeps.json, so that any which have been modified or
+        partly deleted are fetched again. With fetch=False, only reports.
+    lock:
+        True to record the fully expanded dependencies (and the size and ETag of
+        their archives) for this platform and debugmode in
+        projectdata/dependencies.lock.json.
+    locked:
+        True to read the dependencies from the lockfile instead, without
+        expanding dependencies.json or listing 'latest' archives.
+    verify_lock:
+        With locked, check that no locked archive has changed since it was
+        locked (one HEAD request per archive).
+    report:
+        Filename to write a JSON report of the bytes, download and extraction
+        time, file count and status of each dependency fetched to (also
+        summarised in a table at the end).
+    transitive:
+        True to also fetch (recursively) the dependencies listed in the
+        dependencies.json bundled with each fetched dependency.
+    graph:
+        With transitive, filename to write the resolved dependency graph to
+        (Graphviz dot if it ends in '.dot', otherwise JSON).
+    chunked:
+        True to fetch archives published in chunked form (see
+        chunked_artifacts.py) by downloading only the chunks not already in the
+        per-user chunk store. A ChunkStore instance may be passed to use a
+        specific store.
+    plan:
+        True to only print which archives would be downloaded, taken from the
+        cache or store, skipped as unchanged or are missing (with their sizes),
+        without cleaning or fetching anything. Raises an exception if any are
+        missing. The same check is made before any fetch starts downloading.
+    cross_check:
+        True to cross-check the (major.minor) versions of the dependencies
+        against those they were built with, False to skip. The default (None)
+        checks unless clean is True - a selective clean leaves the unchanged
+        dependencies in place, so the full set is checked.
+    keep_going:
+        The dependency versions are cross-checked as each dependency is
+        fetched (if checked at all), and the first mismatch cancels the rest of
+        the fetch. True to fetch everything regardless (the mismatches are
+        still reported, and raised once the fetch is complete).
     '''
+    if cross_check is None:
+        cross_check = not clean or clean == 'selective'
+    summary = {'started': time.time(), 'jobs': jobs, 'seconds': 0.0, 'cross-check-seconds': 0.0}
     if env is None:
         env = {}
 
-    if platform is not None:
-        env['platform'] = None
-        fName = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'platforms.txt')
-        f = open(fName, 'rt')
-        supported = f.readlines()
-        f.close()
-        for entry in supported:
-            if platform in entry:
-                env['platform'] = platform
-        if not env['platform']:
-            raise Exception('Platform not supported (%s) - see %s for list of supported platforms' % (platform, fName))
-    if 'platform' not in env:
-        platform = env['platform'] = default_platform()
-    if '-' in platform:
-        components = platform.split('-')
-        if len(components) == 2:
-            env['system'], env['architecture'] = components
-        elif len(components) == 3:
-            env['architecture'], env['distro'], env['system'] = components
-        else:
-            print("Unexpected platform format '%s'" % platform)
-    if platform is None:
-        raise Exception('Platform not specified and unable to guess.')
+    platforms = platform.split(',') if isinstance(platform, str) else platform
+    if platforms and len(platforms) > 1:
+        envs = [platform_env(name, dict(env)) for name in platforms]
+    else:
+        envs = [platform_env(platforms[0] if platforms else None, env)]
+    summary['platform'] = ','.join(e['platform'] for e in envs)
 
-    if clean and not list_details:
-        try:
-            os.unlink('dependencies/loadedDeps.json')
-        except:
-            pass
-        clean_dirs('dependencies')
+    trash.purge()
 
-    overrides_filename = '../dependency_overrides.json' if local_overrides else None
-    dependencies = read_json_dependencies_from_filename('projectdata/dependencies.json', overrides_filename, env=env)
     if list_details:
-        for name, dependency in dependencies.items():
-            print("Dependency '{0}':".format(name))
-            print("    fetches from:     {0!r}".format(dependency['archive-path']))
-            print("    unpacks to:       {0!r}".format(dependency['dest']))
-            print("    local override:   {0}".format("YES (see '../dependency_overrides.json')" if dependency.has_overrides else 'no'))
-            if verbose:
-                print("    all keys:")
-                for key, value in sorted(dependency.items()):
-                    print("        {0} = {1!r}".format(key, value))
-            print("")
+        keys = None if verbose else dependency_matrix.kListKeys
+    else:
+        keys = dependency_matrix.kFetchKeys
+    collections = []
+    listings = {}
+    if locked:
+        if source:
+            raise Exception("Source can't be fetched for locked dependencies")
+        for e in envs:
+            dependencies = read_locked_dependencies(e)
+            if verify_lock:
+                problems = dependencies.verify_lock(jobs)
+                if problems:
+                    raise Exception("Lockfile is out of date:\n    " + '\n    '.join(problems))
+            collections.append(dependencies)
+        matrix = dependency_matrix.DependencyMatrix(collections, keys)
+    else:
+        overrides_filename = '../dependency_overrides.json' if local_overrides else None
+        definitions, overrides = read_json_definitions('projectdata/dependencies.json', overrides_filename)
+        matrix = create_matrix(definitions, overrides, envs, keys)
+        collections = matrix.collections
+        for e, dependencies in zip(envs, collections):
+            dependencies.listings = listings
+            if lock:
+                write_lockfile(dependencies, e, jobs=jobs)
+    if cache:
+        cache = cache if isinstance(cache, archive_cache.ArchiveCache) else archive_cache.ArchiveCache()
+    if chunked:
+        chunked = chunked if isinstance(chunked, chunked_artifacts.ChunkStore) else chunked_artifacts.ChunkStore()
+    if store:
+        store = store if isinstance(store, dependency_store.DependencyStore) else dependency_store.DependencyStore()
+    for dependencies in collections:
+        if cache:
+            dependencies.fetcher.cache = cache
+        if chunked:
+            dependencies.fetcher.chunks = chunked
+        if store:
+            dependencies.store = store
+    if plan:
+        entries = [entry for _collection, entry in plan_fetch(collections, dependency_names, jobs, clean=clean and clean != 'selective')]
+        print_plan(entries)
+        if [entry for entry in entries if entry['action'] == 'missing']:
+            raise Exception("Some dependency archives are missing")
+        return
+    planned = None
+    if clean and clean != 'selective' and not list_details:
+        if fetch:
+            # only clean once every archive is known to exist, so a missing one leaves what is there alone
+            planned = plan_fetch(collections, dependency_names, jobs, clean=True)
+            if not report_missing(planned):
+                if report:
+                    write_fetch_report(report, collections, summary)
+                raise Exception("Failed to load requested dependencies")
+        fetch_manifest.FetchManifest(os.path.join('dependencies', 'loadedDeps.json')).delete()
+        clean_dirs('dependencies')
+    if clean == 'selective' and not list_details:
+        clean_changed_collections(collections)
+    version_cache = None
+    checker = None
+    if list_details:
+        matrix.print_list(verbose)
     else:
+        if verify and (not clean or clean == 'selective'):
+            damaged = []
+            for dependencies in collections:
+                damaged.extend(dependencies.verify(dependency_names, jobs=max(jobs, archives.default_jobs())))
+            if damaged and not fetch:
+                raise Exception("Fetched dependencies are damaged: " + ' '.join(damaged))
         if fetch:
-            if not dependencies.fetch(dependency_names):
+            version_cache = deps_cross_checker.VersionCache(read_cross_check_versions)    # shared with the final check
+            if cross_check:
+                checker = CrossCheck([deps_cross_checker.DepsCrossChecker(e['platform'], version_cache, matrix) for e in envs], keep_going)
+            if transitive:
+                # each platform's bundled dependencies are only known as it is fetched
+                fetched = True
+                for dependencies in collections:
+                    fetched = dependencies.fetch_transitive(dependency_names, jobs=jobs, cross_check=checker) and fetched
+                    if graph:
+                        dependencies.write_graph(graph_filename(graph, dependencies.base_env['platform']) if len(collections) > 1 else graph)
+            else:
+                fetched = fetch_collections(collections, dependency_names, jobs=jobs, cross_check=checker, planned=planned)
+            summary['seconds'] = round(time.time() - summary['started'], 3)
+            if not fetched:
+                if report:
+                    write_fetch_report(report, collections, summary)
+                if checker is not None and checker.cancel.is_set():
+                    raise Exception('Failed: dependency cross-checker detected problem(s)')
                 raise Exception("Failed to load requested dependencies")
 
         if source:
-            dependencies.checkout(dependency_names)
+            if not collections[0].checkout(dependency_names, jobs=jobs, mode=source_mode):
+                raise Exception("Failed to fetch source of some dependencies")
 
     # Finally perform cross-check of (major.minor) dependency versions to ensure that these are in sync
     # across this (current) repo and all its pulled-in dependencies. Done as totally seperate operation
     # to isolate from the main fetcher code to assist with any future maintenance
-    if not clean:
-        xcheck = deps_cross_checker.DepsCrossChecker( platform )
-        result = xcheck.execute()
-        if result != 0:
-            raise Exception( 'Failed: dependency cross-checker detected problem(s)' )
-
-    return dependencies
+    result = 0
+    if cross_check:
+        start = time.time()
+        reports = {}
+        for i, e in enumerate(envs):
+            xcheck = deps_cross_checker.DepsCrossChecker( e['platform'], version_cache or deps_cross_checker.VersionCache(read_cross_check_versions), matrix )
+            if checker is not None:
+                xcheck.reported = set(checker.checkers[i].reported)    # already printed as they were found
+            result = xcheck.execute() or result
+            reports[e['platform']] = xcheck.report()
+        deps_cross_checker.write_report( reports )
+        summary['cross-check'] = reports
+        summary['cross-check-seconds'] = round(time.time() - start, 3)
+    if report and fetch and not list_details:
+        write_fetch_report(report, collections, summary)
+    if result != 0:
+        raise Exception( 'Failed: dependency cross-checker detected problem(s)' )
+
+    return collections[0] if len(collections) == 1 else collections
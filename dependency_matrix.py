@@ -0,0 +1,213 @@
+"""Expansion of a set of dependency definitions for several combinations of
+platform and debugmode at once.
+
+Most values in a dependencies file - names, versions, repositories, the
+archive names of AnyPlatform dependencies - are the same whatever the
+platform or debugmode, and the rest usually only differ in part. A
+DependencyMatrix expands each dependency fully for the first combination,
+tracking which keys are affected by the environment keys that differ between
+combinations. The values of all the others are shared with the remaining
+combinations, so only the varying keys are expanded again for each of them.
+
+The result is a compact table (see table()): for each dependency, the values
+common to all combinations, and for each of the rest its value per
+combination. 'go fetch --list' prints it and the cross-checker reads versions
+from it."""
+import os
+from environment_expander import EnvironmentExpander, LockedExpander, lock_key, platform_env
+
+kListKeys  = ('archive-path', 'dest')
+kCheckKeys = ('version', 'cross-check')
+kFetchKeys = ('name', 'archive-path', 'dest') + kCheckKeys
+
+
+class TrackingExpander(EnvironmentExpander):
+    """Expander that records which of the keys it expands depend, directly or
+    through other keys, on any of the varying keys. A key that fails to expand
+    is counted as dependent, so that it is expanded for every combination."""
+    __slots__ = ('varying', 'dependent', 'stack')
+
+    def __init__(self, env_dict, varying):
+        EnvironmentExpander.__init__(self, env_dict)
+        self.varying = varying
+        self.dependent = set()
+        self.stack = []
+
+    def expand(self, key):
+        if key in self.varying:
+            self.dependent.add(key)
+        self.stack.append(key)
+        try:
+            return EnvironmentExpander.expand(self, key)
+        except Exception:
+            self.dependent.add(key)
+            self.expandset.discard(key)
+            raise
+        finally:
+            self.stack.pop()
+            if key in self.dependent:
+                self.dependent.update(self.stack)
+
+
+class PerCombination(dict):
+    """Value of a key that differs between combinations - {label: value}"""
+    __slots__ = ()
+
+
+def varying_keys(envs):
+    """Keys whose value isn't the same in all of envs (or is missing from some)"""
+    missing = object()
+    keys = set()
+    for env in envs:
+        keys.update(env)
+    return set(key for key in keys if any(env.get(key, missing) != envs[0].get(key, missing) for env in envs[1:]))
+
+
+def combination_envs(platforms, debugmodes=('Release',), env=None):
+    """Base environment for each (platform, debugmode) combination, platform
+    varying slowest"""
+    envs = []
+    for platform in platforms:
+        for debugmode in debugmodes:
+            combination = dict(env or {})
+            combination['debugmode'] = debugmode
+            combination['titlecase-debugmode'] = debugmode.title()
+            envs.append(platform_env(platform, combination))
+    return envs
+
+
+def supported_platforms():
+    """The platforms listed in platforms.txt"""
+    with open(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'platforms.txt'), 'rt') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class DependencyMatrix(object):
+    """The dependencies of one set of definitions for several combinations of
+    platform and debugmode - a DependencyCollection for each, in collections
+    (see dependencies.create_matrix and read_matrix to make one from definitions).
+    keys (default all) are expanded up front, the rest only when asked for (by
+    value() etc.)."""
+
+    def __init__(self, collections, keys=None):
+        self.collections = collections
+        self.labels = [lock_key(c.base_env) for c in collections]
+        self.varying = varying_keys([c.base_env for c in collections])
+        self.names = []
+        seen = set()
+        for collection in collections:
+            for name in collection.dependencies:
+                if name not in seen:
+                    seen.add(name)
+                    self.names.append(name)
+        self.keys = {}          # dependency name -> keys expanded up front
+        self.shared = {}        # dependency name -> keys shared by all combinations
+        for name in self.names:
+            self._expand(name, keys)
+
+    def _expand(self, name, keys):
+        present = [c.dependencies[name] for c in self.collections if name in c.dependencies]
+        first = present[0]
+        wanted = list(first.expander.keys()) if keys is None else [key for key in keys if key in first.expander]
+        self.keys[name] = wanted
+        if isinstance(first.expander, LockedExpander):
+            # recorded per combination, so nothing can be shared
+            self.shared[name] = set()
+            return
+        tracker = TrackingExpander(first.expander.env_dict, self.varying)
+        for key in wanted:
+            try:
+                tracker.expand(key)
+            except Exception:
+                pass        # raised again if the key is used
+        shared = dict((key, value) for key, value in tracker.cache.items() if key not in tracker.dependent)
+        self.shared[name] = set(shared)
+        first.expander.cache.update(tracker.cache)
+        for d in present[1:]:
+            d.expander.cache.update(shared)
+
+    def index(self, platform, debugmode=None):
+        """Index of the (first) combination for platform and debugmode"""
+        for i, collection in enumerate(self.collections):
+            env = collection.base_env
+            if env['platform'] == platform and (debugmode is None or str(env.get('debugmode')).title() == debugmode.title()):
+                return i
+        raise KeyError("No combination for %s/%s in dependency matrix" % (platform, debugmode))
+
+    def value(self, name, key, index=0):
+        """Expanded value of key for dependency name in the combination at
+        index - raises KeyError if the dependency or key isn't defined there"""
+        collection = self.collections[index]
+        if name not in collection.dependencies:
+            raise KeyError("No dependency %s for %s" % (name, self.labels[index]))
+        return collection.dependencies[name].expander.expand(key)
+
+    def column(self, index, keys):
+        """{dependency name: {key: value}} for one combination - keys that fail
+        to expand are left out, with the errors in the second element of the
+        returned (column, errors), as {dependency name: exception}"""
+        column = {}
+        errors = {}
+        collection = self.collections[index]
+        for name in self.names:
+            if name not in collection.dependencies:
+                continue
+            values = column[name] = {}
+            for key in keys:
+                if key in collection.dependencies[name].expander:
+                    try:
+                        values[key] = self.value(name, key, index)
+                    except Exception as e:
+                        errors[name] = e
+        return column, errors
+
+    def table(self, keys=None):
+        """Compact table of keys (default those expanded up front) of every
+        dependency - {name: {key: value}}, where value is a PerCombination for
+        a key that differs between combinations (leaving out any where it is
+        undefined or fails to expand)"""
+        table = {}
+        for name in self.names:
+            row = table[name] = {}
+            for key in (self.keys[name] if keys is None else keys):
+                values = PerCombination()
+                for i, label in enumerate(self.labels):
+                    try:
+                        values[label] = self.value(name, key, i)
+                    except Exception:
+                        pass
+                if not values:
+                    continue
+                distinct = list(values.values())
+                if len(values) == len(self.labels) and all(v == distinct[0] for v in distinct[1:]):
+                    row[key] = distinct[0]
+                else:
+                    row[key] = values
+        return table
+
+    def print_list(self, verbose=False):
+        """Print the dependencies (for 'go fetch --list') - values that differ
+        between combinations are listed for each"""
+        width = max(len(label) for label in self.labels) + 1
+        table = self.table(None if verbose else kListKeys)
+        for name in self.names:
+            row = table[name]
+            d = [c.dependencies[name] for c in self.collections if name in c.dependencies][0]
+            print("Dependency '{0}':".format(name))
+            for key, title in (('archive-path', 'fetches from'), ('dest', 'unpacks to')):
+                self._print_value("    {0:<18}".format(title + ':'), row.get(key), width)
+            print("    local override:   {0}".format("YES (see '../dependency_overrides.json')" if d.has_overrides else 'no'))
+            if verbose:
+                print("    all keys:")
+                for key in sorted(row):
+                    self._print_value("        {0} = ".format(key), row[key], width)
+            print("")
+
+    def _print_value(self, prefix, value, width):
+        if not isinstance(value, PerCombination):
+            print("{0}{1!r}".format(prefix, value))
+            return
+        print(prefix.rstrip())
+        indent = ' ' * (len(prefix) - len(prefix.lstrip()) + 4)
+        for label, combination_value in value.items():
+            print("{0}{1:<{2}} {3!r}".format(indent, label + ':', width, combination_value))
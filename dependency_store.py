@@ -0,0 +1,249 @@
+"""Per-machine store of unpacked dependency trees, shared between workspaces"""
+import json
+import os
+import platform
+import shutil
+import stat
+import time
+import archive_cache
+import archives
+from userlocks import FileLock
+
+kStoreDirEnv     = 'OHDEVTOOLS_STORE_DIR'
+kMetaFilename    = 'meta.json'
+kTreeDirname     = 'tree'
+kTempSuffix      = '.tmp'
+kLockSuffix      = '.lock'
+kDefaultMaxAge   = 30       # days
+kFICLONE         = 0x40049409
+
+
+def default_store_dir():
+    return os.environ.get(kStoreDirEnv) or os.path.join(archive_cache.default_cache_root(), 'store')
+
+
+class DependencyStore(object):
+    """Each (archive, version) is unpacked once into a read-only entry in the store,
+    and workspaces are populated from it with reflinks (where the filesystem
+    supports them) or, failing those, copies - so workspace files are their own,
+    and writable as unpacked.
+
+    With hardlink set, files are hardlinked rather than copied where reflinks
+    aren't supported. That saves space, but workspace files then share their
+    contents (and permissions) with the store: they are read-only, and anything
+    which writes to one anyway (e.g. as root) damages the store entry for every
+    workspace. Entries are checked against their recorded file table before
+    being used, and damaged ones are unpacked afresh.
+
+    On Windows, where a read-only file can't be deleted, files in the store are
+    left writable so that workspaces can still be cleaned."""
+
+    def __init__(self, root=None, hardlink=False):
+        self.root = root or default_store_dir()
+        self.hardlink = hardlink
+        self.read_only = platform.system() != 'Windows'
+        self.reflink = platform.system() == 'Linux'
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+
+    @staticmethod
+    def supports(remote_path):
+        return os.path.splitext(remote_path)[1].upper() != '.SH'
+
+    @staticmethod
+    def key(remote_path, info):
+        return archive_cache.ArchiveCache.key(remote_path, info.get('etag', ''), info.get('size', 0))
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def contains(self, key):
+        return os.path.isfile(os.path.join(self.entry_dir(key), kMetaFilename))
+
+    def populate(self, key, remote_path, unpack):
+        """Unpack an archive into the store (unless another workspace already has),
+        by calling unpack(directory) - which returns a dict of extra metadata to
+        record for the entry (e.g. the archive hash), or None on failure"""
+        with FileLock(self.entry_dir(key) + kLockSuffix):
+            if self.contains(key):
+                return True
+            tmpdir = self.entry_dir(key) + kTempSuffix
+            if os.path.exists(tmpdir):
+                archives.rmtree(tmpdir)
+            tree = os.path.join(tmpdir, kTreeDirname)
+            os.makedirs(tree)
+            extra = unpack(tree)
+            if extra is None:
+                archives.rmtree(tmpdir)
+                return False
+            files = {}
+            for dirpath, _dirnames, filenames in os.walk(tree):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        continue
+                    st = os.stat(path)
+                    files[os.path.relpath(path, tree).replace('\\', '/')] = [st.st_size, st.st_mode & 0o7777, archives.hash_file(path), int(st.st_mtime)]
+                    if self.read_only:
+                        os.chmod(path, st.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            meta = {'archive': remote_path, 'created': time.time(), 'used': time.time(), 'files': files}
+            meta.update(extra)
+            with open(os.path.join(tmpdir, kMetaFilename), 'wt') as f:
+                json.dump(meta, f)
+            os.rename(tmpdir, self.entry_dir(key))
+        return True
+
+    def materialise(self, key, dest):
+        """Fill dest from the store entry. Returns (table, reflinked, hardlinked, copied)
+        where table maps each file's path (relative to dest) to [size, mtime, sha1]"""
+        tree = os.path.join(self.entry_dir(key), kTreeDirname)
+        counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+        table = {}
+        with FileLock(self.entry_dir(key) + kLockSuffix):
+            meta = self._load_meta(key)
+            for dirpath, dirnames, filenames in os.walk(tree):
+                rel = os.path.relpath(dirpath, tree)
+                target_dir = os.path.normpath(os.path.join(dest, rel))
+                if not os.path.isdir(target_dir):
+                    os.makedirs(target_dir)
+                for name in dirnames:
+                    src = os.path.join(dirpath, name)
+                    if os.path.islink(src):
+                        self._symlink(src, os.path.join(target_dir, name))
+                        table[os.path.relpath(src, tree).replace('\\', '/')] = [None, None, None]
+                for name in filenames:
+                    src = os.path.join(dirpath, name)
+                    dst = os.path.join(target_dir, name)
+                    rel = os.path.relpath(src, tree).replace('\\', '/')
+                    if os.path.islink(src):
+                        self._symlink(src, dst)
+                        table[rel] = [None, None, None]
+                        continue
+                    size, mode, digest = meta['files'].get(rel, [0, None, None])[:3]
+                    counts[self._link(src, dst, mode)] += 1
+                    table[rel] = [size, int(os.path.getmtime(dst)), digest]
+            meta['used'] = time.time()
+            self._save_meta(key, meta)
+        return table, counts['reflink'], counts['hardlink'], counts['copy']
+
+    def archive_hash(self, key):
+        return self._load_meta(key).get('archive-sha256')
+
+    def check(self, key, full=False):
+        """Check an entry against its recorded file table - returns a description
+        of the first problem found, or None if it is intact. Only the sizes and
+        modification times are compared (enough to catch a write through a
+        hardlink) unless full is set, when every file is hashed."""
+        with FileLock(self.entry_dir(key) + kLockSuffix):
+            meta = self._load_meta(key)
+            tree = os.path.join(self.entry_dir(key), kTreeDirname)
+            for rel, recorded in sorted(meta.get('files', {}).items()):
+                size, digest = recorded[0], recorded[2]
+                mtime = recorded[3] if len(recorded) > 3 else None     # not recorded by older versions
+                path = os.path.join(tree, rel)
+                try:
+                    st = os.stat(path)
+                    if st.st_size != size or (mtime is not None and int(st.st_mtime) != mtime):
+                        return 'modified: %s' % rel
+                    if full and archives.hash_file(path) != digest:
+                        return 'modified: %s' % rel
+                except OSError:
+                    return 'missing: %s' % rel
+        return None
+
+    def verify(self, repair=True):
+        """Check every entry against its recorded file table. Damaged entries are
+        removed (if repair is set) so that they are unpacked afresh when next
+        needed. Returns list of (key, archive, problem) for damaged entries."""
+        damaged = []
+        for key in self.keys():
+            problem = self.check(key, full=True)
+            if problem:
+                damaged.append((key, self._load_meta(key).get('archive'), problem))
+                if repair:
+                    self.remove(key)
+        return damaged
+
+    def gc(self, max_age_days=kDefaultMaxAge):
+        """Remove entries not used by any workspace for max_age_days, and any
+        abandoned partial entries. Returns number of entries removed."""
+        removed = 0
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(kTempSuffix) and os.path.getmtime(path) < time.time() - 24 * 60 * 60:
+                archives.rmtree(path)
+        for key in self.keys():
+            if self._load_meta(key).get('used', 0) < cutoff:
+                self.remove(key)
+                removed += 1
+        return removed
+
+    def keys(self):
+        return [name for name in os.listdir(self.root) if self.contains(name)]
+
+    def remove(self, key):
+        with FileLock(self.entry_dir(key) + kLockSuffix):
+            archives.rmtree(self.entry_dir(key))
+        try:
+            os.unlink(self.entry_dir(key) + kLockSuffix)
+        except OSError:
+            pass
+
+    def _link(self, src, dst, mode):
+        if os.path.lexists(dst):
+            try:
+                os.unlink(dst)
+            except OSError:
+                os.chmod(dst, stat.S_IWRITE)
+                os.unlink(dst)
+        if self.reflink:
+            try:
+                self._reflink(src, dst)
+                if mode is not None:
+                    os.chmod(dst, mode)
+                return 'reflink'
+            except (IOError, OSError):
+                # not supported by this filesystem - don't keep trying
+                self.reflink = False
+                if os.path.exists(dst):
+                    os.unlink(dst)
+        if self.hardlink:
+            try:
+                os.link(src, dst)
+                return 'hardlink'
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+        if mode is not None:
+            os.chmod(dst, mode)
+        return 'copy'
+
+    @staticmethod
+    def _reflink(src, dst):
+        import fcntl
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), kFICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+
+    @staticmethod
+    def _symlink(src, dst):
+        if os.path.lexists(dst):
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                return
+            os.unlink(dst)
+        os.symlink(os.readlink(src), dst)
+
+    def _load_meta(self, key):
+        with open(os.path.join(self.entry_dir(key), kMetaFilename), 'rt') as f:
+            return json.load(f)
+
+    def _save_meta(self, key, meta):
+        filename = os.path.join(self.entry_dir(key), kMetaFilename)
+        with open(filename + kTempSuffix, 'wt') as f:
+            json.dump(meta, f)
+        os.replace(filename + kTempSuffix, filename)
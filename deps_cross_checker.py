@@ -1,96 +1,204 @@
 """Class to perform cross check of dependency versions"""
 import json
 import os
+import fetch_manifest
+import version
 
-kDepsFilename = 'dependencies.json'
-kDepsPath     = 'dependencies'
-kProjDataPath = 'projectdata'
+kDepsFilename   = 'dependencies.json'
+kDepsPath       = 'dependencies'
+kProjDataPath   = 'projectdata'
+kManifestPath   = os.path.join( kDepsPath, 'loadedDeps.json' )
+kReportPath     = os.path.join( kDepsPath, 'crossCheck.json' )
+kCachePath      = os.path.join( kDepsPath, 'crossCheckCache.json' )
+kCacheFormat    = 1
+kAnyPlatform    = 'AnyPlatform'
 
 
 class DepsCrossChecker:
-    """Ensure version consistency (at major.minor level) across all dependencies"""
+    """Ensure version consistency (at major.minor level) across all dependencies.
+    The versions used by each project (projectdata and each fetched dependency
+    with a bundled dependencies file) are collected into one index, dependency
+    name -> {version: [projects]}, and any dependency with more than one version
+    is reported."""
 
-    def __init__( self, aTargetPlatform=None ):
-        """Initialise class data"""
+    def __init__( self, aTargetPlatform, aCache, aMatrix=None ):
+        """Initialise class data - aCache is the VersionCache to read dependencies files
+        through (may be shared by checkers). aMatrix, if given, is the dependency_matrix.DependencyMatrix
+        of projectdata (as fetched), to read its versions from rather than re-reading the file."""
         self.targetPlatform = aTargetPlatform
-        self.failures  = 0
-        self.artifacts = {}
+        self.matrix = aMatrix
+        self.cache = aCache
+        self.failures = 0
+        self.projects = []
+        self.index    = {}      # dependency name -> {version: [names of the projects using it]}
+        self.reported = set()   # names of the dependencies whose conflicts have been printed
 
     def execute( self ):
-        """Perform the check - return zero on success, number of mismatches on failure"""
+        """Perform the check - return zero on success, number of dependencies with conflicting versions on failure"""
         print('Cross-checking dependency versions')
-        print('  Finding %s dependency definition files...' % kDepsFilename)
-        for root, _dirs, files in os.walk( os.path.join( os.getcwd(), kDepsPath )):
-            for name in files:
-                if name == kDepsFilename:
-                    if self.targetPlatform in root or 'AnyPlatform' in root:
-                        self.artifacts[os.path.basename( root )] = self.parse_json( os.path.join( root, kDepsFilename ), self.targetPlatform)
-        self.artifacts['projectdata'] = self.parse_json( os.path.join( kProjDataPath, kDepsFilename ), self.targetPlatform)
-
-        projects = list( self.artifacts )
-        while len(projects):
-            project1 = projects[0]
-            for project2 in projects:
-                if project1 != project2:
-                    self.check_versions( project1, project2 )
-            projects.remove( project1 )
+        misses, hits = self.cache.misses, self.cache.hits
+        self.add( 'projectdata', self.projectdata_versions() )
+        for root in self.artifact_roots():
+            self.add( os.path.basename( root ), self.cache.versions( os.path.join( root, kDepsFilename ), self.targetPlatform ))
+        self.cache.save()
+        conflicts = self.conflicts()
+        for name in sorted( conflicts ):
+            self.print_conflict( name )
+        self.failures = len( conflicts )
+        print('  Checked %d dependencies of %d projects (%d files read, %d unchanged) - %d with conflicting versions' % (
+            len( self.index ), len( self.projects ), self.cache.misses - misses, self.cache.hits - hits, self.failures))
         return self.failures
 
-    def check_versions( self, aProject1, aProject2 ):
-        """Perform comparison between 2 specified projects"""
-        print('    Checking %s against %s' % (aProject1, aProject2))
-        for dependency in self.artifacts[aProject1]:
-            if dependency in self.artifacts[aProject2]:
-                version1 = self.artifacts[aProject1][dependency]
-                version2 = self.artifacts[aProject2][dependency]
-                if version1 == version2:
-                    print('      %-16s %6s        --> OK' % (dependency.decode(), version1.decode()))
-                else:
-                    self.failures += 1
-                    print('      %-16s %6s/%-6s --> FAILED' % (dependency.decode(), version1.decode(), version2.decode()))
-                    print('%s != %s' % (version1, version2))
+    def artifact_roots( self ):
+        """Directories of the fetched dependencies (for the target platform, or
+        AnyPlatform) with a dependencies file - those recorded in the fetched
+        dependency manifest or, without one, the directories in each dest"""
+        roots = [key for key, _entry in fetch_manifest.FetchManifest( kManifestPath ).items()]
+        if not roots and os.path.isdir( kDepsPath ):
+            for dest in sorted( os.listdir( kDepsPath )):
+                # (hidden directories are for staging and trash, not dependencies)
+                if os.path.isdir( os.path.join( kDepsPath, dest )) and not dest.startswith( '.' ):
+                    roots.extend( os.path.join( kDepsPath, dest, name ) for name in sorted( os.listdir( os.path.join( kDepsPath, dest ))) if not name.startswith( '.' ))
+        return [root for root in sorted( roots )
+                if (self.targetPlatform in root or kAnyPlatform in root) and os.path.isfile( os.path.join( root, kDepsFilename ))]
+
+    def projectdata_versions( self ):
+        """Versions from projectdata (from the matrix, if one was given)"""
+        if self.matrix is not None:
+            return self.versions( self.matrix, self.matrix.index( self.targetPlatform ))
+        filename = os.path.join( kProjDataPath, kDepsFilename )
+        if not os.path.exists( filename ):
+            return {}
+        return self.cache.versions( filename, self.targetPlatform )
+
+    def add( self, aProject, aVersions ):
+        """Add the versions used by a project to the index - return the names of
+        the dependencies it gives a conflicting version"""
+        self.projects.append( aProject )
+        conflicting = []
+        for name, ver in aVersions.items():
+            versions = self.index.setdefault( name, {} )
+            if versions and ver not in versions:
+                conflicting.append( name )
+            versions.setdefault( ver, [] ).append( aProject )
+        return conflicting
+
+    def begin( self ):
+        """Start an incremental check (see add_fetched) from the versions in projectdata"""
+        self.add( 'projectdata', self.projectdata_versions() )
+
+    def add_fetched( self, aPath ):
+        """Check the dependencies file (aPath) bundled with a dependency just fetched
+        against all those seen so far, if execute() would include it - return the
+        number of conflicts found"""
+        root = os.path.dirname( aPath )
+        if not os.path.isfile( aPath ) or not (self.targetPlatform in root or kAnyPlatform in root):
+            return 0
+        return self.add_project( os.path.basename( root ), self.cache.versions( aPath, self.targetPlatform ))
+
+    def add_project( self, aProject, aVersions ):
+        """Add the versions of a project, reporting any that conflict with those
+        of the projects added so far - return the number of conflicts found"""
+        conflicting = self.add( aProject, aVersions )
+        for name in conflicting:
+            self.print_conflict( name )
+        self.failures += len( conflicting )
+        return len( conflicting )
+
+    def conflicts( self ):
+        """Dependencies with more than one version - name -> {version: [projects]}"""
+        return dict( (name, versions) for name, versions in self.index.items() if len( versions ) > 1 )
+
+    def print_conflict( self, aName ):
+        """Print the versions of a conflicting dependency, unless already printed"""
+        if aName in self.reported:
+            return
+        self.reported.add( aName )
+        print('    %-20s --> FAILED' % aName)
+        for ver, projects in sorted( self.index[aName].items() ):
+            print('      %-8s used by %s' % (ver, ', '.join( projects )))
+
+    def report( self ):
+        """Result of the check, for the JSON conflict report"""
+        return {
+            'platform': self.targetPlatform,
+            'projects': self.projects,
+            'dependencies': len( self.index ),
+            'conflicts': self.conflicts()}
 
     @staticmethod
-    def parse_json( aPath, aTargetPlatform ):
-        """Read and parse the JSON dependencies file"""
+    def versions( aMatrix, aIndex ):
+        """Versions (to major.minor) of the dependencies to cross-check in one combination of aMatrix"""
         deps = {}
-        if os.path.exists( aPath ):
-            f = open( aPath, 'rt' )
-            items = json.load( f )
-            f.close()
-            for item in items:
-                try:
-                    xCheck = True
-                    if 'cross-check' in item:
-                        xCheck = item['cross-check']
-                    if xCheck:
-                        name = item['name'].encode( 'ascii' )
-                        vers =  item['version']
-                        if '${' in vers and '}' in vers:
-                            st = vers.index('${')
-                            end = vers.index('}', st)
-                            token = vers[(st+2):end]   
-                            if '[' in token:
-                                keystart = token.index('[')
-                                keyend = token.index(']', keystart)
-                                table = item[token[:keystart]]
-                                keyvar = token[keystart+2:keyend]
-                                if keyvar == 'platform':
-                                    key = aTargetPlatform
-                                else:               
-                                    key = item[keyvar]
-                                if key not in table and '*' in table:
-                                    val = table['*']
-                                else: 
-                                    val = table[key]
-                                vers = vers[:st] + val + vers[(end+1):]
-                            else:
-                                vers = vers[:st] + item[token] + vers[(end+1):]
-                       
-                        # TODO: maybe don't discard minor version here/make optional
-                        ver = '.' . join( vers.split( '.' )[:-1] ).encode( 'ascii' )
-                        deps[name] = ver
-                except Exception as e:
-                    print("Warning: %s(%s)" % (e.__class__.__name__, e))
-                    pass
+        column, errors = aMatrix.column( aIndex, ('version', 'cross-check') )
+        for name, e in errors.items():
+            print("Warning: %s(%s)" % (e.__class__.__name__, e))
+        for name, values in column.items():
+            if name in errors or 'version' not in values or not values.get( 'cross-check', True ):
+                continue
+            # TODO: maybe don't discard minor version here/make optional
+            deps[str( name )] = '.' . join( str( values['version'] ).split( '.' )[:-1] )
         return deps
+
+
+class VersionCache:
+    """Versions read from dependencies files (by aRead, given the path and target
+    platform - see dependencies.read_cross_check_versions), kept in kCachePath
+    between fetches. Entries are keyed by target platform and
+    path, and are only used while the file's size, mtime and ctime (and the
+    version of ohDevTools) are unchanged - so an unchanged tree is checked
+    without parsing any of them. The ctime catches a file replaced by a fetch
+    with one of the same size, as archives often have fixed mtimes."""
+
+    def __init__( self, aRead, aPath=kCachePath ):
+        self.read    = aRead
+        self.path    = aPath
+        self.entries = {}       # '<platform>|<path>' -> {'size', 'mtime', 'ctime', 'versions'}
+        self.changed = False
+        self.hits    = 0
+        self.misses  = 0
+        try:
+            with open( aPath, 'rt' ) as f:
+                cache = json.load( f )
+            if cache.get( 'format' ) == kCacheFormat and cache.get( 'ohdevtools-version' ) == version.VERSION:
+                self.entries = cache['entries']
+        except (IOError, OSError, ValueError):
+            pass
+
+    def versions( self, aPath, aTargetPlatform ):
+        """Versions from the dependencies file at aPath, parsed only if it has changed"""
+        st = os.stat( aPath )
+        key = '%s|%s' % (aTargetPlatform, os.path.normpath( aPath ))
+        entry = self.entries.get( key )
+        if entry is not None and [entry['size'], entry['mtime'], entry['ctime']] == [st.st_size, st.st_mtime_ns, st.st_ctime_ns]:
+            self.hits += 1
+            return dict( entry['versions'] )
+        self.misses += 1
+        versions = self.read( aPath, aTargetPlatform )
+        self.entries[key] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'ctime': st.st_ctime_ns, 'versions': versions}
+        self.changed = True
+        return dict( versions )
+
+    def save( self ):
+        """Write the cache (if changed), dropping the entries of files that no longer exist"""
+        stale = [key for key in self.entries if not os.path.exists( key.split( '|', 1 )[1] )]
+        for key in stale:
+            del self.entries[key]
+        if not (self.changed or stale) or not os.path.isdir( os.path.dirname( self.path )):
+            return
+        tmpname = self.path + '.tmp'
+        with open( tmpname, 'wt' ) as f:
+            json.dump( {'format': kCacheFormat, 'ohdevtools-version': version.VERSION, 'entries': self.entries}, f )
+        os.replace( tmpname, self.path )
+        self.changed = False
+
+
+def write_report( aReports, aPath=kReportPath ):
+    """Write the reports of the checks made (platform -> DepsCrossChecker.report())
+    as JSON to aPath - if its directory exists"""
+    if not os.path.isdir( os.path.dirname( aPath )):
+        return
+    with open( aPath, 'wt' ) as f:
+        json.dump( aReports, f, indent=4, sort_keys=True )
+    if [report for report in aReports.values() if report['conflicts']]:
+        print('  Conflict report written to %s' % aPath)
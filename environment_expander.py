@@ -0,0 +1,285 @@
+"""Expansion of the values in dependency environments - the ${...} templates
+(compiled once and shared), the expanders that evaluate them, and the base
+environment for a platform. Shared by dependencies and dependency_matrix."""
+import os
+import re
+from default_platform import default_platform
+
+
+# A string value from a dependency environment is compiled (see compile_template)
+# into a tree of the template nodes below, each of which has an evaluate(expander)
+# method giving its value against any expander. Errors in the ${...} syntax are
+# raised when the node is evaluated, as they were when values were parsed on
+# each expansion.
+
+class Literal(object):
+    """Text with no expansions"""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def evaluate(self, expander):
+        return self.text
+
+
+class Var(object):
+    """$key or ${key}"""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def evaluate(self, expander):
+        return expander.expand(self.key)
+
+
+class Lookup(object):
+    """${table[key]} or ${table[$key]} - the table's '*' entry is the default"""
+    __slots__ = ('tablename', 'keyname')
+
+    def __init__(self, tablename, keyname):
+        self.tablename = tablename
+        self.keyname = keyname
+
+    def evaluate(self, expander):
+        table = expander.expand(self.tablename)
+        if self.keyname.startswith('$'):
+            key = expander.expand(self.keyname[1:])
+        else:
+            key = self.keyname
+        if not isinstance(table, dict):
+            raise ValueError("lookup table must expand to a JSON object (got {0!r} instead)".format(table))
+        if not isinstance(key, ("".__class__, u"".__class__)):
+            raise ValueError("lookup index must expand to a JSON string (got {0!r} instead)".format(key))
+        if key not in table:
+            if '*' in table:
+                return table['*']
+            raise KeyError("Key not in table, and no default '*' entry found: key={0!r}\ntable={1!r}".format(key, table))
+        return table[key]
+
+
+class Cond(object):
+    """${condition?result:alternative} - an undefined condition is false"""
+    __slots__ = ('condition', 'primary', 'alternative')
+
+    def __init__(self, condition, primary, alternative):
+        self.condition = condition
+        self.primary = primary
+        self.alternative = alternative
+
+    def evaluate(self, expander):
+        try:
+            conditionvalue = expander.expand(self.condition)
+        except KeyError:
+            conditionvalue = False
+        if expander.is_trueish(conditionvalue):
+            return expander.expand(self.primary)
+        return expander.expand(self.alternative)
+
+
+class Concat(object):
+    """Literal text with expansions embedded - each must expand to a string"""
+    __slots__ = ('parts',)
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def evaluate(self, expander):
+        result = []
+        for part in self.parts:
+            value = part.evaluate(expander)
+            if not isinstance(value, ("".__class__, u"".__class__)):
+                raise TypeError("expected str instance, {0} found (expanding {1!r})".format(type(value).__name__, value))
+            result.append(value)
+        return ''.join(result)
+
+
+class Invalid(object):
+    """Malformed ${...} - raises only if it is expanded"""
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def evaluate(self, expander):
+        raise ValueError(self.message)
+
+
+_compiled_templates = {}
+
+
+def compile_template(value):
+    """Compile (or fetch from the cache) the template for string value. The
+    templates of each dependency type are shared by all dependencies of that
+    type, so each distinct string is only parsed once."""
+    template = _compiled_templates.get(value)
+    if template is None:
+        template = _compiled_templates[value] = _compile_template(value)
+    return template
+
+
+def _compile_template(value):
+    regex = EnvironmentExpander.template_regex
+    firstmatch = regex.match(value)
+    if firstmatch is not None and firstmatch.group(0) == value and value != "$$":
+        # Special case: The entire string is a single expansion. In this case,
+        # we allow the expansion to be *anything* (bool, int, list...),
+        # not just a string.
+        return _compile_match(firstmatch)
+    parts = []
+    pos = 0
+    for match in regex.finditer(value):
+        if match.start() > pos:
+            parts.append(Literal(value[pos:match.start()]))
+        parts.append(_compile_match(match))
+        pos = match.end()
+    if not parts:
+        return Literal(value)
+    if pos < len(value):
+        parts.append(Literal(value[pos:]))
+    return Concat(parts)
+
+
+def _compile_match(match):
+    if match.group('dollar'):
+        return Literal('$')
+    if match.group('word'):
+        key = match.group('word')[1:]
+    else:
+        key = match.group('parens')[2:-1]
+    key = key.strip()
+    if '[' in key:
+        index = EnvironmentExpander.index_regex.match(key)
+        if index is None:
+            return Invalid('lookup must be of form ${table[key]}')
+        return Lookup(index.group(1).strip(), index.group(2).strip())
+    if '?' in key:
+        condition, rest = key.split('?', 1)
+        if ':' not in rest:
+            return Invalid('conditional must be of form ${condition?result:alternative}')
+        primary, alternative = rest.split(':', 1)
+        return Cond(condition.strip(), primary.strip(), alternative.strip())
+    return Var(key)
+
+
+class EnvironmentExpander(object):
+    # template_regex matches
+    template_regex = re.compile(r"""(?x)    # Enable whitespace and comments
+        (?P<dollar>\$\$)|                   # Match $$
+        (?P<word>\$[a-zA-Z_][a-zA-Z_0-9]*)| # Match $word
+        (?P<parens>\$\{[^}]*\})             # Match ${any-thing}
+        """)
+    # Matches foo[bar]
+    index_regex = re.compile(r"""(?x)       # Enable whitespace and comments
+        ^                                   # Match only at start of string
+        ([^][]*)                            # Match table name (no brackets allowed)
+        \[                                  # Match one open bracket: [
+        ([^][]*)                            # Match key (no brackets allowed)
+        \]                                  # Match one close bracket: ]
+        $
+        """)
+
+    __slots__ = ('env_dict', 'cache', 'expandset')
+
+    def __init__(self, env_dict):
+        self.env_dict = env_dict
+        self.cache = {}
+        self.expandset = set()
+
+    def __getitem__(self, key):
+        return self.expand(key)
+
+    def getraw(self, key):
+        return self.env_dict[key]
+
+    def __contains__(self, key):
+        return key in self.env_dict
+
+    def keys(self):
+        return self.env_dict.keys()
+
+    def values(self):
+        return [self.expand(key) for key in self.keys()]
+
+    def items(self):
+        return [(key, self.expand(key)) for key in self.keys()]
+
+    def expand(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        if key in self.expandset:
+            raise ValueError("Recursive expansion for key:", key)
+        self.expandset.add(key)
+        result = self._expand(key)
+        self.cache[key] = result
+        self.expandset.remove(key)
+        return result
+
+    def _expand(self, key):
+        if key not in self.env_dict:
+            raise KeyError("Key undefined:", key)
+        value = self.env_dict[key]
+        return self._expandvalue(value)
+
+    def _expandvalue(self, value):
+        if isinstance(value, ("".__class__, u"".__class__)):
+            return self.expandstring(value)
+        elif isinstance(value, (list, tuple)):
+            return [self._expandvalue(x) for x in value]
+        elif isinstance(value, dict):
+            return dict((k, self._expandvalue(v)) for (k, v) in value.items())
+        return value
+
+    def expandstring(self, value):
+        return compile_template(value).evaluate(self)
+
+    @staticmethod
+    def is_trueish(value):
+        if hasattr(value, "upper"):
+            value = value.upper()
+        return value in [1, "1", "YES", "Y", "TRUE", "ON", True]
+
+
+class LockedExpander(EnvironmentExpander):
+    """Expander over the values recorded in a lockfile - already expanded, so
+    they are returned as they are"""
+    __slots__ = ()
+
+    def _expandvalue(self, value):
+        return value
+
+
+def platform_env(platform, env):
+    """Set platform (default the host's) in env, with its system, architecture
+    and distro, checking that it is supported. Returns env."""
+    if platform is not None:
+        env['platform'] = None
+        fName = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'platforms.txt')
+        f = open(fName, 'rt')
+        supported = f.readlines()
+        f.close()
+        for entry in supported:
+            if platform in entry:
+                env['platform'] = platform
+        if not env['platform']:
+            raise Exception('Platform not supported (%s) - see %s for list of supported platforms' % (platform, fName))
+    if 'platform' not in env:
+        env['platform'] = default_platform()
+    platform = env['platform']
+    if platform is None:
+        raise Exception('Platform not specified and unable to guess.')
+    if '-' in platform:
+        components = platform.split('-')
+        if len(components) == 2:
+            env['system'], env['architecture'] = components
+        elif len(components) == 3:
+            env['architecture'], env['distro'], env['system'] = components
+        else:
+            print("Unexpected platform format '%s'" % platform)
+    return env
+
+
+def lock_key(env):
+    """Lockfile section for the platform and debugmode of env"""
+    return '%s/%s' % (env['platform'], str(env.get('debugmode', 'Release')).title())
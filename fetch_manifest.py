@@ -0,0 +1,257 @@
+"""Record of the dependencies unpacked into a workspace (dependencies/loadedDeps.json)"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import archives
+
+kManifestFormat = 2
+kJournalSuffix  = '.journal'
+
+
+class FetchManifest(object):
+    """Manifest of fetched dependencies, keyed by '<dest>/<name>'.
+
+    Each entry records the full archive path, the archive's SHA-256 (and, for
+    local archives, its size/mtime), whether extraction completed, and a table
+    of the files unpacked (relative to dest) with their size, mtime and SHA-1.
+
+    Changes are appended to a journal next to the manifest as they happen - an
+    entry is marked incomplete before extraction starts and complete only once
+    it has finished - so an interrupted fetch is never mistaken for a
+    finished one. save() folds the journal into the manifest, which is
+    replaced atomically."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal_filename = filename + kJournalSuffix if filename else None
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.entries = {}
+        if not self.filename:
+            return
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename, 'rt') as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and data.get('format') == kManifestFormat:
+                    self.entries = data['dependencies']
+                # else: legacy manifest recording only archive basenames - not
+                # enough to be sure what is unpacked, so start afresh
+            except (IOError, OSError, ValueError):
+                print("Error with current fetched dependency file: %s" % self.filename)
+        if os.path.isfile(self.journal_filename):
+            with open(self.journal_filename, 'rt') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break       # torn final write from an interrupted fetch
+                    self._apply(record)
+
+    def _apply(self, record):
+        op = record['op']
+        key = record['key']
+        if op == 'begin':
+            self.entries[key] = {'archive': record['archive'], 'complete': False, 'files': {}}
+        elif op == 'complete':
+            self.entries[key] = record['entry']
+        elif op == 'damaged':
+            if key in self.entries:
+                self.entries[key]['complete'] = False
+        elif op == 'remove':
+            self.entries.pop(key, None)
+
+    def _record(self, record):
+        with self.lock:
+            self._apply(record)
+            if not self.journal_filename:
+                return
+            dirname = os.path.dirname(self.journal_filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.journal_filename, 'at') as f:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def items(self):
+        return list(self.entries.items())
+
+    def begin(self, key, archive):
+        self._record({'op': 'begin', 'key': key, 'archive': archive})
+
+    def complete(self, key, archive, dest, archive_sha256, files, archive_id=None):
+        entry = {
+            'archive': archive,
+            'archive-sha256': archive_sha256,
+            'archive-id': archive_id,
+            'dest': dest,
+            'complete': True,
+            'fetched': time.time(),
+            'files': files}
+        self._record({'op': 'complete', 'key': key, 'entry': entry})
+
+    def mark_damaged(self, key):
+        self._record({'op': 'damaged', 'key': key})
+
+    def remove(self, key):
+        self._record({'op': 'remove', 'key': key})
+
+    def uninstall(self, key, keep=()):
+        """Remove the files unpacked for key (other than any also unpacked by
+        the entries in keep) and any directories left empty, and forget the
+        entry. The files of an incomplete entry aren't known, so its
+        '<dest>/<name>' tree is removed instead. Returns number of files removed."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return 0
+        removed = 0
+        if not entry.get('complete'):
+            tree = os.path.abspath(key)
+            if os.path.isdir(tree):
+                removed = sum(len(files) for _d, _s, files in os.walk(tree))
+                archives.rmtree(tree)
+        else:
+            base = os.path.abspath(entry['dest'])
+            shared = set()
+            for other in keep:
+                other_entry = self.entries.get(other)
+                if other_entry and os.path.abspath(other_entry.get('dest', '')) == base:
+                    shared.update(other_entry['files'])
+            directories = set()
+            locked = []
+            for rel in entry['files']:
+                if rel in shared:
+                    continue
+                path = os.path.join(base, rel)
+                try:
+                    _remove_file(path)
+                    removed += 1
+                except OSError:
+                    if os.path.lexists(path):
+                        locked.append(path)
+                directories.add(os.path.dirname(path))
+            if locked:
+                for path in locked:
+                    print('Locked file:- ', path)
+                raise Exception('Failed to clean dependency %s\n' % key)
+            _prune_empty(directories, base)
+        self.remove(key)
+        return removed
+
+    def is_current(self, key, archive):
+        """True if archive is known to be completely unpacked for key. Remote
+        archive paths are versioned, so only the path is compared. A local
+        archive (e.g. an override pointing at a build output) is checked by
+        size/mtime, falling back to its hash if those have changed."""
+        entry = self.entries.get(key)
+        if entry is None or not entry.get('complete') or entry.get('archive') != archive:
+            return False
+        if archive.startswith('s3:'):
+            return True
+        try:
+            archive_id = local_archive_id(archive)
+        except OSError:
+            return False
+        if archive_id == entry.get('archive-id'):
+            return True
+        if archives.hash_file(archive, 'sha256') != entry.get('archive-sha256'):
+            return False
+        entry['archive-id'] = archive_id
+        return True
+
+    def verify(self, jobs=None, keys=None):
+        """Check the files of each complete entry against the recorded table (in
+        parallel), marking entries with missing or altered files as damaged so
+        that the next fetch unpacks them again. Returns {key: [problems]}."""
+        checks = []
+        for key, entry in self.entries.items():
+            if entry.get('complete') and (keys is None or key in keys):
+                base = os.path.abspath(entry['dest'])
+                for rel, expected in entry['files'].items():
+                    checks.append((key, os.path.join(base, rel), rel, expected))
+        with ThreadPoolExecutor(jobs or archives.default_jobs()) as pool:
+            results = list(pool.map(lambda check: self._check_file(*check[1:]), checks))
+        damaged = {}
+        for (key, _path, _rel, _expected), problem in zip(checks, results):
+            if problem:
+                damaged.setdefault(key, []).append(problem)
+        for key in damaged:
+            self.mark_damaged(key)
+        return damaged
+
+    @staticmethod
+    def _check_file(path, rel, expected):
+        size, mtime, digest = expected
+        if size is None:
+            # link - only check it is still there
+            return None if os.path.lexists(path) else 'missing: %s' % rel
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing: %s' % rel
+        if st.st_size != size:
+            return 'size changed: %s' % rel
+        if int(st.st_mtime) != mtime and digest is not None and archives.hash_file(path) != digest:
+            return 'modified: %s' % rel
+        return None
+
+    def save(self):
+        """Fold the journal into the manifest file (replaced atomically)"""
+        if not self.filename:
+            return
+        with self.lock:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'wt') as f:
+                json.dump({'format': kManifestFormat, 'dependencies': self.entries}, f)
+            os.replace(tmpname, self.filename)
+            if os.path.exists(self.journal_filename):
+                os.unlink(self.journal_filename)
+
+    def delete(self):
+        for filename in (self.filename, self.journal_filename):
+            try:
+                os.unlink(filename)
+            except (OSError, TypeError):
+                pass
+        self.entries = {}
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        if not os.path.lexists(path):
+            return
+        # read-only (Windows) or in a read-only directory
+        archives.make_writable(os.unlink, path, None)
+
+
+def _prune_empty(directories, base):
+    """Remove any of directories (and their parents, up to base) left empty"""
+    for dirname in sorted(directories, key=len, reverse=True):
+        while dirname != base and dirname.startswith(base + os.sep):
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                break       # not empty, or already gone
+            dirname = os.path.dirname(dirname)
+
+
+def local_archive_id(path):
+    st = os.stat(path)
+    return '%d:%d' % (st.st_size, int(st.st_mtime))
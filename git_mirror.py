@@ -0,0 +1,122 @@
+"""Per-machine cache of bare git mirrors, shared by release scripts"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import archive_cache
+from userlocks import FileLock
+
+kMirrorDirEnv    = 'OHDEVTOOLS_GIT_MIRROR_DIR'
+kMirrorSuffix    = '.git'
+kLockSuffix      = '.lock'
+
+
+def default_mirror_dir():
+    return os.environ.get(kMirrorDirEnv) or os.path.join(archive_cache.default_cache_root(), 'git-mirrors')
+
+
+class GitMirrorCache(object):
+    """Each repository URL has a bare mirror (git clone --mirror) in the cache,
+    brought up to date with an incremental 'git fetch' before each use, rather
+    than being cloned afresh. Files are read from it with 'git show', tags
+    are pushed straight from it, and commits are made in a temporary worktree
+    of it - so nothing is ever cloned twice.
+
+    Everything done with a mirror is done under its lock file, so separate
+    scripts (and threads) can share the cache. Pushes always name the URL and
+    the refs to update, so the mirror's own refs are only ever updated by
+    fetching."""
+
+    def __init__(self, root=None):
+        self.root = root or default_mirror_dir()
+
+    def path(self, url):
+        """Directory of the mirror of url"""
+        name = os.path.basename(url.rstrip('/'))
+        if name.endswith(kMirrorSuffix):
+            name = name[:-len(kMirrorSuffix)]
+        return os.path.join(self.root, '%s-%s%s' % (name, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12], kMirrorSuffix))
+
+    def lock(self, url):
+        return FileLock(self.path(url) + kLockSuffix)
+
+    @staticmethod
+    def git(args, cwd=None, check=True):
+        """Run git, returning its (stripped) output - raises on failure with git's error message"""
+        p = subprocess.Popen(['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        if p.returncode != 0 and check:
+            lines = [line for line in err.decode('utf-8', 'replace').splitlines() if line.strip()]
+            errors = [line for line in lines if line.startswith(('fatal:', 'error:'))]
+            raise Exception("git %s failed: %s" % (args[0], (errors or lines or ['exit code %d' % p.returncode])[-1]))
+        return out.decode('utf-8', 'replace').strip()
+
+    def update(self, url):
+        """Create or fetch into the mirror of url (the caller holds its lock) - returns its path"""
+        path = self.path(url)
+        if os.path.isdir(path):
+            self.git(['fetch', '--prune', '--quiet', 'origin'], cwd=path)
+        else:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            tmpname = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=self.root)
+            try:
+                self.git(['clone', '--mirror', '--quiet', url, tmpname])
+                os.rename(tmpname, path)
+            except:
+                shutil.rmtree(tmpname, ignore_errors=True)
+                raise
+        return path
+
+    def show(self, url, rev, filename):
+        """Contents (bytes) of filename (relative to the root of the repository) at rev"""
+        with self.lock(url):
+            path = self.update(url)
+            p = subprocess.Popen(['git', 'show', '%s:%s' % (rev, filename.replace(os.sep, '/'))], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        if p.returncode != 0:
+            raise Exception("Can't read %s at %s from %s: %s" % (filename, rev, url, err.decode('utf-8', 'replace').strip()))
+        return out
+
+    def push_tag(self, url, new_tag, existing_rev, dry_run=False):
+        """Tag the commit at existing_rev (a tag, branch or commit) as new_tag
+        in the repository at url, without checking anything out - returns the
+        commit tagged"""
+        with self.lock(url):
+            path = self.update(url)
+            commit = self.git(['rev-parse', '--verify', '%s^{commit}' % existing_rev], cwd=path)
+            if not dry_run:
+                self.git(['push', '--quiet', url, '%s:refs/tags/%s' % (commit, new_tag)], cwd=path)
+        return commit
+
+    def commit_files(self, url, files, message, dry_run=False, branch=None, log=print):
+        """Copy files ({source: path relative to the root of the repository})
+        into a worktree of branch (default the repository's default branch)
+        and commit and push them, if any have changed - returns whether they had"""
+        with self.lock(url):
+            path = self.update(url)
+            if not branch:
+                branch = self.git(['symbolic-ref', '--short', 'HEAD'], cwd=path)
+            worktree = tempfile.mkdtemp(prefix='worktree-', dir=self.root)
+            try:
+                self.git(['worktree', 'add', '--detach', '--quiet', worktree, 'refs/heads/%s' % branch], cwd=path)
+                for source, relpath in sorted(files.items()):
+                    dest = os.path.join(worktree, relpath)
+                    log("Copy %s to %s " % (source, dest))
+                    shutil.copy2(source, dest)
+                self.git(['add', '--'] + sorted(files.values()), cwd=worktree)
+                if subprocess.call(['git', 'diff', '--cached', '--quiet'], cwd=worktree) == 0:
+                    log("No changed files to commit!")
+                    return False
+                log("Committing changed files...")
+                log(self.git(['status', '--short'], cwd=worktree))
+                if not dry_run:
+                    self.git(['commit', '--quiet', '-m', message], cwd=worktree)
+                log("Pushing changes to %s (%s)" % (url, branch))
+                if not dry_run:
+                    self.git(['push', '--quiet', url, 'HEAD:refs/heads/%s' % branch], cwd=worktree)
+                return True
+            finally:
+                shutil.rmtree(worktree, ignore_errors=True)
+                self.git(['worktree', 'prune'], cwd=path, check=False)
@@ -0,0 +1,85 @@
+"""Fixtures shared by the tests - each test fetches into a workspace of its own,
+with its own archive cache, dependency store etc."""
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# aws.py (imported by dependencies) exits unless it finds AWS credentials. The
+# tests only use local archives, so they get a home of their own with dummy ones.
+kHome = tempfile.mkdtemp(prefix='ohdevtools-tests-')
+os.makedirs(os.path.join(kHome, '.aws'))
+with open(os.path.join(kHome, '.aws', 'credentials'), 'wt') as f:
+    f.write('[default]\naws_access_key_id = test\naws_secret_access_key = test\n')
+os.environ['HOME'] = kHome
+if 'HOMEPATH' in os.environ and 'HOMEDRIVE' in os.environ:
+    os.environ['HOMEDRIVE'], os.environ['HOMEPATH'] = os.path.splitdrive(kHome)
+
+kPlatform = 'Linux-x64'
+
+
+def make_tar(path, files):
+    """Write a tar archive (compressed as its extension says) of files - {name: bytes}"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    mode = 'w:gz' if path.endswith('.gz') else 'w'
+    with tarfile.open(path, mode) as tf:
+        for name, data in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            info.mtime = 1500000000
+            tf.addfile(info, io.BytesIO(data))
+    return path
+
+
+class Project(object):
+    """projectdata/dependencies.json of a workspace, with local archives for its dependencies"""
+
+    def __init__(self, root):
+        self.root = root
+        self.definitions = []
+
+    def archive(self, name, version, files=None, bundled=None):
+        """Make the archive of a dependency - files ({path in <name>/: bytes}), and
+        bundled (a list of definitions) as its dependencies.json. Returns its path."""
+        contents = dict(('%s/%s' % (name, path), data) for path, data in (files or {'lib/%s.so' % name: b'x' * 100}).items())
+        if bundled is not None:
+            contents['%s/dependencies.json' % name] = json.dumps(bundled).encode('utf-8')
+        return make_tar(os.path.join('archives', '%s-%s.tar.gz' % (name, version)), contents)
+
+    def add(self, name, version, files=None, bundled=None, **keys):
+        """Add a dependency on a local archive (made unless keys gives an archive-path)"""
+        definition = {'name': name, 'version': version, 'type': 'external', 'dest': 'dependencies/${platform}/'}
+        if 'archive-path' not in keys:
+            definition['archive-path'] = self.archive(name, version, files, bundled)
+        definition.update(keys)
+        self.definitions.append(definition)
+        self.write()
+        return definition
+
+    def write(self):
+        with open(os.path.join('projectdata', 'dependencies.json'), 'wt') as f:
+            json.dump(self.definitions, f)
+
+    def fetch(self, **kwargs):
+        import dependencies
+        options = {'platform': kPlatform, 'env': {'linn-git-user': 'test', 'debugmode': 'Release', 'titlecase-debugmode': 'Release'},
+                   'fetch': True, 'clean': False, 'local_overrides': False}
+        options.update(kwargs)
+        return dependencies.fetch_dependencies(**options)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    root = tmp_path / 'ws'
+    (root / 'projectdata').mkdir(parents=True)
+    monkeypatch.chdir(root)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('LOCALAPPDATA', str(tmp_path / 'cache'))
+    return Project(root)
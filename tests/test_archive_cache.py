@@ -0,0 +1,35 @@
+"""Per-user cache of downloaded archives"""
+import os
+import shutil
+import archive_cache
+import aws
+from conftest import kPlatform
+
+kRemote = 's3://bucket/A-1.0.0.tar.gz'
+
+
+class EvictingCache(archive_cache.ArchiveCache):
+    """A cache in which another build evicts each archive just after it is looked up"""
+
+    def lookup(self, path):
+        filename = archive_cache.ArchiveCache.lookup(self, path)
+        if filename:
+            self.remove(path)
+        return filename
+
+
+def test_archive_evicted_after_lookup_is_downloaded(project, tmp_path, monkeypatch, capsys):
+    local = project.archive('A', '1.0.0')
+    info = {'size': os.path.getsize(local), 'etag': '"1"'}
+    monkeypatch.setattr(aws, 'info', lambda path: info if path == kRemote else None)
+    monkeypatch.setattr(aws, 'stream', lambda path: (open(local, 'rb'), info))
+    cache = EvictingCache(str(tmp_path / 'archives'))
+    copy = cache.new_temp()
+    shutil.copy(local, copy)
+    cache.insert(kRemote, info, copy)
+    project.add('A', '1.0.0', **{'archive-path': kRemote})
+
+    project.fetch(cache=cache)
+
+    assert 'CACHE copy of %s has gone' % kRemote in capsys.readouterr().out
+    assert os.path.isfile(os.path.join('dependencies', kPlatform, 'A', 'lib', 'A.so'))
@@ -0,0 +1,37 @@
+"""Parallel extraction of archives"""
+import io
+import os
+import tarfile
+import time
+import pytest
+import archives
+from conftest import make_tar
+
+
+class SlowExtractor(archives.ParallelExtractor):
+    """Extractor whose writes take long enough to still be running when reading fails"""
+
+    def __init__(self, dest):
+        archives.ParallelExtractor.__init__(self, dest)
+        self.submitted = []
+
+    def submit(self, fn, *args, **kwargs):
+        archives.ParallelExtractor.submit(self, fn, *args, **kwargs)
+        self.submitted.append(self.pending[-1])
+
+    def write_file(self, *args):
+        time.sleep(0.05)
+        archives.ParallelExtractor.write_file(self, *args)
+
+
+def test_failed_tar_leaves_no_writes_running(tmp_path):
+    archive = make_tar(str(tmp_path / 'a.tar.gz'), dict(('A/%d.txt' % i, os.urandom(4096)) for i in range(64)))
+    with open(archive, 'rb') as f:
+        data = f.read()
+    extractor = SlowExtractor(str(tmp_path / 'dest'))
+    with archives.TarStream(io.BytesIO(data[:len(data) * 3 // 4]), archive) as source:
+        with pytest.raises((tarfile.TarError, EOFError, IOError)):
+            extractor.extract_tar(source.tarfile)
+    assert extractor.submitted
+    assert all(future.done() for future in extractor.submitted)
+    assert not extractor.pending
@@ -0,0 +1,24 @@
+"""Splitting files into content-defined chunks"""
+import io
+import random
+import chunked_artifacts
+
+
+def chunk_sizes(data):
+    return [len(chunk) for chunk in chunked_artifacts.split(io.BytesIO(data))]
+
+
+def test_split_is_the_same_with_and_without_numpy(monkeypatch):
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(5 * 1024 * 1024))
+    sizes = chunk_sizes(data)
+    assert sum(sizes) == len(data)
+    assert all(size <= chunked_artifacts.kMaxChunk for size in sizes)
+    assert len(sizes) > 1
+    monkeypatch.setattr(chunked_artifacts, 'numpy', None)
+    assert chunk_sizes(data) == sizes
+
+
+def test_split_cuts_unchanging_data_at_the_largest_chunk():
+    data = b'\0' * (2 * chunked_artifacts.kMaxChunk + 10)
+    assert chunk_sizes(data) == [chunked_artifacts.kMaxChunk, chunked_artifacts.kMaxChunk, 10]
@@ -0,0 +1,30 @@
+"""Cross-check of the dependency versions used by the project and its dependencies"""
+import pytest
+
+kCommon21 = [{'name': 'Common', 'version': '2.1.0', 'type': 'external', 'archive-filename': 'Common-2.1.0.tar.gz'}]
+
+
+def test_mismatched_versions_fail_the_fetch(project, capsys):
+    project.add('A', '1.0.0', bundled=kCommon21)
+    project.add('Common', '2.0.0')
+    with pytest.raises(Exception, match='cross-check'):
+        project.fetch(keep_going=True)
+    # found as A was fetched, and not reported again by the final check
+    assert capsys.readouterr().out.count('Common               --> FAILED') == 1
+
+
+@pytest.mark.parametrize('locked', [False, True])
+def test_cross_check_false_is_honoured(project, locked):
+    project.add('A', '1.0.0', bundled=kCommon21)
+    project.add('Common', '2.0.0', **{'cross-check': False})
+    if locked:
+        project.fetch(fetch=False, lock=True)
+    project.fetch(locked=locked)
+
+
+def test_clean_fetch_is_only_cross_checked_when_asked(project):
+    project.add('A', '1.0.0', bundled=kCommon21)
+    project.add('Common', '2.0.0')
+    project.fetch(clean=True)
+    with pytest.raises(Exception, match='cross-check'):
+        project.fetch(clean=True, cross_check=True, keep_going=True)
@@ -0,0 +1,33 @@
+"""Fetching dependencies from local archives"""
+import os
+import pytest
+import fetch_manifest
+from conftest import kPlatform
+
+
+def test_concurrent_fetch_unpacks_every_dependency(project):
+    for i in range(6):
+        project.add('Dep%d' % i, '1.0.%d' % i, files={'lib/%d.so' % i: b'%d' % i * 1000, 'include/%d.h' % i: b'h'})
+    project.fetch(jobs=4)
+    for i in range(6):
+        with open(os.path.join('dependencies', kPlatform, 'Dep%d' % i, 'lib', '%d.so' % i), 'rb') as f:
+            assert f.read() == b'%d' % i * 1000
+    manifest = fetch_manifest.FetchManifest(os.path.join('dependencies', 'loadedDeps.json'))
+    assert len(list(manifest.items())) == 6
+
+
+def test_unchanged_dependencies_are_skipped(project, capsys):
+    project.add('A', '1.0.0')
+    project.fetch()
+    capsys.readouterr()
+    project.fetch()
+    assert 'Skipping fetch of A as unchanged' in capsys.readouterr().out
+
+
+def test_missing_archive_leaves_a_clean_fetch_alone(project):
+    project.add('A', '1.0.0')
+    project.fetch()
+    project.add('B', '1.0.0', **{'archive-path': 'archives/B-1.0.0-unpublished.tar.gz'})
+    with pytest.raises(Exception, match='Failed to load'):
+        project.fetch(clean=True)
+    assert os.path.isfile(os.path.join('dependencies', kPlatform, 'A', 'lib', 'A.so'))
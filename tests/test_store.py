@@ -0,0 +1,41 @@
+"""Per-machine store of unpacked dependencies"""
+import os
+import stat
+from dependency_store import DependencyStore
+
+
+def write(path, data, mode=None):
+    if mode is not None and os.path.exists(path):
+        os.chmod(path, mode)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def make_entry(tmp_path):
+    store = DependencyStore(str(tmp_path / 'store'), hardlink=True)
+
+    def unpack(tree):
+        write(os.path.join(tree, 'lib.so'), b'x' * 100)
+        return {}
+    store.populate('A-key', 'A-1.0.0.tar.gz', unpack)
+    return store, os.path.join(store.entry_dir('A-key'), 'tree', 'lib.so')
+
+
+def test_write_through_hardlink_is_found_without_hashing(tmp_path):
+    store, path = make_entry(tmp_path)
+    assert store.check('A-key') is None
+    st = os.stat(path)
+    write(path, b'y' * 100, stat.S_IRUSR | stat.S_IWUSR)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+    assert store.check('A-key') == 'modified: lib.so'
+
+
+def test_full_check_hashes_files(tmp_path):
+    store, path = make_entry(tmp_path)
+    st = os.stat(path)
+    write(path, b'y' * 100, stat.S_IRUSR | stat.S_IWUSR)
+    os.utime(path, (st.st_atime, st.st_mtime))
+    assert store.check('A-key') is None
+    assert store.check('A-key', full=True) == 'modified: lib.so'
+    assert [key for key, _archive, _problem in store.verify()] == ['A-key']
+    assert not store.contains('A-key')
@@ -0,0 +1,22 @@
+"""Fetching the dependencies listed by other dependencies"""
+import os
+import pytest
+from conftest import kPlatform
+
+
+def test_bundled_dependencies_are_fetched(project):
+    project.archive('B', '1.0.0')
+    project.add('A', '1.0.0', bundled=[{'name': 'B', 'version': '1.0.0', 'type': 'external',
+                                        'dest': 'dependencies/${platform}/', 'archive-path': 'archives/B-1.0.0.tar.gz'}])
+    project.fetch(transitive=True)
+    assert os.path.isfile(os.path.join('dependencies', kPlatform, 'B', 'lib', 'B.so'))
+
+
+def test_unresolvable_bundled_dependency_is_reported(project, capsys):
+    project.add('A', '1.0.0', bundled=[{'name': 'Z', 'version': '1.2.3'}])
+    with pytest.raises(Exception, match='Failed to load'):
+        project.fetch(transitive=True)
+    out = capsys.readouterr().out
+    assert 'unable to resolve Z (listed by A)' in out
+    assert 'Failed to fetch some dependencies: Z' in out
+    assert os.path.isfile(os.path.join('dependencies', kPlatform, 'A', 'lib', 'A.so'))
@@ -0,0 +1,62 @@
+"""Unpacking Yocto SDK installers without running them"""
+import io
+import os
+import tarfile
+import yocto_sdk
+
+kSysroot = 'sysroots/x86_64-pokysdk-linux'
+
+
+def make_installer(path, default_dir):
+    """A minimal installer - a script, then a tar of an SDK installed in default_dir"""
+    members = {
+        'environment-setup-armv7': b'export SDKTARGETSYSROOT=%s/sysroots/armv7\n'
+                                   b'export OECORE_NATIVE_SYSROOT="@SDKPATH@/%s"\n' % (default_dir.encode(), kSysroot.encode()),
+        'site-config-armv7': b'ac_cv_path=%s/sysroots/armv7/usr/lib\n' % default_dir.encode(),
+        'version-armv7': b'Distro: poky\nSDK path: %s\n' % default_dir.encode(),
+        kSysroot + '/usr/bin/tool.pl': b'#! /usr/bin/perl -w\nprint "%s";\n' % default_dir.encode(),
+        kSysroot + '/usr/share/config.txt': b'prefix=%s\n' % default_dir.encode(),
+        'sysroots/armv7/usr/lib/libc.so': b'\x7fELF\0binary',
+    }
+    payload = io.BytesIO()
+    with tarfile.open(fileobj=payload, mode='w:gz') as tf:
+        for name, data in sorted(members.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755 if name.endswith('.pl') else 0o644
+            tf.addfile(info, io.BytesIO(data))
+        for name, target in (('%s/usr/lib/libc.so' % kSysroot, '%s/sysroots/armv7/usr/lib/libc.so' % default_dir),
+                             ('%s/usr/armv7' % kSysroot, '%s/sysroots/armv7' % default_dir)):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tf.addfile(info)
+    with open(path, 'wb') as f:
+        f.write(b'#!/bin/sh\nDEFAULT_INSTALL_DIR="%s"\nSDK_EXTENSIBLE=""\nexit 0\nMARKER:\n' % default_dir.encode())
+        f.write(payload.getvalue())
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_installer_is_relocated(tmp_path):
+    # the default directory exists, so that symlinks to directories in it are seen as directories
+    default_dir = str(tmp_path / 'opt' / 'poky')
+    installer = str(tmp_path / 'sdk.sh')
+    make_installer(installer, default_dir)
+    os.makedirs(os.path.join(default_dir, 'sysroots', 'armv7'))
+    dest = str(tmp_path / 'deps' / 'sdk')
+
+    stats = yocto_sdk.extract(installer, dest, str(tmp_path / 'deps'))
+
+    assert stats is not None
+    for name in ('environment-setup-armv7', 'site-config-armv7', 'version-armv7', kSysroot + '/usr/share/config.txt'):
+        data = read(os.path.join(dest, name))
+        assert default_dir.encode() not in data and dest.encode() in data, name
+    assert b'@SDKPATH@' not in read(os.path.join(dest, 'environment-setup-armv7'))
+    assert read(os.path.join(dest, kSysroot, 'usr/bin/tool.pl')).startswith(b'#!/usr/bin/env perl\n')
+    assert os.readlink(os.path.join(dest, kSysroot, 'usr/lib/libc.so')) == dest + '/sysroots/armv7/usr/lib/libc.so'
+    assert os.readlink(os.path.join(dest, kSysroot, 'usr/armv7')) == dest + '/sysroots/armv7'
+    assert read(os.path.join(dest, 'sysroots/armv7/usr/lib/libc.so')) == b'\x7fELF\0binary'
@@ -0,0 +1,70 @@
+"""Fast removal of large directory trees: rename them out of the way, delete in the background"""
+import os
+import subprocess
+import sys
+import time
+import archives
+
+kTrashDirname = '.ohdevtools-trash'
+
+
+def trash_dir(path):
+    """Trash directory used for path - a sibling, so on the same filesystem"""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), kTrashDirname)
+
+
+def move_to_trash(path):
+    """Atomically rename path into the trash and start deleting it in the
+    background. Returns False (leaving path in place) if it can't be renamed -
+    e.g. on Windows if a file in it is open, or if path is a mount point."""
+    path = os.path.abspath(path)
+    trash = trash_dir(path)
+    try:
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+            with open(os.path.join(trash, '.gitignore'), 'wt') as f:
+                f.write('*\n')
+        os.rename(path, os.path.join(trash, '%s-%d-%d' % (os.path.basename(path), os.getpid(), int(time.time() * 1000))))
+    except OSError:
+        return False
+    empty_trash(trash)
+    return True
+
+
+def purge(parent='.'):
+    """Start deleting anything left in the trash under parent by an earlier run
+    (e.g. one whose background delete was interrupted)"""
+    trash = os.path.join(os.path.abspath(parent), kTrashDirname)
+    if os.path.isdir(trash) and [name for name in os.listdir(trash) if name != '.gitignore']:
+        empty_trash(trash)
+
+
+def empty_trash(trash):
+    """Delete the contents of trash in a detached process, which outlives this one"""
+    kwargs = {}
+    if sys.platform == 'win32':
+        kwargs['creationflags'] = 0x00000008 | 0x00000200      # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), trash],
+                         stdin=subprocess.DEVNULL, stdout=devnull, stderr=devnull, close_fds=True, **kwargs)
+
+
+def _delete_contents(trash):
+    for name in os.listdir(trash):
+        if name != '.gitignore':
+            try:
+                archives.rmtree(os.path.join(trash, name))
+            except OSError:
+                pass    # being deleted by another run, or still open (Windows) - left for a later purge
+    if os.listdir(trash) == ['.gitignore']:
+        try:
+            os.unlink(os.path.join(trash, '.gitignore'))
+            os.rmdir(trash)
+        except OSError:
+            pass        # something else was moved into the trash meanwhile
+
+
+if __name__ == '__main__':
+    _delete_contents(sys.argv[1])
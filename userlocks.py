@@ -63,6 +63,52 @@ class PosixUserLock(BaseUserLock):
         self.f.close()
 
 
+class FileLock(object):
+    '''
+    Blocking exclusive lock on the given file, for short critical sections
+    shared between threads and processes (e.g. updates to an on-disk cache
+    index). Each 'with' block opens its own handle, so separate FileLock
+    instances on the same file exclude each other within a process too.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+
+    def __enter__(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass
+        self.f = open(self.filename, 'a+')
+        if platform.system() == 'Windows':
+            import msvcrt
+            self.f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass        # LK_LOCK gives up after 10s - keep waiting
+        else:
+            import fcntl
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, etype, einstance, etraceback):
+        if platform.system() == 'Windows':
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+
 def userlock(name):
     '''
     Acquire a lock scoped to the local user. Only one build at a time can run
@@ -4,7 +4,7 @@ import sys
 
 # The version number of the API. Incremented whenever there
 # are new features or bug fixes.
-VERSION = 146
+VERSION = 171
 
 # The earliest API version that we're still compatible with.
 # Changed only when a change breaks an existing API.
@@ -0,0 +1,214 @@
+"""Unpacking of Yocto SDK installers (.sh) without running them.
+
+An installer is a shell script (toolchain-shar-extract.sh) followed, after a
+line 'MARKER:', by the SDK as a compressed tar (or zip) archive. Running it
+checks the host, unpacks the archive with tar and then relocates the SDK from
+its default install directory with a mix of sed, find, file and the SDK's own
+relocate_sdk.py. extract() does the same from Python: it streams the payload
+through the parallel extractor, rewrites the text files and symlinks that refer
+to the default directory, and runs relocate_sdk.py only over the ELF
+executables that need it."""
+import os
+import re
+import stat
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import archives
+
+kMarker           = b'MARKER:'
+kMaxHeader        = 1024 * 1024     # installer scripts are a few tens of KB
+kRelocateBatch    = 256             # executables per run of relocate_sdk.py
+kSdkPathToken     = b'@SDKPATH@'
+kPayloadFormats   = [               # magic number -> format, as an archive extension
+    (b'\xfd7zXZ\x00', '.tar.xz'),
+    (b'\x28\xb5\x2f\xfd', '.tar.zst'),
+    (b'\x1f\x8b', '.tar.gz'),
+    (b'BZh', '.tar.bz2'),
+    (b'PK\x03\x04', '.zip')]
+kPerlRewrites     = [               # as the installer does, so that scripts use the SDK's perl
+    (re.compile(br'^#!.*/usr/bin/perl.*$', re.MULTILINE), b'#!/usr/bin/env perl'),
+    (b' /usr/bin/perl', b' /usr/bin/env perl')]
+
+
+def read_header(installer):
+    """Settings from the script part of installer, and the offset of its
+    payload - (settings, offset), or None if there is no payload marker"""
+    settings = {}
+    with open(installer, 'rb') as f:
+        while f.tell() < kMaxHeader:
+            line = f.readline()
+            if not line:
+                break
+            if line.rstrip(b'\r\n') == kMarker:
+                return settings, f.tell()
+            match = re.match(br'^([A-Z_]+)="?([^"\s]*)"?\s*$', line)
+            if match:
+                settings[match.group(1).decode('ascii')] = match.group(2).decode('utf-8', 'replace')
+    return None
+
+
+def payload_format(installer, offset):
+    with open(installer, 'rb') as f:
+        f.seek(offset)
+        magic = f.read(8)
+    for prefix, extension in kPayloadFormats:
+        if magic.startswith(prefix):
+            return extension
+    return None
+
+
+def extract(installer, dest, base):
+    """Install the SDK in installer into dest (as 'installer -y -d dest' would).
+    Returns archives.ExtractStats, with the table relative to base, or None if
+    the installer isn't in a form that can be unpacked directly, in which case
+    it should be run instead."""
+    header = read_header(installer)
+    if header is None:
+        return None
+    settings, offset = header
+    default_dir = settings.get('DEFAULT_INSTALL_DIR')
+    extension = payload_format(installer, offset)
+    if not default_dir or extension is None or settings.get('SDK_EXTENSIBLE') == '1':
+        return None     # extensible SDKs need their own set up after unpacking
+
+    start = time.time()
+    dest = os.path.realpath(dest)
+    archives.ParallelExtractor.makedirs(dest)
+    extractor = archives.ParallelExtractor(dest)
+    if extension == '.zip':
+        # zipfile finds the archive's directory from the end, so skips the script itself
+        stats = extractor.extract_zip(installer)
+    else:
+        with open(installer, 'rb') as f:
+            f.seek(offset)
+            with archives.TarStream(f, extension) as payload:
+                stats = extractor.extract_tar(payload.tarfile)
+    if default_dir != dest:
+        changed = relocate(dest, default_dir)
+        for path in changed:
+            st = os.stat(path)
+            stats.table[extractor.relative(path)] = [st.st_size, int(st.st_mtime), archives.hash_file(path)]
+        for name in list(stats.table):
+            if not os.path.lexists(os.path.join(dest, name)):
+                del stats.table[name]      # e.g. relocate_sdk.py, removed once used
+    prefix = os.path.relpath(dest, base).replace('\\', '/')
+    stats.table = dict(('%s/%s' % (prefix, name), entry) for name, entry in stats.table.items())
+    stats.seconds = time.time() - start
+    return stats
+
+
+def relocate(sdk_dir, default_dir):
+    """Relocate an SDK unpacked into sdk_dir from default_dir, as the installer
+    does. Returns the paths of the files changed."""
+    old = default_dir.encode('utf-8')
+    new = sdk_dir.encode('utf-8')
+    replacements = [(old, new)] + kPerlRewrites
+    changed = set()
+
+    # fix environment paths, and the default directory in the other text files
+    # at the top level (site-config-*, version-* etc.)
+    native_sysroot = None
+    for name in sorted(os.listdir(sdk_dir)):
+        path = os.path.join(sdk_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        if name.startswith('environment-setup-'):
+            if _replace_in_file(path, [(kSdkPathToken, new)] + replacements):
+                changed.add(path)
+            match = re.search(br'OECORE_NATIVE_SYSROOT="?([^"\s]+)', _read(path))
+            if match:
+                native_sysroot = match.group(1).decode('utf-8')
+        elif _replace_in_file(path, replacements, text_only=True):
+            changed.add(path)
+    if native_sysroot is None or not os.path.isdir(native_sysroot):
+        return changed
+
+    # replace the default directory in text files (configs, scripts etc.), find
+    # the executables that may need their loader changed and fix symlinks (to
+    # directories as well as files)
+    texts = []
+    executables = []
+    for dirpath, dirnames, filenames in os.walk(native_sysroot):
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                _relink(path, default_dir, sdk_dir)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                _relink(path, default_dir, sdk_dir)
+            elif os.stat(path).st_mode & 0o111:
+                executables.append(path)
+            else:
+                texts.append(path)
+    with ThreadPoolExecutor(archives.default_jobs()) as pool:
+        elves = [path for path, elf in zip(executables, pool.map(_is_elf, executables)) if elf]
+        texts.extend(sorted(set(executables) - set(elves)))     # scripts
+        for path, replaced in zip(texts, pool.map(lambda p: _replace_in_file(p, replacements, text_only=True), texts)):
+            if replaced:
+                changed.add(path)
+
+        # fix dynamic loader paths in all ELF SDK binaries
+        relocate_script = os.path.join(sdk_dir, 'relocate_sdk.py')
+        loaders = sorted(name for name in os.listdir(os.path.join(native_sysroot, 'lib'))
+                         if name.startswith('ld-linux')) if os.path.isdir(os.path.join(native_sysroot, 'lib')) else []
+        if elves and loaders and os.path.isfile(relocate_script):
+            dl_path = os.path.join(native_sysroot, 'lib', loaders[0])
+            batches = [elves[i:i + kRelocateBatch] for i in range(0, len(elves), kRelocateBatch)]
+            for _ in pool.map(lambda batch: subprocess.check_call(
+                    [sys.executable, relocate_script, sdk_dir, dl_path] + batch), batches):
+                pass
+            changed.update(elves)
+
+    post_relocate = os.path.join(sdk_dir, 'post-relocate-setup.sh')
+    if os.path.isfile(post_relocate):
+        _replace_in_file(post_relocate, ((old, new),))
+        subprocess.check_call(['/bin/sh', post_relocate, sdk_dir, default_dir])
+        os.unlink(post_relocate)
+    # as the installer does, so that the SDK can't be relocated again
+    for name in ('relocate_sdk.py', 'relocate_sdk.sh'):
+        if os.path.exists(os.path.join(sdk_dir, name)):
+            os.unlink(os.path.join(sdk_dir, name))
+    return set(path for path in changed if os.path.isfile(path))
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _is_elf(path):
+    with open(path, 'rb') as f:
+        return f.read(4) == b'\x7fELF'
+
+
+def _relink(path, default_dir, sdk_dir):
+    target = os.readlink(path)
+    if default_dir in target:
+        os.unlink(path)
+        os.symlink(target.replace(default_dir, sdk_dir, 1), path)
+
+
+def _replace_in_file(path, replacements, text_only=False):
+    """Make replacements ((old, new) - old being bytes or a compiled
+    pattern) in the file at path. Returns whether it was changed."""
+    with open(path, 'rb') as f:
+        data = f.read(8192)
+        if text_only and b'\0' in data:
+            return False
+        data += f.read()
+    original = data
+    for old, new in replacements:
+        data = old.sub(new, data) if hasattr(old, 'sub') else data.replace(old, new)
+    if data == original:
+        return False
+    st = os.stat(path)
+    if not st.st_mode & stat.S_IWUSR:
+        os.chmod(path, st.st_mode | stat.S_IWUSR)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, (st.st_atime, st.st_mtime))
+    return True